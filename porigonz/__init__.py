@@ -1,14 +1,30 @@
+from __future__ import print_function
+
+import errno
 from optparse import OptionParser
 import os
 import re
 import shutil
 from sys import argv, exit, stderr, stdout
 
-from porigonz.nds import DSImage
-from porigonz.nds import format
+# Only what every command needs is imported up here; anything heavier (PIL,
+# the decoders, multiprocessing) is imported by the commands that use it, so
+# simple commands like list start quickly
+from porigonz.compat import binary_stream, text_type
+from porigonz.nds import DSImage, content_hash
+from porigonz.nds import stats
 
 help = """porigon-z: a Nintendo DS game image inspector aimed at Pokemon
-Syntax: porigon-z {path-to-image-file} {command} ...
+Syntax: porigon-z [--profile[=FILE]] [--memstats[=FILE]]
+                 {path-to-image-file} {command} ...
+
+--profile           Print how long each stage of the work took, and counts of
+                    what was done, when finished.  With =FILE, write them to
+                    FILE as JSON instead.
+--memstats          As --profile, but also track how much memory each stage
+                    allocated, and the peak.  (Traced with tracemalloc on
+                    Python 3, which is slow; by resident size on Python 2,
+                    and on Linux only, except the peak.)
 
 Commands:
 list
@@ -19,6 +35,97 @@ cat [-f FORMAT] {ds-filename}
 
     -f FORMAT       Specifies the formatting to use.
 
+    Formats that produce images also take these options:
+
+    --image-format TYPE     png (the default), webp (lossless), or raw
+                            (one byte per pixel, palette indices if any).
+    --compress-level N      Compression level from 0 to 9.  Default is 6.
+    --optimize              Try harder to make images small.
+    -t THREADS              Number of threads to encode images with.
+                            Default is one per CPU.
+
+extract [-d DIRECTORY] [-f FORMAT] [--link-duplicates] [ds-filename ...]
+    Extracts files from the DS image into a directory, applying a format.
+    Takes the same image options as cat.
+
+    --link-duplicates   Hardlink identical output files together.  Files
+                        identical to one already extracted are linked
+                        without being formatted again.
+
+replace [-o OUTPUT] {ds-filename[:member]} {source-file} ...
+    Replaces files within the DS image with the contents of files on disk.
+    Give a NARC member number after a colon to replace just that member.
+    Files that grow too big for where they were are moved to the end of the
+    image; nothing else moves.
+
+    -o OUTPUT       Write the changed image here instead of changing this
+                    one.
+
+verify [-j JOBS] [-q] [other-image-file ...]
+    Checks the header, logo, banner, and secure area CRCs of this image, and
+    any others given, and reports how fast that went.  Exits with an error if
+    any CRC is wrong.
+
+    -j JOBS         Number of processes to check images with.
+    -q              Only print images with a wrong CRC.
+
+serve [-p PORT] [-j JOBS] [--cache-size MB] [other-image-file ...]
+    Serves files, NARC members, and anything a format can make of them over
+    HTTP on 127.0.0.1, keeping this image (and any others) open between
+    requests.  GET / for the list of images, /N/ for the files in image N,
+    and /N/FORMAT/ds-filename for a file, with ?member=M (any number of
+    times) to use only those NARC members.  Takes --image-format,
+    --compress-level, and --optimize as for cat.  See porigonz/nds/serve.py
+    for more.
+
+    -p PORT         Port to listen on.  Default is 8000.
+    -j JOBS         Number of processes to decode with.
+    --cache-size MB Most memory to keep responses in.  Default is 64.
+
+hash [-j JOBS] [--rebuild] [--members] [--duplicates]
+    Prints a SHA-1 hash of every file, in the style of sha1sum.  Hashes are
+    saved, like search indices, so this is only slow the first time.
+
+    -j JOBS         Number of processes to hash with.
+    --rebuild       Hash everything again even if the hashes are saved.
+    --members       Also print a hash for every NARC member, as path/n.
+    --duplicates    Instead, print groups of identical files (and members,
+                    with --members), separated by blank lines.
+
+search [-i] [-j JOBS] [--rebuild] {text}
+    Finds every string of Pokemon text containing the given text, printing
+    the file, NARC member, and string index of each.  The first search on an
+    image builds an index of all its text, which is saved for next time.
+
+    -i              Ignore case.
+    -j JOBS         Number of processes to use when building the index.
+    --rebuild       Rebuild the index even if one already exists.
+
+text-dump [-j JOBS]
+    Prints every string of Pokemon text in every NARC as JSON Lines, one
+    record per string, with "file", "member", "index", and "text" keys.
+
+    -j JOBS         Number of processes to decrypt text with.
+
+diff [--depth DEPTH] {other-image-file}
+    Compares this image with another, printing every difference as JSON
+    Lines: one record per added, removed, or changed file, NARC member, or
+    string of Pokemon text.  Files are matched by path.
+
+    --depth DEPTH   How far to look: file, member, or text (the default).
+
+records [-l LAYOUT | --fields FIELDS] [-o OUTPUT] {ds-filename}
+    Decodes a file made of fixed-size records and prints them as a table.
+    Each member of a NARC is one record; any other file is taken to be
+    records packed end to end.
+
+    -l LAYOUT       A known record layout: pokemon-base-stats or
+                    pokemon-moves.
+    --fields FIELDS A custom layout, as comma-separated name:code pairs,
+                    where codes are Python struct codes: B, h, I, 16s, etc.
+                    Use 2x and the like for padding.
+    -o OUTPUT       csv (the default), jsonl, or columnar (binary).
+
 Formats:
 raw
     The default.  Does no processing at all; spits out raw binary.
@@ -31,24 +138,51 @@ narc-hex
 """
 
 def main():
-    if len(argv) < 3:
-        print help
+    args = argv[1:]
+
+    # Global options come before the image filename
+    profile = None
+    memstats = False
+    while args and args[0].startswith('--'):
+        option, _, value = args.pop(0).partition('=')
+        if option == '--profile':
+            profile = value or '-'
+        elif option == '--memstats':
+            profile = value or profile or '-'
+            memstats = True
+        else:
+            print(help)
+            exit(0)
+
+    if len(args) < 2:
+        print(help)
         exit(0)
 
-    (filename, command) = argv[1:3]
-    args = argv[3:]
-    image = DSImage(filename)
+    if profile:
+        stats.enable(memory=memstats)
 
-    func = globals().get("command_%s" % command, None)
-    if func:
-        func(image, args)
-    else:
-        print help
+    (filename, command) = args[0:2]
+    args = args[2:]
+
+    func = globals().get("command_%s" % re.sub('-', '_', command), None)
+    if not func:
+        print(help)
         exit(0)
 
+    try:
+        image = DSImage(filename)
+        func(image, args)
+    finally:
+        if profile == '-':
+            stats.write_summary(stderr)
+        elif profile:
+            f = open(profile, 'w')
+            stats.write_json(f)
+            f.close()
+
 
 def command_examine(image, args):
-    print image.banner.title_en
+    print(image.banner.title_en)
 
 
 def command_list(image, args):
@@ -63,26 +197,46 @@ def command_list(image, args):
             path_parts.pop()  # Drop filename
             if path_parts != prev_path_parts:
                 dir_path = '/'.join(path_parts)
-                print dir_path
+                print(dir_path)
                 prev_path_parts = path_parts
         else:
             path = '(no filename)'
 
         end = dsfile.offset + dsfile.length
 
-        print "%(id)5d 0x%(start)08x 0x%(end)08x %(length)9d %(path)s" % {
+        print("%(id)5d 0x%(start)08x 0x%(end)08x %(length)9d %(path)s" % {
             'id': dsfile.id,
             'start': dsfile.offset,
             'end': end,
             'length': dsfile.length,
             'path': path,
-        }
+        })
+
+
+def add_encoder_options(parser):
+    """Adds options for image formats to an OptionParser."""
+    from porigonz.nds.util.encoder import FORMATS
+    parser.add_option('--image-format', dest='image_format', type='choice', choices=FORMATS, default='png')
+    parser.add_option('--compress-level', dest='compress_level', type='int', default=6)
+    parser.add_option('--optimize', dest='optimize', action='store_true', default=False)
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=None)
+
+def encoder_from_options(options):
+    """Returns an ImageEncoder configured by `add_encoder_options` options."""
+    from porigonz.nds.util.encoder import ImageEncoder
+    return ImageEncoder(
+        format=options.image_format,
+        compress_level=options.compress_level,
+        optimize=options.optimize,
+        threads=options.threads,
+    )
 
 
 def command_cat(image, args):
     parser = OptionParser()
     parser.add_option('-f', '--format', dest='format', default='raw')
     parser.add_option('-s', '--split-narc', dest='splitnarc', type='choice', choices=['always', 'never', 'auto'], default='auto')
+    add_encoder_options(parser)
     options, (dsfilename,) = parser.parse_args(args)
 
     # XXX factor this out; do wildcards and ids
@@ -107,15 +261,254 @@ def command_cat(image, args):
     if split_narc:
         chunks = dsfile.parse_narc()
     else:
-        chunks = [ dsfile ]
+        chunks = [ dsfile.contents ]
 
     # Output formatting
+    from porigonz.nds import format
     format_name = re.sub('-', '_', options.format)
     formatter = getattr(format, format_name)
 
     # Finally, print everything
-    for chunk in formatter(chunks):
-        print chunk
+    out = binary_stream(stdout)
+    with encoder_from_options(options) as encoder:
+        for chunk in formatter(chunks, encoder=encoder):
+            out.write(bytes(chunk))
+            out.write(b'\n')
+
+
+def command_search(image, args):
+    from porigonz.nds.search import TextIndex
+
+    parser = OptionParser()
+    parser.add_option('-i', '--ignore-case', dest='ignore_case', action='store_true', default=False)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None)
+    parser.add_option('--rebuild', dest='rebuild', action='store_true', default=False)
+    parser.add_option('--cache-dir', dest='cache_dir', default=None)
+    options, words = parser.parse_args(args)
+
+    query = ' '.join(words)
+    if isinstance(query, bytes):
+        query = query.decode('utf8')
+    if not query:
+        stderr.write("Nothing to search for.\n")
+        return
+
+    index = TextIndex.for_image(image, cache_dir=options.cache_dir,
+                                rebuild=options.rebuild, workers=options.jobs)
+
+    for path, member, string_index, string in index.search(query, ignore_case=options.ignore_case):
+        line = u"%s:%d:%d: %s\n" % (path, member, string_index, string)
+        binary_stream(stdout).write(line.encode('utf8'))
+
+command_grep = command_search
+
+
+def command_text_dump(image, args):
+    from porigonz.nds.textdump import dump_json_lines
+
+    parser = OptionParser()
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None)
+    options, _ = parser.parse_args(args)
+
+    dump_json_lines(image, binary_stream(stdout), workers=options.jobs)
+
+
+def command_diff(image, args):
+    from porigonz.nds.diff import DEPTHS, diff_images, dump_json_lines
+
+    parser = OptionParser()
+    parser.add_option('--depth', dest='depth', type='choice', choices=DEPTHS, default='text')
+    options, (other_filename,) = parser.parse_args(args)
+
+    other = DSImage(other_filename)
+    dump_json_lines(diff_images(image, other, depth=options.depth),
+                    binary_stream(stdout))
+
+
+def command_records(image, args):
+    from porigonz.nds.records import RecordLayout, RecordTable, layouts
+
+    parser = OptionParser()
+    parser.add_option('-l', '--layout', dest='layout', type='choice', choices=sorted(layouts), default=None)
+    parser.add_option('--fields', dest='fields', default=None)
+    parser.add_option('-o', '--output', dest='output', type='choice', choices=sorted(RecordTable.writers), default='csv')
+    options, (dsfilename,) = parser.parse_args(args)
+
+    if options.fields:
+        layout = RecordLayout.from_string(options.fields)
+    elif options.layout:
+        layout = layouts[options.layout]
+    else:
+        stderr.write("Need a record layout; use -l or --fields.\n")
+        return
+
+    # XXX factor this out; do wildcards and ids
+    matches = [dsfile for dsfile in image.dsfiles if dsfile.path == dsfilename]
+    if not matches:
+        stderr.write("No such file.\n")
+        return
+    dsfile = matches[0]
+
+    if dsfile.is_narc:
+        table = layout.decode(dsfile.parse_narc())
+    else:
+        table = layout.decode_packed(dsfile.contents)
+
+    if options.output == 'columnar':
+        table.write(binary_stream(stdout), options.output)
+    else:
+        table.write(stdout, options.output)
+
+
+def command_verify(image, args):
+    from porigonz.nds.verify import Throughput, verify_files
+
+    parser = OptionParser()
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None)
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False)
+    options, filenames = parser.parse_args(args)
+
+    throughput = Throughput()
+    failed = False
+    for filename, checks, checked in verify_files([image.filename] + filenames, workers=options.jobs):
+        if checks is None:
+            print("%s: ERROR %s" % (filename, checked))
+            failed = True
+            continue
+
+        throughput.add(filename, checked)
+        bad = [check for check in checks if not check.ok]
+        failed = failed or bool(bad)
+        if options.quiet and not bad:
+            continue
+
+        print("%s: %s" % (filename, 'BAD' if bad else 'OK'))
+        for check in checks:
+            if check.status == 'skipped':
+                print("    %-12s skipped" % check.name)
+            else:
+                print("    %-12s %-4s expected 0x%04x, found 0x%04x" % (
+                    check.name, check.status, check.expected, check.actual))
+
+    stderr.write("%s\n" % throughput)
+    if failed:
+        exit(1)
+
+
+def command_serve(image, args):
+    from porigonz.nds.serve import serve
+
+    parser = OptionParser()
+    parser.add_option('-p', '--port', dest='port', type='int', default=8000)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None)
+    parser.add_option('--cache-size', dest='cache_size', type='float', default=64)
+    add_encoder_options(parser)
+    options, filenames = parser.parse_args(args)
+
+    images = [image] + [DSImage(filename) for filename in filenames]
+    encoder_options = dict(
+        format=options.image_format,
+        compress_level=options.compress_level,
+        optimize=options.optimize,
+    )
+
+    stderr.write("Serving on http://127.0.0.1:%d/\n" % options.port)
+    serve(images, port=options.port, workers=options.jobs,
+          encoder_options=encoder_options,
+          cache_size=int(options.cache_size * 1024 * 1024))
+
+
+def command_hash(image, args):
+    from porigonz.nds.hashes import ContentHashes
+
+    parser = OptionParser()
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None)
+    parser.add_option('--rebuild', dest='rebuild', action='store_true', default=False)
+    parser.add_option('--cache-dir', dest='cache_dir', default=None)
+    parser.add_option('--members', dest='members', action='store_true', default=False)
+    parser.add_option('--duplicates', dest='duplicates', action='store_true', default=False)
+    options, _ = parser.parse_args(args)
+
+    hashes = ContentHashes.for_image(image, cache_dir=options.cache_dir,
+                                     rebuild=options.rebuild, workers=options.jobs)
+
+    def name(path, member):
+        if member is None:
+            return path
+        return "%s/%d" % (path, member)
+
+    if options.duplicates:
+        for n, group in enumerate(hashes.duplicates(members=options.members)):
+            if n:
+                print()
+            for path, member in group:
+                print(name(path, member))
+        return
+
+    for digest, path, member in hashes:
+        if member is not None and not options.members:
+            continue
+        print("%s  %s" % (digest, name(path, member)))
+
+
+def command_replace(image, args):
+    parser = OptionParser()
+    parser.add_option('-o', '--output', dest='output', default=None)
+    options, pairs = parser.parse_args(args)
+
+    if not pairs or len(pairs) % 2:
+        stderr.write("Need pairs of DS filenames and source files.\n")
+        return
+
+    for dsfilename, source in zip(pairs[0::2], pairs[1::2]):
+        member = None
+        match = re.match(r'^(.*):(\d+)$', dsfilename)
+        if match:
+            dsfilename, member = match.group(1), int(match.group(2))
+
+        # XXX factor this out; do wildcards and ids
+        matches = [dsfile for dsfile in image.dsfiles if dsfile.path == dsfilename]
+        if not matches:
+            stderr.write("No such file: %s\n" % dsfilename)
+            return
+        dsfile = matches[0]
+
+        f = open(source, 'rb')
+        data = f.read()
+        f.close()
+
+        if member is None:
+            dsfile.replace(data)
+        else:
+            dsfile.replace_member(member, data)
+
+    image.save(options.output)
+
+
+def remove_existing(path):
+    """Deletes `path` if it exists, so that writing or linking a new file
+    there can't write through a hardlink left by an earlier extract.
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def link_or_copy(source, destination):
+    """Hardlinks `source` to `destination`, or copies it if the filesystem
+    can't do that.  Anything already at `destination` is replaced.
+    """
+    remove_existing(destination)
+    try:
+        os.link(source, destination)
+    except AttributeError:
+        # No hardlinks on this platform
+        shutil.copyfile(source, destination)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copyfile(source, destination)
 
 
 def command_extract(image, args):
@@ -130,6 +523,8 @@ def command_extract(image, args):
     parser.add_option('-d', '--directory', dest='directory', default=defaultdir)
     parser.add_option('-f', '--format', dest='format', default='raw')
     parser.add_option('-s', '--split-narc', dest='splitnarc', type='choice', choices=['always', 'never', 'auto'], default='auto')
+    parser.add_option('--link-duplicates', dest='link_duplicates', action='store_true', default=False)
+    add_encoder_options(parser)
     options, dsfiles = parser.parse_args(args)
 
     # XXX factor this out; do wildcards and ids
@@ -139,76 +534,131 @@ def command_extract(image, args):
         matches = image.dsfiles
 
     # Output formatting
+    from porigonz.nds import format
     format_name = re.sub('-', '_', options.format)
     formatter = getattr(format, format_name)
+    encoder = encoder_from_options(options)
+
+    # For --link-duplicates: the outputs written for each file already
+    # extracted, and where each distinct output was first written, both keyed
+    # by content
+    extracted = {}
+    written = {}
+
+    def write(fspath, data):
+        if options.link_duplicates:
+            digest = content_hash(data)
+            if digest in written and os.path.exists(written[digest]):
+                link_or_copy(written[digest], fspath)
+                stats.count('files linked')
+                return
+            written[digest] = fspath
+
+        with stats.stage('write'):
+            remove_existing(fspath)
+            fsfile = open(fspath, 'wb')
+            fsfile.write(data)
+            fsfile.close()
+        stats.count('files written')
+        stats.count('bytes written', len(data))
 
     # Extract every file to the requested directory
-    for dsfile in matches:
-        # Narc splitting
-        if options.splitnarc == 'never':
-            split_narc = False
-        elif options.splitnarc == 'always':
-            split_narc = True
-        else:  # auto
-            split_narc = dsfile.is_narc
-
-        dspath = dsfile.path
-        if not dspath:
-            # Construct a default filename
-            dspath = "file%d" % dsfile.id
-
-        print dspath, '...',
-        stdout.flush()
-
-        # dspath is probably absolute, and we need relative parts
-        dspath = dspath.strip('/')
-
-        # Get the chunks we're working with here
-        if split_narc:
-            chunks = dsfile.parse_narc()
-        else:
-            chunks = [ dsfile.contents ]
-
-        # Heart of the matter: apply formatting
-        formatted_chunks = formatter(chunks)
-
-        # Spit it all out as appropriate
-        if split_narc:
-            # Split the file and write the pieces all inside a directory
-            dsdir = dspath
-            fsdir = os.path.join(options.directory, dsdir)
-
-            # Delete the target if it already exists.  This *should* only
-            # delete existing extracted files.  Who would have real files
-            # called poke_msg.narc?
-            if os.path.exists(fsdir):
-                shutil.rmtree(fsdir)
-
-            os.makedirs(fsdir)
-
-            chunks = dsfile.parse_narc()
-            for n, chunk in enumerate(formatted_chunks):
-                dsfilename = unicode(n)
-
+    try:
+        for dsfile in matches:
+            # Narc splitting
+            if options.splitnarc == 'never':
+                split_narc = False
+            elif options.splitnarc == 'always':
+                split_narc = True
+            else:  # auto
+                split_narc = dsfile.is_narc
+
+            dspath = dsfile.path
+            if not dspath:
+                # Construct a default filename
+                dspath = "file%d" % dsfile.id
+
+            print(dspath, '...', end=' ')
+            stdout.flush()
+
+            # dspath is probably absolute, and we need relative parts
+            dspath = dspath.strip('/')
+
+            # An identical file has already been done; just link everything
+            previous = None
+            if options.link_duplicates:
+                previous = extracted.get((dsfile.digest, split_narc))
+            if previous and all(os.path.exists(path) for path in previous):
+                if split_narc:
+                    fsdir = os.path.join(options.directory, dspath)
+                    if os.path.exists(fsdir):
+                        shutil.rmtree(fsdir)
+                    os.makedirs(fsdir)
+                    for path in previous:
+                        link_or_copy(path, os.path.join(fsdir, os.path.basename(path)))
+                else:
+                    fsdir = os.path.join(options.directory, os.path.dirname(dspath))
+                    if not os.path.isdir(fsdir):
+                        os.makedirs(fsdir)
+                    link_or_copy(previous[0], os.path.join(options.directory, dspath))
+                stats.count('files linked', len(previous))
+                dsfile._contents = None
+
+                print('linked')
+                continue
+
+            # Get the chunks we're working with here
+            if split_narc:
+                chunks = dsfile.parse_narc()
+            else:
+                chunks = [ dsfile.contents ]
+
+            # Heart of the matter: apply formatting
+            formatted_chunks = formatter(chunks, encoder=encoder)
+
+            # Spit it all out as appropriate
+            if split_narc:
+                # Split the file and write the pieces all inside a directory
+                dsdir = dspath
+                fsdir = os.path.join(options.directory, dsdir)
+
+                # Delete the target if it already exists.  This *should* only
+                # delete existing extracted files.  Who would have real files
+                # called poke_msg.narc?
+                if os.path.exists(fsdir):
+                    shutil.rmtree(fsdir)
+
+                os.makedirs(fsdir)
+
+                outputs = []
+                for n, chunk in enumerate(formatted_chunks):
+                    dsfilename = text_type(n)
+
+                    fspath = os.path.join(fsdir, dsfilename)
+                    write(fspath, bytes(chunk))
+                    outputs.append(fspath)
+
+                if options.link_duplicates:
+                    extracted[dsfile.digest, split_narc] = outputs
+
+            else:
+                # Write the entire file to a..  file
+                dsdir, dsfilename = os.path.split(dspath)
+                fsdir = os.path.join(options.directory, dsdir)
+
+                if not os.path.isdir(fsdir):
+                    os.makedirs(fsdir)
+
+                # Create the file in the appropriate format
                 fspath = os.path.join(fsdir, dsfilename)
-                fsfile = open(fspath, 'wb')
-                fsfile.write(str( chunk ))
-                fsfile.close()
+                write(fspath, chunks[0])
 
-        else:
-            # Write the entire file to a..  file
-            dsdir, dsfilename = os.path.split(dspath)
-            fsdir = os.path.join(options.directory, dsdir)
-
-            if os.path.exists(fsdir):
-                shutil.rmtree(fsdir)
-
-            os.makedirs(fsdir)
+                if options.link_duplicates:
+                    extracted[dsfile.digest, split_narc] = [fspath]
 
-            # Create the file in the appropriate format
-            fspath = os.path.join(fsdir, dsfilename)
-            fsfile = open(fspath, 'wb')
-            fsfile.write(chunks[0])
-            fsfile.close()
+            # Done with this file; don't keep the whole image in memory
+            dsfile._contents = None
 
-        print 'ok'
+            print('ok')
+    finally:
+        encoder.close()
@@ -0,0 +1,577 @@
+# encoding: utf8
+u"""Rough benchmarks for the slow parts of porigon-z.
+
+Real game images can't be shipped around, so everything here runs on
+synthetic data from `porigonz.synthetic`, built with the same structs used to
+parse it.
+
+Run with:  python -m porigonz.benchmark [-o results.json] [--compare old.json]
+
+Results can be saved as JSON and compared against an earlier run, e.g. from
+another commit.  Rates are per second, so bigger is better.
+
+Each group of benchmarks runs in its own process, so its peak memory use can
+be measured too.  If any group goes over its budget in `memory_budgets` (or
+as given with --budget), the run fails.
+
+The `startup` group times whole runs of the command-line tool, for the simple
+commands that shouldn't have to load PIL and friends; if one takes longer
+than its target in `startup_targets`, or loads any of `heavy_modules`, the
+run fails too.
+"""
+
+from __future__ import print_function
+
+from itertools import cycle
+import json
+from multiprocessing import Pipe, Process
+from optparse import OptionParser
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from construct import Container
+
+from porigonz.compat import native_str, range
+from porigonz.nds import DSImage, stats
+from porigonz.nds.records import layouts
+from porigonz.nds.util import word_iterator
+from porigonz.nds.util.colors import color_table, decode_palette
+from porigonz.nds.util.encoder import ImageEncoder
+from porigonz.nds.util.sprites import (Palette, Sprite, rahc_struct,
+    rgcn_struct, pokemon_decrypt, POKEMON_SPRITE_DP, POKEMON_SPRITE_PLATINUM)
+from porigonz.nds.util.text import pokemon_character_table
+from porigonz.nds.util.texture import NSBTX, Texture, bpp
+from porigonz.nds.util.texture import Palette as TexturePalette
+from porigonz.synthetic import (make_rgcn, make_rlcn, random_bytes,
+    write_pokemon_image)
+
+def timed(func, count):
+    """Calls `func` `count` times and returns the calls per second."""
+    start = time.time()
+    for _ in range(count):
+        func()
+    elapsed = time.time() - start
+    return count / elapsed if elapsed else float('inf')
+
+def decrypt_loop(data, backwards=False):
+    """The original sprite decryption, one word at a time, for comparison and
+    as a known answer.  Platinum seeds from the first word and works forwards;
+    D/P seeds from the last word and works backwards.
+    """
+    words = list(word_iterator(data[:len(data) // 2 * 2], 16))
+    order = list(range(len(words)))
+    if backwards:
+        order.reverse()
+
+    key = words[order[0]]
+    for i in order:
+        words[i] ^= key
+        key = (key * 0x4e6d + 0x6073) & 0xffff
+    return struct.pack('<%dH' % len(words), *words)
+
+def bench_pokemon_sprites(count=200, seed=0):
+    rng = random.Random(seed)
+    chunks = [make_rgcn(random_bytes(rng, 2048)) for _ in range(count)]
+    datas = [rahc_struct.parse(rgcn_struct.parse(chunk).data).data
+             for chunk in chunks]
+
+    # Check against the original first; this also builds the orbit tables up
+    # front, as they're a one-off cost
+    for name, constants, backwards in (
+        ('D/P', POKEMON_SPRITE_DP, True),
+        ('Platinum', POKEMON_SPRITE_PLATINUM, False)):
+        for data in datas[:10]:
+            if pokemon_decrypt(data, constants) != decrypt_loop(data,
+                                                                backwards):
+                raise Exception("pokemon_decrypt (%s) doesn't match the "
+                                "original" % name)
+
+    it = cycle(chunks)
+    yield 'Sprite.from_pokemon', 'sprites', \
+        timed(lambda: Sprite.from_pokemon(next(it)), count)
+
+    for name, constants in (('D/P', POKEMON_SPRITE_DP),
+                            ('Platinum', POKEMON_SPRITE_PLATINUM)):
+        it = cycle(datas)
+        yield 'pokemon_decrypt (%s)' % name, 'sprites', \
+            timed(lambda: pokemon_decrypt(next(it), constants), count)
+
+def bench_sprite_png(count=200, seed=0):
+    rng = random.Random(seed)
+    sprites = [Sprite.from_pokemon(make_rgcn(random_bytes(rng, 2048)))
+               for _ in range(count)]
+    palettes = [Palette(make_rlcn(random_bytes(rng, 32))) for _ in range(2)]
+
+    it = cycle(sprites)
+    yield 'Sprite.png', 'sprites', \
+        timed(lambda: next(it).png(palette=palettes[0]), count)
+
+    # Normal and shiny
+    it = cycle(sprites)
+    yield 'Sprite.pngs (2 palettes)', 'sprites', \
+        timed(lambda: next(it).pngs(palettes), count)
+
+    # Everything at once, spread across threads
+    images = [sprite.image(palettes[0]) for sprite in sprites]
+    with ImageEncoder() as encoder:
+        yield 'ImageEncoder.encode_all (threaded)', 'sprites', \
+            timed(lambda: list(encoder.encode_all(images)), 1) * count
+
+def palette_loop(data):
+    """The old way of decoding a palette, one color at a time."""
+    colors = []
+    for w in word_iterator(data, 16):
+        colors.append((((w & 0x001f)      ) * 255 // 31,
+                       ((w & 0x03e0) >> 5 ) * 255 // 31,
+                       ((w & 0x7c00) >> 10) * 255 // 31))
+    return colors
+
+def bench_palettes(count=2000, seed=0):
+    rng = random.Random(seed)
+    datas = [random_bytes(rng, 512) for _ in range(count)]
+    color_table()
+
+    it = iter(datas)
+    yield 'palette loop (256 colors)', 'palettes', \
+        timed(lambda: palette_loop(next(it)), count)
+
+    # Every palette is new, so none of these hit the cache
+    it = iter(datas)
+    yield 'decode_palette (256 colors)', 'palettes', \
+        timed(lambda: decode_palette(next(it)), count)
+
+    # A few palettes over and over, as the cache only keeps so many
+    it = cycle(datas[:100])
+    yield 'decode_palette (cached)', 'palettes', \
+        timed(lambda: decode_palette(next(it)), count)
+
+    chunks = [make_rlcn(random_bytes(rng, 32)) for _ in range(count)]
+    it = iter(chunks)
+    yield 'Palette', 'palettes', \
+        timed(lambda: Palette(next(it)), count)
+
+def format3_loop(texture):
+    """The original format 3 decoder, one pixel at a time, for comparison."""
+    pixels = [[0] * texture.size.height for _ in range(texture.size.width)]
+    it = word_iterator(texture.data.value, 4)
+    for y in range(texture.size.height):
+        for x in range(texture.size.width):
+            pixels[x][y] = next(it)
+    return pixels
+
+def make_texture(rng, format, width=64, height=64):
+    """Builds a Texture of random data, without bothering with a whole BTX0."""
+    info = Container(format=format, width=width, height=height, color0=True)
+    data = Container(value=random_bytes(rng, width * height * bpp[format] // 8))
+    palette_index = Container(value=random_bytes(rng, width * height // 8))
+    return Texture(info, data, palette_index)
+
+def bench_textures(count=50, seed=0):
+    rng = random.Random(seed)
+    palette_data = random_bytes(rng, 512)
+
+    # Textures of different formats sharing a palette should each get as many
+    # colors as their own format has, the same as with a palette of their own
+    shared = TexturePalette(palette_data)
+    for format in 2, 4:
+        texture = make_texture(rng, format)
+        got = texture.image(shared).convert('RGBA').tobytes()
+        expected = texture.image(TexturePalette(palette_data)) \
+                          .convert('RGBA').tobytes()
+        if got != expected:
+            raise Exception("format %d texture came out wrong with a shared "
+                            "palette" % format)
+
+    textures = [make_texture(rng, 3) for _ in range(count)]
+    it = cycle(textures)
+    yield 'format 3, per-pixel loop', 'textures', \
+        timed(lambda: format3_loop(next(it)), count)
+
+    for format in range(1, 8):
+        textures = [make_texture(rng, format) for _ in range(count)]
+        palette = None
+        if format != 7:
+            palette = TexturePalette(palette_data, format=format)
+
+        # Decoding is cached on the texture, so every round needs a fresh one
+        it = iter(textures)
+        yield 'format %d, Texture.image' % format, 'textures', \
+            timed(lambda: next(it).image(palette), count)
+
+def records_loop(layout, chunks):
+    """Decoding records one at a time and then turning them into columns, for
+    comparison.
+    """
+    record_struct = struct.Struct('<' + layout.body)
+    return list(zip(*[record_struct.unpack(chunk[:layout.size])
+                      for chunk in chunks]))
+
+def bench_records(count=20, seed=0):
+    rng = random.Random(seed)
+    layout = layouts['pokemon-base-stats']
+    # About one NARC's worth of species
+    chunks = [random_bytes(rng, layout.size) for _ in range(500)]
+
+    yield 'records, one at a time', 'NARCs', \
+        timed(lambda: records_loop(layout, chunks), count)
+    yield 'RecordLayout.decode', 'NARCs', \
+        timed(lambda: layout.decode(chunks), count)
+
+def quietly(func, *args):
+    """Calls `func`, throwing away anything it prints."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def list_files(image):
+    """Runs the `list` command, throwing away the output."""
+    from porigonz import command_list
+    quietly(command_list, image, [])
+
+def bench_image(count=20, seed=0):
+    """Everything from opening an image to writing out PNGs, on a whole
+    synthetic image.
+    """
+    fd, filename = tempfile.mkstemp(suffix='.nds')
+    os.close(fd)
+    try:
+        write_pokemon_image(filename, seed=seed)
+
+        yield 'DSImage', 'images', \
+            timed(lambda: DSImage(filename), count)
+
+        image = DSImage(filename)
+        yield 'list (%d files)' % len(image.dsfiles), 'images', \
+            timed(lambda: list_files(image), count)
+
+        dsfiles = dict((dsfile.path, dsfile) for dsfile in image.dsfiles)
+        def parse_narc(dsfile):
+            # Include reading the file, not just splitting it
+            dsfile._contents = None
+            return dsfile.parse_narc()
+
+        msg = dsfiles['/msgdata/msg.narc']
+        yield 'DSFile.parse_narc (%d members)' % len(parse_narc(msg)), \
+            'NARCs', timed(lambda: parse_narc(msg), count)
+
+        table = pokemon_character_table()
+        banks = msg.parse_narc()
+        it = cycle(banks)
+        yield 'pokemon_translate', 'banks', \
+            timed(lambda: table.pokemon_translate(next(it)), len(banks))
+
+        members = dsfiles['/poketool/pokegra/pokegra.narc'].parse_narc()
+        sprite_chunks = [member for member in members
+                         if member[:4] == b'RGCN']
+        it = cycle(sprite_chunks)
+        yield 'Sprite.from_pokemon', 'sprites', \
+            timed(lambda: Sprite.from_pokemon(next(it)), len(sprite_chunks))
+
+        sprites = [Sprite.from_pokemon(chunk) for chunk in sprite_chunks]
+        palette = Palette(members[2])
+        it = cycle(sprites)
+        yield 'Sprite.png', 'sprites', \
+            timed(lambda: next(it).png(palette=palette), len(sprites))
+
+        # Textures cache their pixels, so every round parses afresh
+        btx_chunks = [dsfile.contents for path, dsfile in dsfiles.items()
+                      if path.endswith('.nsbtx')]
+        def texture_pixels(chunk):
+            textures = NSBTX(chunk).blocks[0].textures
+            for texture in textures:
+                texture.pixels
+            return len(textures)
+        per_chunk = texture_pixels(btx_chunks[0])
+        it = cycle(btx_chunks)
+        yield 'Texture.pixels (with parsing)', 'textures', \
+            timed(lambda: texture_pixels(next(it)), len(btx_chunks)) \
+            * per_chunk
+
+        block = NSBTX(btx_chunks[0]).blocks[0]
+        textures = block.textures
+        it = cycle(textures)
+        yield 'Texture.png', 'textures', \
+            timed(lambda: next(it).png(block.palettes[0]), len(textures))
+    finally:
+        os.remove(filename)
+
+def bench_extract(count=3, seed=0):
+    """Extracting every file from a bigger synthetic image, mostly to keep an
+    eye on memory.
+    """
+    from porigonz import command_extract
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'image.nds')
+        write_pokemon_image(filename, seed=seed, scale=4)
+        out = os.path.join(directory, 'out')
+
+        def extract(*args):
+            if os.path.exists(out):
+                shutil.rmtree(out)
+            quietly(command_extract, DSImage(filename), ['-d', out] + list(args))
+
+        yield 'extract', 'images', timed(extract, count)
+        yield 'extract -f pokemon-sprite', 'images', \
+            timed(lambda: extract('-f', 'pokemon-sprite',
+                                  '/poketool/pokegra/pokegra.narc'), count)
+    finally:
+        shutil.rmtree(directory)
+
+# Modules that commands not decoding anything shouldn't need to import
+heavy_modules = ['PIL', 'pkg_resources', 'multiprocessing']
+
+# The longest each startup benchmark may take per run, in seconds
+startup_targets = {
+    'porigon-z list': 0.3,
+    'porigon-z cat -f raw': 0.3,
+}
+
+_loaded_modules_script = """
+import sys
+import porigonz
+sys.argv = ['porigon-z'] + sys.argv[1:]
+try:
+    porigonz.main()
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(name for name in %r if name in sys.modules))
+""" % (heavy_modules,)
+
+def bench_startup(count=10, seed=0):
+    """Whole runs of the command-line tool, startup and all."""
+    directory = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    try:
+        filename = os.path.join(directory, 'image.nds')
+        write_pokemon_image(filename, seed=seed)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [package_dir, env.get('PYTHONPATH')]))
+
+        commands = [
+            ('porigon-z list', ['list']),
+            ('porigon-z cat -f raw',
+             ['cat', '-f', 'raw', '/msgdata/msg.narc']),
+        ]
+        for name, args in commands:
+            def run_command():
+                subprocess.check_call(
+                    [sys.executable, '-m', 'porigonz', filename] + args,
+                    stdout=devnull, env=env)
+            yield name, 'runs', timed(run_command, count)
+
+            process = subprocess.Popen(
+                [sys.executable, '-c', _loaded_modules_script, filename]
+                + args, stdout=devnull, stderr=subprocess.PIPE, env=env)
+            _, loaded = process.communicate()
+            if loaded:
+                raise Exception("%s imported %s" % (name, native_str(loaded)))
+    finally:
+        devnull.close()
+        shutil.rmtree(directory)
+
+benchmarks = [
+    bench_pokemon_sprites,
+    bench_palettes,
+    bench_sprite_png,
+    bench_textures,
+    bench_records,
+    bench_image,
+    bench_extract,
+    bench_startup,
+]
+
+# The most memory each group may use at its peak, in megabytes.  This is the
+# whole process, interpreter and all, so these are only meant to catch
+# something holding on to far more than it should
+memory_budgets = dict(
+    pokemon_sprites=48,
+    palettes=48,
+    sprite_png=64,
+    textures=48,
+    records=32,
+    image=64,
+    extract=96,
+    startup=48,
+)
+
+def git_commit():
+    """Returns the commit the code being benchmarked is from, if it can."""
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = process.communicate()
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+    return native_str(out.strip())
+
+def _run_group(benchmark, group, conn):
+    """Runs one group of benchmarks, in a process of its own, and sends back
+    (results, peak memory, error).
+    """
+    results = []
+    try:
+        for name, unit, rate in benchmark():
+            print("%-40s %12.1f %s/s" % (name, rate, unit))
+            sys.stdout.flush()
+            results.append(dict(group=group, name=name, unit=unit, rate=rate))
+        conn.send((results, stats.peak_memory(), None))
+    except Exception:
+        conn.send((results, stats.peak_memory(), traceback.format_exc()))
+
+def run(names=None):
+    """Runs the benchmarks, printing results as it goes, and returns them as
+    a dict suitable for saving as JSON.
+    """
+    results = []
+    memory = {}
+    errors = {}
+    for benchmark in benchmarks:
+        group = benchmark.__name__[len('bench_'):]
+        if names and group not in names:
+            continue
+
+        parent_conn, child_conn = Pipe(duplex=False)
+        process = Process(target=_run_group,
+                          args=(benchmark, group, child_conn))
+        process.start()
+        # Otherwise recv() can't tell when the group dies without a word,
+        # e.g. when it's killed for running out of memory
+        child_conn.close()
+        try:
+            group_results, peak, error = parent_conn.recv()
+        except EOFError:
+            process.join()
+            group_results, peak = [], None
+            error = "%s died with exit code %s\n" % (group, process.exitcode)
+        else:
+            process.join()
+        parent_conn.close()
+
+        results.extend(group_results)
+        if peak is not None:
+            memory[group] = peak
+            print("%-40s %12.1f MB peak" % ('(%s)' % group, peak / 1048576.0))
+        if error:
+            errors[group] = error
+            sys.stderr.write(error)
+
+    return dict(
+        commit=git_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        results=results,
+        memory=memory,
+        errors=errors,
+    )
+
+def over_budget(results, budgets):
+    """Returns a list of (group, peak MB, budget MB) for every group whose
+    peak memory went over its budget.
+    """
+    over = []
+    for group, peak in sorted(results['memory'].items()):
+        budget = budgets.get(group)
+        peak_mb = peak / 1048576.0
+        if budget is not None and peak_mb > budget:
+            over.append((group, peak_mb, budget))
+    return over
+
+def too_slow(results, targets):
+    """Returns a list of (name, seconds, target) for every startup benchmark
+    slower than its target.
+    """
+    slow = []
+    for result in results['results']:
+        target = targets.get(result['name'])
+        if target is not None and result['group'] == 'startup':
+            seconds = 1 / result['rate']
+            if seconds > target:
+                slow.append((result['name'], seconds, target))
+    return slow
+
+def compare(old, new):
+    """Prints how each result in `new` changed from `old`."""
+    old_rates = dict(((result['group'], result['name']), result['rate'])
+                     for result in old['results'])
+
+    print()
+    print("Compared with %s:" % (old.get('commit') or 'previous run'))
+    for result in new['results']:
+        old_rate = old_rates.get((result['group'], result['name']))
+        if not old_rate:
+            change = 'new'
+        else:
+            change = '%+.1f%%' % ((result['rate'] / old_rate - 1) * 100)
+        print("%-40s %12s" % (result['name'], change))
+
+    old_memory = old.get('memory', {})
+    for group, peak in sorted(new.get('memory', {}).items()):
+        if old_memory.get(group):
+            print("%-40s %+11.1f%%" % ('(%s) peak memory' % group,
+                                        (float(peak) / old_memory[group] - 1) * 100))
+
+def main():
+    parser = OptionParser(usage="%prog [-o FILE] [--compare FILE] [group ...]")
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help="save the results to FILE as JSON")
+    parser.add_option('--compare', dest='compare', default=None,
+                      help="compare the results with those saved in FILE")
+    parser.add_option('--budget', dest='budgets', action='append', default=[],
+                      metavar='GROUP=MB',
+                      help="fail if GROUP's peak memory goes over MB")
+    options, names = parser.parse_args()
+
+    budgets = dict(memory_budgets)
+    for budget in options.budgets:
+        group, _, megabytes = budget.partition('=')
+        budgets[group] = float(megabytes)
+
+    results = run(names)
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        old = json.load(f)
+        f.close()
+        compare(old, results)
+
+    over = over_budget(results, budgets)
+    for group, peak, budget in over:
+        print("%s: peak memory %.1f MB is over its budget of %.1f MB" % (
+            group, peak, budget))
+
+    slow = too_slow(results, startup_targets)
+    for name, seconds, target in slow:
+        print("%s: took %.3fs, over its target of %.3fs" % (
+            name, seconds, target))
+
+    if over or slow or results['errors']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
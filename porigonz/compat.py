@@ -0,0 +1,108 @@
+# encoding: utf8
+"""Papering over the differences between Python 2 and Python 3.
+
+Everything else is written to run on both.  DS data is always bytes: `str` on
+Python 2 and `bytes` on 3.  Looking at part of some data without copying it
+is done with `view`, which gives a `buffer` on Python 2 and a `memoryview` on
+3.  Slicing a `memoryview` doesn't copy either, but slicing a `buffer` does,
+so anything that wants to treat the result as bytes should pass it through
+`tobytes` first.
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    from cStringIO import StringIO as BytesIO
+    import cPickle as pickle
+    from itertools import imap as map, izip as zip
+    range = xrange
+    text_type = unicode
+    string_types = basestring
+    unichr = unichr
+    int2byte = chr
+
+    def native_str(data):
+        """Returns bytes, such as a name read from a file, as a `str`."""
+        return data
+
+    def view(data, offset=0, length=None):
+        if length is None:
+            return buffer(data, offset)
+        return buffer(data, offset, length)
+
+    def tobytes(data):
+        if isinstance(data, array):
+            return data.tostring()
+        return str(data)
+
+    def array_frombytes(words, data):
+        words.fromstring(tobytes(data))
+
+    def int_from_bytes(data):
+        """Returns big-endian bytes as one (possibly huge) integer."""
+        return int(hexlify(data), 16)
+
+    def int_to_bytes(n, length):
+        """The reverse of `int_from_bytes`, giving `length` bytes."""
+        return unhexlify('%0*x' % (length * 2, n))
+
+else:
+    from io import BytesIO
+    import pickle
+    map = map
+    zip = zip
+    range = range
+    text_type = str
+    string_types = str
+    unichr = chr
+
+    def int2byte(n):
+        return bytes((n,))
+
+    def native_str(data):
+        """Returns bytes, such as a name read from a file, as a `str`.  Bytes
+        that aren't UTF-8 survive the trip, as with Python 3's filenames.
+        """
+        return bytes(data).decode('utf8', 'surrogateescape')
+
+    def view(data, offset=0, length=None):
+        data = memoryview(data)
+        if length is None:
+            return data[offset:]
+        return data[offset:offset + length]
+
+    def tobytes(data):
+        return bytes(data)
+
+    def array_frombytes(words, data):
+        words.frombytes(data)
+
+    def int_from_bytes(data):
+        """Returns big-endian bytes as one (possibly huge) integer."""
+        return int.from_bytes(data, 'big')
+
+    def int_to_bytes(n, length):
+        """The reverse of `int_from_bytes`, giving `length` bytes."""
+        return n.to_bytes(length, 'big')
+
+def bytes_compatible(cls):
+    """Class decorator that lets `bytes(obj)` work on Python 2 as on 3, by
+    making the class's `__bytes__` its `__str__` too.
+    """
+    if PY2:
+        cls.__str__ = cls.__bytes__
+    return cls
+
+def binary_stream(f):
+    """Returns the binary stream behind the text file `f`, e.g. stdout, for
+    writing bytes to.  On Python 2 that's just `f`.
+    """
+    return getattr(f, 'buffer', f)
+
+def byte_table(values):
+    """Returns a sequence of byte values as bytes, e.g. for `bytes.translate`."""
+    return bytes(bytearray(values))
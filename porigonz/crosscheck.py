@@ -0,0 +1,213 @@
+# encoding: utf8
+u"""Checking that porigon-z gives the same results under two Pythons.
+
+Builds synthetic images with `porigonz.synthetic`, runs every command over
+them with this interpreter and with each one given, and compares what comes
+out: standard output, exit status, extracted files, and rewritten images.
+
+Run with:  python -m porigonz.crosscheck --python python3 [--scale N]
+
+--python can be given more than once.  Include a recent Python 3 (3.12 or
+later) that doesn't come with setuptools, so nothing can come to depend on it
+unnoticed, e.g.:
+
+    python2 -m porigonz.crosscheck --python python3.11 --python python3.13
+
+Different PIL versions compress PNGs differently, so images are compared by
+what they decode to (mode, size, palette, transparency, and pixels) rather
+than byte for byte.  Anything else has to match exactly.
+"""
+
+from __future__ import print_function
+
+import filecmp
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from PIL import Image
+
+from porigonz.synthetic import write_pokemon_image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# (name, arguments); IMAGE and OTHER stand for the two synthetic images, OUT
+# for a directory of the run's own
+commands = [
+    ('list', ['IMAGE', 'list']),
+    ('text-dump', ['IMAGE', 'text-dump', '-j', '2']),
+    ('cat hex', ['IMAGE', 'cat', '-f', 'hex',
+                 '/poketool/personal/personal.narc']),
+    ('cat pokemon-text', ['IMAGE', 'cat', '-f', 'pokemon-text',
+                          '/msgdata/msg.narc']),
+    ('cat pokemon-sprite', ['IMAGE', 'cat', '-f', 'pokemon-sprite',
+                            '--image-format', 'raw',
+                            '/poketool/pokegra/pokegra.narc']),
+    ('records csv', ['IMAGE', 'records', '-l', 'pokemon-base-stats',
+                     '/poketool/personal/personal.narc']),
+    ('records jsonl', ['IMAGE', 'records', '-l', 'pokemon-moves',
+                       '-o', 'jsonl', '/poketool/waza/waza_tbl.narc']),
+    ('records columnar', ['IMAGE', 'records', '--fields', 'a:B,b:h,2x,c:I',
+                          '-o', 'columnar',
+                          '/poketool/personal/personal.narc']),
+    ('hash', ['IMAGE', 'hash', '--members', '--cache-dir', 'OUT/cache']),
+    ('hash --duplicates', ['IMAGE', 'hash', '--members', '--duplicates',
+                           '--cache-dir', 'OUT/cache']),
+    ('search', ['IMAGE', 'search', '-i', '--cache-dir', 'OUT/cache', 'ab']),
+    ('diff', ['IMAGE', 'diff', 'OTHER']),
+    ('diff --depth file', ['IMAGE', 'diff', '--depth', 'file', 'OTHER']),
+    ('verify', ['IMAGE', 'verify']),
+    ('verify -q', ['IMAGE', 'verify', '-q', 'OTHER']),
+    ('extract', ['IMAGE', 'extract', '-d', 'OUT/raw']),
+    ('extract pokemon-sprite', ['IMAGE', 'extract', '-d', 'OUT/sprites',
+                                '-f', 'pokemon-sprite', '--link-duplicates',
+                                '/poketool/pokegra/pokegra.narc']),
+    ('extract texture', ['IMAGE', 'extract', '-d', 'OUT/textures',
+                         '-f', 'texture', '/graphic/tex00.nsbtx',
+                         '/graphic/textures.narc']),
+    ('replace', ['OUT/replaced.nds', 'replace',
+                 '/msgdata/msg.narc:3', 'OUT/new.bin',
+                 '/graphic/tex00.nsbtx', 'OTHER']),
+]
+
+def run_commands(python, image, other, out):
+    """Runs every command with the interpreter `python`, leaving everything
+    in the directory `out`.  Returns a dict of command name to (exit status,
+    output).
+    """
+    os.mkdir(out)
+    shutil.copyfile(image, os.path.join(out, 'replaced.nds'))
+    f = open(os.path.join(out, 'new.bin'), 'wb')
+    f.write(b'hello there')
+    f.close()
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [package_dir, env.get('PYTHONPATH')]))
+
+    devnull = open(os.devnull, 'w')
+    results = {}
+    try:
+        for name, args in commands:
+            args = [arg.replace('IMAGE', image).replace('OTHER', other)
+                       .replace('OUT', out)
+                    for arg in args]
+            process = subprocess.Popen([python, '-m', 'porigonz'] + args,
+                                       stdout=subprocess.PIPE, stderr=devnull,
+                                       env=env)
+            output, _ = process.communicate()
+            results[name] = process.returncode, output
+    finally:
+        devnull.close()
+
+    shutil.rmtree(os.path.join(out, 'cache'), ignore_errors=True)
+    return results
+
+def _decoded(filename):
+    img = Image.open(filename)
+    return (img.mode, img.size, img.getpalette(),
+            img.info.get('transparency'), img.tobytes())
+
+def same_file(a, b):
+    """Compares two files, decoding them first if they're both PNGs."""
+    if filecmp.cmp(a, b, shallow=False):
+        return True
+
+    for filename in a, b:
+        f = open(filename, 'rb')
+        signature = f.read(len(PNG_SIGNATURE))
+        f.close()
+        if signature != PNG_SIGNATURE:
+            return False
+    return _decoded(a) == _decoded(b)
+
+def compare_trees(a, b):
+    """Yields the relative path of everything that differs between the
+    directories `a` and `b`, or is only in one of them.
+    """
+    seen = set()
+    for top, other in (a, b), (b, a):
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), top)
+                if path in seen:
+                    continue
+                seen.add(path)
+
+                other_path = os.path.join(other, path)
+                if not os.path.exists(other_path):
+                    yield path
+                elif top is a and not same_file(os.path.join(a, path),
+                                                other_path):
+                    yield path
+
+def crosscheck(pythons, scale=1, seed=0):
+    """Runs everything under each of `pythons` and compares the results with
+    this interpreter's.  Returns a list of descriptions of what differed.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        image = os.path.join(directory, 'image.nds')
+        other = os.path.join(directory, 'other.nds')
+        write_pokemon_image(image, seed=seed, scale=scale)
+        write_pokemon_image(other, seed=seed + 1, scale=scale)
+
+        print("Running under %s" % sys.executable)
+        base_out = os.path.join(directory, 'base')
+        base = run_commands(sys.executable, image, other, base_out)
+
+        problems = []
+        # Synthetic images are meant to be valid, so this is no good even if
+        # every interpreter agrees
+        if base['verify'][0] != 0:
+            problems.append("%s: verify fails on a synthetic image"
+                            % sys.executable)
+        for n, python in enumerate(pythons):
+            print("Running under %s" % python)
+            out = os.path.join(directory, 'run%d' % n)
+            results = run_commands(python, image, other, out)
+
+            for name, args in commands:
+                status, output = results[name]
+                base_status, base_output = base[name]
+                if status != base_status:
+                    problems.append("%s: %s exited with %d, not %d" % (
+                        python, name, status, base_status))
+                elif output != base_output:
+                    problems.append("%s: %s printed something else" % (
+                        python, name))
+
+            for path in compare_trees(base_out, out):
+                problems.append("%s: %s differs" % (python, path))
+
+        return problems
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    parser = OptionParser(usage="%prog --python PYTHON [--scale N]")
+    parser.add_option('--python', dest='pythons', action='append', default=[],
+                      metavar='PYTHON',
+                      help="another interpreter to compare with")
+    parser.add_option('--scale', dest='scale', type='int', default=1,
+                      help="how big to make the synthetic images")
+    parser.add_option('--seed', dest='seed', type='int', default=0)
+    options, args = parser.parse_args()
+    if not options.pythons:
+        parser.error("need at least one --python to compare with")
+
+    problems = crosscheck(options.pythons, scale=options.scale,
+                          seed=options.seed)
+    for problem in problems:
+        print(problem)
+
+    if problems:
+        sys.exit(1)
+    print("Everything matches.")
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,22 @@ self-documenting, and I can hardly document all the fields when I don't know
 myself what many of them do.
 """
 
+import hashlib
+import os
 from weakref import ref
 
 from construct import *
 
+from porigonz.compat import native_str, range, string_types, tobytes
+from porigonz.nds.nitro import NitroFile
+from porigonz.nds import parallel, patch, stats
+
 # Useful for much of the below: http://llref.emutalk.net/nds_formats.htm
 
+# How many samples of the image `DSImage.stamp` hashes, and their size
+STAMP_SAMPLES = 64
+STAMP_SAMPLE_SIZE = 4096
+
 # DS uses UTF-16 null-terminated strings for a lot of text
 def UnicodeDSString(name, length, *args, **kwargs):
     kwargs.setdefault('encoding', 'utf-16')
@@ -107,7 +117,7 @@ filename_table_struct = Struct('filename_table',
         ULInt16('directory_count'),
         Pointer(lambda ctx: ctx['offset'], filename_list_struct),
     ),
-    MetaRepeater(
+    Array(
         # -1 is because the count includes the header row
         lambda ctx: ctx['root_directory'].directory_count - 1,
         Struct('directories',
@@ -120,7 +130,7 @@ filename_table_struct = Struct('filename_table',
 )
 
 # http://www.bottledlight.com/ds/index.php/FileFormats/FAT
-fat_struct = GreedyRepeater(
+fat_struct = GreedyRange(
     Struct('fat',
         ULInt32('start'),
         ULInt32('end'),
@@ -143,32 +153,12 @@ banner_struct = Struct('banner',
     UnicodeDSString('title_es', 256),
 )
 
-# http://www.pipian.com/ierukana/hacking/ds_nff.html
-# Nitro is used to clump binary blocks together
-nitro_struct = Struct('nitro',
-    String('magic', 4),
-    ULInt16('bom'),
-    ULInt16('unknown1'),  # always 0x0100?
-    ULInt32('file_size'),
-    ULInt16('unknown2'),
-    ULInt16('num_records'),
-
-    MetaRepeater(
-        lambda ctx: ctx['num_records'],
-        Struct('records',
-            String('magic', 4),
-            ULInt32('length'),
-            # The above fields count against the length, so subtract their size
-            MetaField('data', lambda ctx: ctx['length'] - 8),
-        ),
-    ),
-)
-
 # http://www.pipian.com/ierukana/hacking/ds_narc.html
-# NARC files are an extension of Nitro, used for arrays of small binary blocks
+# NARC files are an extension of Nitro, used for arrays of small binary blocks.
+# These structs are for the contents of the sections, without their headers
 narc_fatb_struct = Struct('fatb',
     ULInt32('num_records'),
-    MetaRepeater(
+    Array(
         lambda ctx: ctx['num_records'],
         Struct('records',
             ULInt32('start'),
@@ -181,16 +171,21 @@ narc_fntb_struct = Struct('fntb',
     ULInt32('unknown2'),
     # There are actually fatb.num_records of these, but that is hard to get
     # with my piecemeal parsing, so we just slurp until we run out of data
-    OptionalGreedyRepeater(
+    OptionalGreedyRange(
         Struct('filenames',
             ULInt8('length'),
             MetaField('filename', lambda ctx: ctx['length']),
         ),
     ),
 )
-# There's also an FIMG block in a NARC file, but alas, we don't do all three
-# blocks at once and this one needs the offsets from the FATB.  Outside code
-# has to parse this.
+# There's also an FIMG block in a NARC file, but it's just the files' data
+# all run together; the FATB says where each one is.
+
+def content_hash(data):
+    """Returns a hex digest identifying `data`.  Used for all content hashes,
+    so they can be compared with each other.
+    """
+    return hashlib.sha1(data).hexdigest()
 
 class DSFile(object):
     """Represents a file inside a Nintendo DS game image.
@@ -203,6 +198,7 @@ class DSFile(object):
         """Laaaazy constructor."""
         self._image = ref(image)
         self._contents = None
+        self._digest = None
         self.id = id
         self.path = path
         self.offset = offset
@@ -213,25 +209,32 @@ class DSFile(object):
         return str(self.__dict__)
 
     def parse_nitro(self):
-        """Parses as a Nitro file.  Returns a Nitro-formatted construct object.
-        """
-        return nitro_struct.parse(self.contents)
+        """Parses as a Nitro file.  Returns a `NitroFile`."""
+        return NitroFile(self.contents)
 
+    @stats.staged('parse NARC')
     def parse_narc(self):
         """Parses as a NARC file.  Returns an array of objects of some sort."""
         # TODO Pokémon doesn't have them, but this ought to return filenames
         nitro = self.parse_nitro()
-        fatb = narc_fatb_struct.parse(nitro.records[0].data)
-        fntb = narc_fntb_struct.parse(nitro.records[1].data)
-        fimg_data = nitro.records[2].data
-
-        fimg = []
-        last_sprite = None
-        for fatb_record in fatb.records:
-            data = fimg_data[fatb_record.start:fatb_record.end]
-            fimg.append(data)
-
-        return fimg
+        fatb = narc_fatb_struct.parse(nitro.contents(b'BTAF'))
+
+        # Slicing the view is the only copy each file gets, and on Python 3,
+        # where members are views too, there isn't even that
+        fimg_data = nitro.contents(b'GMIF')
+        stats.count('NARC members', fatb.num_records)
+        return [fimg_data[fatb_record.start:fatb_record.end]
+                for fatb_record in fatb.records]
+
+    def narc_member_ranges(self):
+        """Returns (offset, length) of every member of this NARC, relative to
+        the start of the file.
+        """
+        nitro = self.parse_nitro()
+        fatb = narc_fatb_struct.parse(nitro.contents(b'BTAF'))
+        start = nitro.find(b'GMIF').offset + 8
+        return [(start + fatb_record.start, fatb_record.end - fatb_record.start)
+                for fatb_record in fatb.records]
 
     @property
     def image(self):
@@ -240,19 +243,49 @@ class DSFile(object):
 
     @property
     def contents(self):
-        """Lazy-loads the actual contents of the file."""
+        """Lazy-loads the actual contents of the file.  If the file has been
+        replaced, returns the replacement.
+        """
+        replacement = self.image._replacements.get(self.id)
+        if replacement is not None:
+            return replacement
+
         if self._contents == None:
-            self.image._file.seek(self.offset)
-            self._contents = self.image._file.read(self.length)
+            with stats.stage('read'):
+                self.image._file.seek(self.offset)
+                self._contents = self.image._file.read(self.length)
+            stats.count('files read')
+            stats.count('bytes read', self.length)
 
         return self._contents
 
+    def replace(self, data):
+        """Replaces the contents of this file.  Nothing is written until the
+        image is saved with `DSImage.save`.
+        """
+        self.image._replacements[self.id] = tobytes(data)
+        self._digest = None
+
+    def replace_member(self, member, data):
+        """Replaces the contents of one member of this NARC.  As with
+        `replace`, nothing is written until the image is saved.
+        """
+        self.replace(patch.replace_narc_member(self.contents, member, data))
+
+    @property
+    def digest(self):
+        """A hash of the contents of this file, from `content_hash`."""
+        if self._digest is None:
+            self._digest = content_hash(self.contents)
+
+        return self._digest
+
     @property
     def is_narc(self):
         """Returns True iff this file appears to be a NARC file."""
         try:
             nitro = self.parse_nitro()
-            return nitro.magic == 'NARC'
+            return nitro.magic == b'NARC'
         except:
             return False
 
@@ -260,11 +293,14 @@ class DSFile(object):
 class DSImage(object):
     """Represents a Nintendo DS game image."""
 
+    @stats.staged('open image')
     def __init__(self, filename):
         """Loads the named file, parsing out some useful header information."""
         self.filename = filename
+        self._fingerprint = None
+        self._replacements = {}
 
-        self._file = file(filename, 'rb')
+        self._file = open(filename, 'rb')
 
         ### Load header
         self._file.seek(0)
@@ -319,11 +355,11 @@ class DSImage(object):
             file_id = dir.top_file_id
 
             for filename in dir.filenames:
-                if filename.filename == '':
+                if not filename.filename:
                     # Dummy end entry; skip
                     continue
 
-                filename.path = dir_path + '/' + filename.filename
+                filename.path = dir_path + '/' + native_str(filename.filename)
                 if filename.metadata.is_directory:
                     seen_dirs[filename.directory_id & 0xfff] = filename.path
                 else:
@@ -336,6 +372,92 @@ class DSImage(object):
 
         return
 
+    def save(self, filename=None):
+        """Writes every replaced file back into the image.
+
+        Files that still fit where they were are written there, and the rest
+        are moved to the end; see `porigonz.nds.patch`.  If `filename` is
+        given, the changed image is written there instead, leaving the
+        original alone, and this object refers to the new file from then on.
+        """
+        patches, layout = patch.plan_patches(self, self._replacements)
+
+        if filename is None or \
+            os.path.abspath(filename) == os.path.abspath(self.filename):
+            patch.apply_patches(self.filename, patches)
+        else:
+            patch.stream_patches(self._file, filename, patches)
+            self.filename = filename
+
+        # Start afresh with the new file
+        self._file.close()
+        self._file = open(self.filename, 'rb')
+        self._header = nds_image_struct.parse_stream(self._file)
+        self._fingerprint = None
+
+        for file_id, (offset, length) in layout.items():
+            dsfile = self._dsfiles[file_id]
+            dsfile.offset = offset
+            dsfile.length = length
+            dsfile._contents = None
+            dsfile._digest = None
+        self._replacements = {}
+
+    def parallel_map(self, fn, selection=None, workers=None):
+        """Calls `fn` on the contents of every file in `selection`, across a
+        pool of `workers` processes, and yields the results in order.
+
+        `selection` is a list (or any iterable) of files, as `DSFile`s, ids,
+        or paths; a (file, member) pair stands for one member of a NARC.  The
+        default is every file.  `fn` has to be a function at the top level of
+        some module, and if it raises, so does this, with a
+        `ParallelMapError` saying which file it was.
+
+        Nothing but offsets and lengths is sent to the workers, which each
+        map the image themselves; see `porigonz.nds.parallel.map_ranges`.
+        Only as many files as the workers can keep up with are read ahead.
+        """
+        if self._replacements:
+            raise ValueError("Save the image before mapping over it")
+
+        if selection is None:
+            selection = self.dsfiles
+        return parallel.map_ranges(self.filename, fn,
+                                   self._descriptors(selection), workers)
+
+    def _descriptors(self, selection):
+        """Yields (offset, length, (path, id, member)) for everything in
+        `selection`, for `parallel_map`.
+        """
+        paths = None
+        last_narc = None
+        for item in selection:
+            member = None
+            if isinstance(item, tuple):
+                item, member = item
+
+            if isinstance(item, DSFile):
+                dsfile = item
+            elif isinstance(item, string_types):
+                if paths is None:
+                    paths = dict((dsfile.path, dsfile)
+                                 for dsfile in self.dsfiles)
+                dsfile = paths[item]
+            else:
+                dsfile = self.dsfiles[item]
+
+            where = dsfile.path, dsfile.id, member
+            if member is None:
+                yield dsfile.offset, dsfile.length, where
+                continue
+
+            # Members of the same NARC tend to come together
+            if last_narc is None or last_narc[0] is not dsfile:
+                last_narc = dsfile, dsfile.narc_member_ranges()
+                dsfile._contents = None
+            offset, length = last_narc[1][member]
+            yield dsfile.offset + offset, length, where
+
     @property
     def header(self):
         """A struct of the standard DS header."""
@@ -347,6 +469,42 @@ class DSImage(object):
         game's icon and titles in various languages."""
         return self._banner
 
+    @property
+    def fingerprint(self):
+        """A hex digest identifying this particular image.
+
+        Only the header, FAT, and filename table are hashed, so this is cheap,
+        but any change that moves or resizes a file will change it.  (The
+        header contains a CRC of itself, too.)
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for offset, length in (
+                (0, nds_image_struct.sizeof()),
+                (self.header.fat_offset, self.header.fat_length),
+                (self.header.file_table_offset, self.header.file_table_length),
+            ):
+                self._file.seek(offset)
+                digest.update(self._file.read(length))
+
+            self._fingerprint = digest.hexdigest()
+
+        return self._fingerprint
+
+    def stamp(self):
+        """Returns something that changes whenever the image file does, even
+        if the fingerprint doesn't: its size and modification time, and a hash
+        of small samples spread throughout it, for edits that keep both.  Not
+        remembered, since the file can change underneath.
+        """
+        st = os.fstat(self._file.fileno())
+        step = max(st.st_size // STAMP_SAMPLES, STAMP_SAMPLE_SIZE)
+        digest = hashlib.sha1()
+        for offset in range(0, st.st_size, step):
+            self._file.seek(offset)
+            digest.update(self._file.read(STAMP_SAMPLE_SIZE))
+        return st.st_size, st.st_mtime, digest.hexdigest()
+
     @property
     def dsfiles(self):
         """An array of files contained within the game image.
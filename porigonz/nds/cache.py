@@ -0,0 +1,102 @@
+# encoding: utf8
+"""Saving expensive per-image data, like search indices, between runs.
+
+Anything derived from a whole image is keyed by `DSImage.fingerprint`, so it
+only ever has to be worked out once per image.  The fingerprint doesn't cover
+file contents, so each saved index also remembers the image's
+`DSImage.stamp`, and is rebuilt if that's changed, e.g. by an edit in place.
+"""
+
+import os
+
+from porigonz.compat import PY2, pickle
+from porigonz.nds import stats
+
+def default_cache_dir():
+    """Returns the directory cached data is stored in by default."""
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'porigon-z')
+
+
+class CachedIndex(object):
+    """Base class for something built from a whole image and cached on disk.
+
+    Subclasses take the image's fingerprint as their only constructor
+    argument, implement a `build(image, workers)` classmethod, and set
+    `extension` and `version`.  Bump `version` whenever the saved format
+    changes, to invalidate old files.  Python 3 can't share Python 2's
+    pickles, so it keeps its own files.
+    """
+
+    extension = None
+    version = None
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index previously written with `save`."""
+        f = open(path, 'rb')
+        try:
+            version, state = pickle.load(f)
+        finally:
+            f.close()
+
+        if version != cls.version:
+            raise ValueError("Index was built by a different version")
+
+        self = cls(state['fingerprint'])
+        self.__dict__.update(state)
+        return self
+
+    def save(self, path):
+        """Writes the index to `path`, atomically."""
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            pickle.dump((self.version, self.__dict__), f,
+                        pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def for_image(cls, image, cache_dir=None, rebuild=False, workers=None):
+        """Returns the index for `image`, loading it from `cache_dir` if it's
+        been built before, and building and saving it otherwise.
+
+        An image with unsaved replacements doesn't match its file, so its
+        index is built afresh and not saved.
+        """
+        if image._replacements:
+            stats.count('index cache misses')
+            with stats.stage('build index'):
+                return cls.build(image, workers=workers)
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        path = os.path.join(cache_dir, image.fingerprint + cls.extension)
+        if not PY2:
+            path += '3'
+
+        stamp = image.stamp()
+        if not rebuild and os.path.exists(path):
+            try:
+                self = cls.load(path)
+                if getattr(self, 'stamp', None) == stamp:
+                    stats.count('index cache hits')
+                    return self
+            except Exception:
+                # Broken; just build it again
+                pass
+
+        stats.count('index cache misses')
+        with stats.stage('build index'):
+            self = cls.build(image, workers=workers)
+        self.stamp = stamp
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.save(path)
+
+        return self
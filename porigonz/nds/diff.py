@@ -0,0 +1,139 @@
+# encoding: utf8
+u"""Finding what changed between two DS images.
+
+Files are matched up by path.  Only files that exist in both images are read,
+one pair at a time in the order they appear in the old image, and a pair of
+files the same length is compared directly rather than hashed.  Changed NARCs
+are compared member by member, and changed Pokémon text banks string by
+string, so the result says exactly what changed rather than just which file.
+"""
+
+from collections import OrderedDict, namedtuple
+import json
+
+from porigonz.compat import range
+from porigonz.nds.util.text import is_pokemon_text, pokemon_character_table
+
+# How far down to look for changes
+DEPTHS = ['file', 'member', 'text']
+
+class Change(namedtuple('Change', 'kind path member index old new')):
+    """A single difference between two images.
+
+    `kind` is 'added', 'removed', or 'changed'.  `member` and `index` are the
+    NARC member and text string the change is in, or None if the change is to
+    a whole file or member.  For changed strings, `old` and `new` are the
+    text; otherwise they're the lengths of the data.
+    """
+
+    def as_dict(self):
+        """Returns the change as an ordered dict, leaving out empty fields."""
+        return OrderedDict((key, value)
+                           for key, value in zip(self._fields, self)
+                           if value is not None)
+
+
+def _path(dsfile):
+    return dsfile.path or "file%d" % dsfile.id
+
+def _narc_members(dsfile):
+    """Returns the members of `dsfile`, or None if it's not a NARC."""
+    if not dsfile.is_narc:
+        return None
+    try:
+        return dsfile.parse_narc()
+    except Exception:
+        return None
+
+def diff_images(old, new, depth='text'):
+    """Yields a `Change` for every difference between the images `old` and
+    `new`.
+
+    `depth` is one of `DEPTHS`: 'file' only says which files changed,
+    'member' also compares NARCs member by member, and 'text' also compares
+    Pokémon text banks string by string.
+    """
+    if depth not in DEPTHS:
+        raise ValueError("Unknown depth %r" % (depth,))
+
+    new_files = dict((_path(dsfile), dsfile) for dsfile in new.dsfiles)
+    old_paths = set()
+
+    for old_file in sorted(old.dsfiles, key=lambda dsfile: dsfile.offset):
+        path = _path(old_file)
+        old_paths.add(path)
+
+        new_file = new_files.get(path)
+        if new_file is None:
+            yield Change('removed', path, None, None, old_file.length, None)
+            continue
+
+        try:
+            for change in _diff_files(path, old_file, new_file, depth):
+                yield change
+        finally:
+            # Both images would otherwise keep every file in memory
+            old_file._contents = None
+            new_file._contents = None
+
+    for new_file in new.dsfiles:
+        path = _path(new_file)
+        if path not in old_paths:
+            yield Change('added', path, None, None, None, new_file.length)
+
+def _diff_files(path, old_file, new_file, depth):
+    # Different lengths are obviously different, and otherwise the contents
+    # have to be read anyway, so comparing them is cheaper than hashing
+    if (old_file.length == new_file.length
+        and old_file.contents == new_file.contents):
+        return
+
+    yield Change('changed', path, None, None, old_file.length, new_file.length)
+    if depth == 'file':
+        return
+
+    old_members = _narc_members(old_file)
+    new_members = _narc_members(new_file)
+    if old_members is None or new_members is None:
+        return
+
+    for member in range(max(len(old_members), len(new_members))):
+        if member >= len(new_members):
+            yield Change('removed', path, member, None,
+                         len(old_members[member]), None)
+        elif member >= len(old_members):
+            yield Change('added', path, member, None,
+                         None, len(new_members[member]))
+        elif old_members[member] != new_members[member]:
+            old_chunk = old_members[member]
+            new_chunk = new_members[member]
+            yield Change('changed', path, member, None,
+                         len(old_chunk), len(new_chunk))
+
+            if (depth == 'text' and is_pokemon_text(old_chunk)
+                and is_pokemon_text(new_chunk)):
+                for change in _diff_text(path, member, old_chunk, new_chunk):
+                    yield change
+
+def _diff_text(path, member, old_chunk, new_chunk):
+    tbl = pokemon_character_table()
+    old_bank = tbl.pokemon_text_bank(old_chunk)
+    new_bank = tbl.pokemon_text_bank(new_chunk)
+
+    for index in range(max(len(old_bank), len(new_bank))):
+        if index >= len(new_bank):
+            yield Change('removed', path, member, index, old_bank[index], None)
+        elif index >= len(old_bank):
+            yield Change('added', path, member, index, None, new_bank[index])
+        elif old_bank.encrypted(index) != new_bank.encrypted(index):
+            # Banks decrypt lazily, so only strings that changed are ever
+            # decrypted
+            yield Change('changed', path, member, index,
+                         old_bank[index], new_bank[index])
+
+def dump_json_lines(changes, out):
+    """Writes `changes` to the file `out` as JSON Lines, one object each."""
+    for change in changes:
+        out.write(json.dumps(change.as_dict(), ensure_ascii=False)
+                  .encode('utf8'))
+        out.write(b'\n')
@@ -7,18 +7,20 @@ from a NARC; it may be a single file pulled from a NARC; it may be an
 assortment of several DS files.  Or you may have created it yourself.  It's all
 good.
 
-Other arguments are cheerfully ignored.
+Other arguments are cheerfully ignored, except that functions producing images
+accept an `encoder` keyword argument: an `ImageEncoder` controlling the output
+format and compression, and how many threads do the encoding.
 
 Functions may return either an iterator or a list.  If you absolutely need a
 list, always use `list()` on the return value.
+
+The decoders (and PIL) are only imported by the functions that use them, so
+that `raw` and `hex` don't pay for them.
 """
 
 import binascii
-import pkg_resources
 
-from porigonz.nds.util.sprites import Sprite, Palette
-from porigonz.nds.util.text import CharacterTable
-from porigonz.nds.util.texture import NSBTX
+from porigonz.nds.util.encoder import default_encoder
 
 
 def raw(chunks, *args, **kwargs):
@@ -35,14 +37,15 @@ def sprite(chunks, *args, **kwargs):
 def sprite_part(chunks, *args, **kwargs):
     """Decrypt the chunks, detecting them as either palettes or regular sprites.
     """
+    from porigonz.nds.util.sprites import Sprite, Palette
 
     def generator(chunks):
         for chunk in chunks:
             if len(chunk) < 4:
                 yield None
-            elif chunk[0:4] == 'RLCN':
+            elif chunk[0:4] == b'RLCN':
                 yield Palette(chunk)
-            elif chunk[0:4] == 'RGCN':
+            elif chunk[0:4] == b'RGCN':
                 try:
                     yield Sprite.from_standard(chunk)
                 except:
@@ -54,22 +57,29 @@ def sprite_part(chunks, *args, **kwargs):
 
 
 
-def texture(chunks, *args, **kwargs):
+def texture(chunks, encoder=default_encoder, *args, **kwargs):
     """textures"""
-    for tex in texture_part(chunks):
-        for palette in tex.palettes:
-            for texture in tex.textures:
-                yield texture.png(palette)
+    def generator(chunks):
+        for tex in texture_part(chunks):
+            # Each texture's pixels are only decoded once; after that, each
+            # palette only costs a palette swap and the PNG encoding
+            for palette in tex.palettes:
+                for texture in tex.textures:
+                    yield texture.image(palette)
+
+    return encoder.encode_all(generator(chunks))
+
+def texture_part(chunks, *args, **kwargs):
+    from porigonz.nds.util.texture import NSBTX
 
-def texture_part(chunks):
     for chunk in chunks:
-        if chunk[:4] == 'BTX0':
+        if chunk[:4] == b'BTX0':
             btx = NSBTX(chunk)
             # i've never seen a btx0 chunk with more than one block,
             # but that's not going to stop me!
             for tex in btx.blocks:
                 yield tex
-        elif chunk[:4] == 'BMD0':
+        elif chunk[:4] == b'BMD0':
             # this might have a texture we can use, but
             # i don't know how to deal with them yet
             pass
@@ -92,14 +102,14 @@ def pokemon_text(chunks, *args, **kwargs):
     and may change in the future, but to my knowledge the Pokémon games do not
     include any literal newlines in their text blocks; they are all "\\n".
     """
-    # LoadingNOW is awesome.
-    stream = pkg_resources.resource_stream('porigonz', 'data/pokemon.tbl')
-    tbl = CharacterTable.from_stream(stream)
+    from porigonz.nds.util.text import pokemon_character_table
+
+    tbl = pokemon_character_table()
 
     return (u"\n".join(tbl.pokemon_translate(chunk)).encode("utf-8")
             for chunk in chunks)
 
-def pokemon_sprite(chunks, *args, **kwargs):
+def pokemon_sprite(chunks, encoder=default_encoder, *args, **kwargs):
     """Decrypt the chunks with Pokémon sprite encryption.
 
     For every sequence of (sprite, sprite, ..., palette, palette, ...), this
@@ -107,8 +117,9 @@ def pokemon_sprite(chunks, *args, **kwargs):
     work for the main Pokémon and perhaps the trainers—NOT the other_poke
     file.
 
-    Returns a list of PNG data.
+    Returns a list of PNG data (or whatever `encoder` produces).
     """
+    from porigonz.nds.util.sprites import Sprite, Palette
 
     def generator(chunks):
         sprs = []
@@ -130,7 +141,7 @@ def pokemon_sprite(chunks, *args, **kwargs):
                 # This means we have a complete set
                 for sprite in sprs:
                     for palette in pals:
-                        yield sprite.png(palette=palette)
+                        yield sprite.image(palette=palette)
 
                 # Then reset both lists and continue as normal
                 sprs = [part]
@@ -140,9 +151,9 @@ def pokemon_sprite(chunks, *args, **kwargs):
         if sprs and pals:
             for sprite in sprs:
                 for palette in pals:
-                    yield sprite.png(palette=palette)
+                    yield sprite.image(palette=palette)
 
-    return generator(chunks)
+    return encoder.encode_all(generator(chunks))
 
 
 def pokemon_sprite_part(chunks, *args, **kwargs):
@@ -151,27 +162,32 @@ def pokemon_sprite_part(chunks, *args, **kwargs):
     Return value is a list of Sprite and Palette objects corresponding to the
     original chunks.  Unrecognized chunks become None.
     """
+    from porigonz.nds.util.sprites import Sprite, Palette
 
     def generator(chunks):
         for chunk in chunks:
             if len(chunk) < 4:
                 yield None
-            elif chunk[0:4] == 'RLCN':
+            elif chunk[0:4] == b'RLCN':
                 yield Palette(chunk)
-            elif chunk[0:4] == 'RGCN':
+            elif chunk[0:4] == b'RGCN':
                 yield Sprite.from_pokemon(chunk)
             else:
                 yield None
 
     return generator(chunks)
 
-def pokemon_overworld_sprites(chunks, shiny=False, *args, **kwargs):
-    for tex in texture_part(chunks):
-        if getattr(tex, 'name', None) != 'tsure_poke':
-            continue
-            
-        palette = tex.palettes[1 if shiny else 0]
-        yield tex.png(palette)
+def pokemon_overworld_sprites(chunks, shiny=False, encoder=default_encoder,
+                              *args, **kwargs):
+    def generator(chunks):
+        for tex in texture_part(chunks):
+            if getattr(tex, 'name', None) != 'tsure_poke':
+                continue
+
+            palette = tex.palettes[1 if shiny else 0]
+            yield tex.image(palette)
+
+    return encoder.encode_all(generator(chunks))
 
 def pokemon_overworld_sprites_shiny(chunks, *args, **kwargs):
     return pokemon_overworld_sprites(chunks, shiny=True, *args, **kwargs)
@@ -0,0 +1,113 @@
+# encoding: utf8
+u"""Content hashes of every file, and every NARC member, in a DS image.
+
+Games are full of duplicates: the same palette or sprite turns up in several
+NARCs, and sister games share most of their data.  Hashing everything once
+makes those easy to find, within an image or between two of them.
+
+Hashing happens in worker processes, with files handed out in the order they
+appear in the image so the reads stay sequential.  The results are keyed by
+`DSImage.fingerprint` and kept in the cache directory, like search indices.
+"""
+
+from collections import defaultdict
+
+from porigonz.nds import content_hash
+from porigonz.nds.cache import CachedIndex
+from porigonz.nds.parallel import image_pool, worker_image
+
+# Bump this whenever the on-disk format changes, to invalidate old hashes
+HASHES_VERSION = 1
+
+
+class ContentHashes(CachedIndex):
+    """Hashes of every file in an image.
+
+    `files` maps each file id to (digest, member digests), where member
+    digests is a list with one digest per NARC member, or None if the file
+    isn't a NARC.  `paths` maps file ids to paths.
+    """
+
+    extension = '.hashes'
+    version = HASHES_VERSION
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.paths = {}
+        self.files = {}
+
+    def add(self, file_id, path, digest, members=None):
+        """Adds the hashes for one file."""
+        self.paths[file_id] = path
+        self.files[file_id] = digest, members
+
+    def __iter__(self):
+        """Yields (digest, path, member) for every file, and then each of its
+        members, in file id order.  `member` is None for whole files.
+        """
+        for file_id in sorted(self.files):
+            path = self.paths[file_id]
+            digest, members = self.files[file_id]
+            yield digest, path, None
+            for member, member_digest in enumerate(members or ()):
+                yield member_digest, path, member
+
+    def duplicates(self, members=True):
+        """Returns a list of groups of (path, member) with identical contents.
+
+        Only groups of two or more are included.  If `members` is false, only
+        whole files are compared.
+        """
+        groups = defaultdict(list)
+        for digest, path, member in self:
+            if member is not None and not members:
+                continue
+            groups[digest].append((path, member))
+
+        # Whole files sort before their members
+        return sorted((group for group in groups.values() if len(group) > 1),
+                      key=lambda group: [(path, -1 if member is None else member)
+                                         for path, member in group])
+
+    @classmethod
+    def build(cls, image, workers=None):
+        """Hashes every file in `image`, using a pool of `workers` processes.
+        """
+        self = cls(image.fingerprint)
+
+        dsfiles = sorted(image.dsfiles, key=lambda dsfile: dsfile.offset)
+        pool = image_pool(image, workers)
+        try:
+            results = pool.imap(_hash_file,
+                                [dsfile.id for dsfile in dsfiles],
+                                chunksize=16)
+            for dsfile, (digest, members) in zip(dsfiles, results):
+                path = dsfile.path or "file%d" % dsfile.id
+                self.add(dsfile.id, path, digest, members)
+        finally:
+            pool.close()
+            pool.join()
+
+        return self
+
+
+### Worker processes
+
+def _hash_file(file_id):
+    """Returns (digest, member digests or None) for the given file."""
+    dsfile = worker_image().dsfiles[file_id]
+    try:
+        digest = dsfile.digest
+
+        members = None
+        if dsfile.is_narc:
+            try:
+                members = [content_hash(chunk)
+                           for chunk in dsfile.parse_narc()]
+            except Exception:
+                # Looked like a NARC, but isn't one after all
+                pass
+
+        return digest, members
+    finally:
+        dsfile._contents = None
@@ -0,0 +1,112 @@
+# encoding: utf8
+"""Reading Nitro files: the containers most DS data comes in.
+
+A Nitro file is a short header followed by a number of sections, each of which
+starts with its own four-character magic number and length.  NARCs, palettes,
+sprites, textures, and models all look like this.
+
+`NitroFile` only reads those headers up front.  Sections are handed out as
+views of the original data (see `porigonz.compat.view`), so nothing is copied
+until something actually slices into a section.
+"""
+
+from collections import namedtuple
+import struct
+
+from construct import *
+
+from porigonz.compat import range, view
+
+# http://www.pipian.com/ierukana/hacking/ds_nff.html
+nitro_header_struct = Struct('nitro_header',
+    String('magic', 4),
+    ULInt16('bom'),
+    ULInt16('version'),  # always 0x0100?
+    ULInt32('file_size'),
+    ULInt16('header_length'),
+    ULInt16('num_sections'),
+)
+
+# Every section starts like this, and the length includes these eight bytes
+section_header = struct.Struct('<4sI')
+
+# 3D files list the offsets of their sections right after the header, rather
+# than packing them end to end
+offset_table_magics = frozenset([
+    b'BMD0', b'BTX0', b'BCA0', b'BTA0', b'BTP0', b'BMA0', b'BVA0',
+])
+
+Section = namedtuple('Section', 'magic offset length')
+
+class NitroFile(object):
+    """A parsed Nitro file.
+
+    `sections` is a list of `Section`s: the magic number, offset, and length
+    of each section, in the order they appear.  Sections can be fetched
+    either by position or by magic number.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+        header = nitro_header_struct.parse(data)
+        self.magic = header.magic
+        self.bom = header.bom
+        self.version = header.version
+        self.file_size = header.file_size
+        self.header_length = header.header_length
+
+        if self.magic in offset_table_magics:
+            offsets = struct.unpack_from('<%dI' % header.num_sections,
+                                         data, self.header_length)
+        else:
+            offsets = None
+
+        self.sections = []
+        self._by_magic = {}
+        offset = self.header_length
+        for i in range(header.num_sections):
+            if offsets is not None:
+                offset = offsets[i]
+
+            # A truncated file just has fewer sections
+            if offset + section_header.size > len(data):
+                break
+
+            magic, length = section_header.unpack_from(data, offset)
+            self._by_magic.setdefault(magic, len(self.sections))
+            self.sections.append(Section(magic, offset, length))
+
+            offset += length
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __contains__(self, magic):
+        return magic in self._by_magic
+
+    def find(self, key):
+        """Returns the `Section` for `key`, which is either the section's
+        position or its magic number; if several sections share a magic
+        number, the first is used.
+        """
+        if isinstance(key, bytes):
+            try:
+                key = self._by_magic[key]
+            except KeyError:
+                raise KeyError("No %r section" % (key,))
+
+        return self.sections[key]
+
+    def section(self, key):
+        """Returns a view of a whole section, header included.  `key` is as
+        for `find`.
+        """
+        magic, offset, length = self.find(key)
+        return view(self.data, offset, length)
+
+    def contents(self, key):
+        """Returns a view of a section's data, after its header."""
+        magic, offset, length = self.find(key)
+        return view(self.data, offset + section_header.size,
+                    max(length - section_header.size, 0))
@@ -0,0 +1,133 @@
+# encoding: utf8
+"""Helpers for spreading work on a DS image across several processes.
+
+`DSFile`s hold a weak reference to their image, so they can't be sent to
+another process.  Instead, each worker opens its own `DSImage` once (see
+`image_pool`) and is handed file ids to look at.
+
+For running some function over the raw data of lots of files, `map_ranges`
+(behind `DSImage.parallel_map`) goes further: each worker maps the image
+read-only and is only handed offsets and lengths.
+"""
+
+from collections import deque
+from itertools import islice
+import mmap
+import traceback
+
+_worker_image = None
+
+def _init_worker(filename):
+    global _worker_image
+    # Imported here to avoid a circular import
+    from porigonz.nds import DSImage
+    _worker_image = DSImage(filename)
+
+def worker_image():
+    """Returns this worker process's copy of the image."""
+    return _worker_image
+
+def image_pool(image, workers=None):
+    """Returns a process pool in which every worker has its own copy of
+    `image`, available from `worker_image()`.
+    """
+    from multiprocessing import Pool
+    return Pool(workers, _init_worker, (image.filename,))
+
+def ordered_map(pool, func, iterable, window=None):
+    """Like `pool.imap`, but never lets more than `window` tasks be queued or
+    finished-and-waiting at once, so memory stays bounded no matter how long
+    `iterable` is or how slowly the results are consumed.
+
+    `window` defaults to twice the number of workers.
+    """
+    if window is None:
+        window = 2 * len(pool._pool)
+
+    pending = deque()
+    for args in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (args,)))
+
+    while pending:
+        yield pending.popleft().get()
+
+
+class ParallelMapError(Exception):
+    """Raised by `map_ranges` when the function fails on some file.  `path`,
+    `id`, and `member` say which; `member` is None for a whole file.
+    `details` is the original traceback.
+    """
+
+    def __init__(self, path, id, member, details):
+        # Everything goes in args, so this survives being pickled
+        Exception.__init__(self, path, id, member, details)
+        self.path = path
+        self.id = id
+        self.member = member
+        self.details = details
+
+    def __str__(self):
+        where = self.path or "file%d" % self.id
+        if self.member is not None:
+            where = "%s/%d" % (where, self.member)
+        return "%s failed:\n%s" % (where, self.details)
+
+_worker_rom = None
+
+def _init_mapper(filename):
+    global _worker_rom
+    f = open(filename, 'rb')
+    _worker_rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The map keeps the file open by itself
+    f.close()
+
+def _map_batch(task):
+    """Calls `fn` on each range of the image.  Returns (results, error); if
+    `fn` fails, the results are those from before it did.  `task` is (fn,
+    descriptors).
+    """
+    fn, descriptors = task
+    results = []
+    for offset, length, where in descriptors:
+        try:
+            results.append(fn(_worker_rom[offset:offset + length]))
+        except Exception:
+            return results, ParallelMapError(*where + (traceback.format_exc(),))
+    return results, None
+
+def map_ranges(filename, fn, descriptors, workers=None, batch_size=16,
+               window=None):
+    """Calls `fn` on the bytes at each of `descriptors` in the file
+    `filename`, in a pool of `workers` processes, and yields the results in
+    order.
+
+    Each descriptor is (offset, length, (path, id, member)); the last part is
+    only used to say where `fn` failed, with a `ParallelMapError`.  `fn` has
+    to be picklable, so a function at the top level of some module.
+
+    Descriptors go to the workers `batch_size` at a time, and no more than
+    `window` batches are ever in flight, as for `ordered_map`.
+    """
+    from multiprocessing import Pool
+
+    descriptors = iter(descriptors)
+    def batches():
+        while True:
+            batch = list(islice(descriptors, batch_size))
+            if not batch:
+                return
+            yield fn, batch
+
+    pool = Pool(workers, _init_mapper, (filename,))
+    try:
+        for results, error in ordered_map(pool, _map_batch, batches(), window):
+            for result in results:
+                yield result
+            if error is not None:
+                raise error
+    finally:
+        # Anything still running is of no use to anyone
+        pool.terminate()
+        pool.join()
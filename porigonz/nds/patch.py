@@ -0,0 +1,263 @@
+# encoding: utf8
+"""Writing changed files back into a DS image.
+
+Changes are collected with `DSFile.replace` (or `replace_member`, for NARCs)
+and written with `DSImage.save`.  Everything is done as a list of patches, each
+some bytes to write at some offset:
+
+- A file that still fits in the space it had is written where it was.
+- A file that doesn't fit is moved to the end of the image.  Nothing else
+  moves, so nothing else has to be rewritten.
+- The FAT entries of changed files are rewritten.
+- The header gets the new ROM size, card size, and CRC.
+
+Saving over the original image writes just those patches.  Saving to a new
+file copies everything in between the patches in big blocks.  Either way, the
+only work that grows with the size of the image is a plain copy.
+"""
+
+import os
+import struct
+
+from porigonz.compat import tobytes
+from porigonz.nds.nitro import NitroFile
+from porigonz.nds.util import crc16
+
+# Files in a DS image start on 512-byte boundaries, and files in a NARC on
+# 4-byte boundaries
+FILE_ALIGNMENT = 0x200
+NARC_ALIGNMENT = 4
+
+# Where things live in the header
+CARD_SIZE_OFFSET = 0x14
+ROM_LENGTH_OFFSET = 0x80
+HEADER_CRC_OFFSET = 0x15e
+HEADER_CRC_LENGTH = 0x15e
+
+# The smallest banner, which is the only size porigon-z reads
+BANNER_LENGTH = 0x840
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+def align(n, alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+def _capacity(start, ranges, limit):
+    """Returns how many bytes starting at `start` are free, given a list of
+    (start, end) ranges already in use and the end of the whole space.
+    """
+    following = [other_start for other_start, other_end in ranges
+                 if other_start > start and other_end > other_start]
+    return min(following or [limit]) - start
+
+def _changed_span(old, new):
+    """Returns (start, end) of the part of `new` that differs from `old`, or
+    None if they're the same.  Only used to skip rewriting identical bytes.
+    """
+    if old == new:
+        return None
+
+    block = 4096
+    start = 0
+    common = min(len(old), len(new))
+    while start < common and old[start:start + block] == new[start:start + block]:
+        start += block
+    while start < common and old[start] == new[start]:
+        start += 1
+
+    end = len(new)
+    if len(old) == len(new):
+        while end - block > start and old[end - block:end] == new[end - block:end]:
+            end -= block
+        while end > start and old[end - 1] == new[end - 1]:
+            end -= 1
+
+    return start, end
+
+
+### NARCs
+
+def replace_narc_member(data, member, new_data):
+    """Returns a copy of the NARC `data` with one member replaced.
+
+    If the new member fits where the old one was, it's written there;
+    otherwise it goes at the end.  Either way, every other member stays put.
+    """
+    nitro = NitroFile(data)
+    btaf = nitro.find(b'BTAF')
+    gmif = nitro.find(b'GMIF')
+
+    count, = struct.unpack_from('<I', data, btaf.offset + 8)
+    records = list(struct.unpack_from('<%dI' % (count * 2), data,
+                                      btaf.offset + 12))
+    ranges = list(zip(records[0::2], records[1::2]))
+    if not 0 <= member < count:
+        raise IndexError("NARC has no member %d" % member)
+
+    fimg = tobytes(nitro.contents(b'GMIF'))
+    start = records[member * 2]
+    if len(new_data) <= _capacity(start, ranges, len(fimg)):
+        fimg = fimg[:start] + new_data + fimg[start + len(new_data):]
+    else:
+        start = align(len(fimg), NARC_ALIGNMENT)
+        fimg = fimg.ljust(start, b'\xff') + new_data
+    records[member * 2] = start
+    records[member * 2 + 1] = start + len(new_data)
+
+    fatb = struct.pack('<I%dI' % (count * 2), count, *records)
+
+    # Reassemble everything, in the original order
+    sections = []
+    for section in nitro.sections:
+        if section is btaf:
+            body = fatb
+        elif section is gmif:
+            body = fimg
+        else:
+            body = tobytes(nitro.contents(section.magic))
+        sections.append(struct.pack('<4sI', section.magic, len(body) + 8)
+                        + body)
+
+    header = bytearray(data[:nitro.header_length])
+    body = b''.join(sections)
+    struct.pack_into('<I', header, 8, len(header) + len(body))
+    return bytes(header) + body
+
+
+### Images
+
+def _used_ranges(image):
+    """Returns (start, end) for everything in the image that isn't a file in
+    the FAT: the header, binaries, tables, and banner.
+    """
+    header = image.header
+    return [
+        (0, header.header_length or 0x4000),
+        (header.arm9_source, header.arm9_source + header.arm9_binary_length),
+        (header.arm7_source, header.arm7_source + header.arm7_binary_length),
+        (header.file_table_offset,
+         header.file_table_offset + header.file_table_length),
+        (header.fat_offset, header.fat_offset + header.fat_length),
+        (header.arm9_overlay_source,
+         header.arm9_overlay_source + header.arm9_overlay_length),
+        (header.arm7_overlay_source,
+         header.arm7_overlay_source + header.arm7_overlay_length),
+        (header.banner_offset, header.banner_offset + BANNER_LENGTH),
+    ]
+
+def plan_patches(image, replacements):
+    """Works out what has to be written to apply `replacements`, a dict of
+    file id to new contents.
+
+    Returns (patches, layout): `patches` is a sorted list of (offset, data),
+    and `layout` maps each replaced file id to its new (offset, length).
+    """
+    header = image.header
+    dsfiles = image.dsfiles
+    ranges = _used_ranges(image) + [
+        (dsfile.offset, dsfile.offset + dsfile.length) for dsfile in dsfiles]
+    used_end = max([header.rom_length] + [end for start, end in ranges])
+
+    patches = []
+    layout = {}
+    appended = []
+    tail = align(used_end, FILE_ALIGNMENT)
+    for file_id in sorted(replacements):
+        dsfile = dsfiles[file_id]
+        data = replacements[file_id]
+
+        # Empty files are often all at offset 0, or anywhere else; they
+        # don't really have a place of their own
+        if len(data) <= dsfile.length or (
+            dsfile.length
+            and len(data) <= _capacity(dsfile.offset, ranges, used_end)):
+            image._file.seek(dsfile.offset)
+            span = _changed_span(image._file.read(dsfile.length), data)
+            if span:
+                start, end = span
+                patches.append((dsfile.offset + start, data[start:end]))
+            layout[file_id] = dsfile.offset, len(data)
+        else:
+            appended.append(data)
+            layout[file_id] = tail, len(data)
+            tail = align(tail + len(data), FILE_ALIGNMENT)
+
+    # Moved files all go in one block at the end, padded as the DS likes
+    if appended:
+        tail_start = align(used_end, FILE_ALIGNMENT)
+        tail_data = b''.join(data.ljust(align(len(data), FILE_ALIGNMENT), b'\xff')
+                            for data in appended)
+        patches.append((tail_start, tail_data))
+        used_end = tail_start + len(tail_data)
+
+    # FAT entries
+    for file_id, (offset, length) in sorted(layout.items()):
+        dsfile = dsfiles[file_id]
+        if (offset, length) != (dsfile.offset, dsfile.length):
+            patches.append((header.fat_offset + file_id * 8,
+                            struct.pack('<II', offset, offset + length)))
+
+    # Header
+    image._file.seek(0)
+    header_data = bytearray(image._file.read(HEADER_CRC_OFFSET + 2))
+    old_header = bytes(header_data)
+    rom_length = max(header.rom_length, used_end)
+    card_size = header.card_size
+    while (0x20000 << card_size) < rom_length:
+        card_size += 1
+    struct.pack_into('<B', header_data, CARD_SIZE_OFFSET, card_size)
+    struct.pack_into('<I', header_data, ROM_LENGTH_OFFSET, rom_length)
+    struct.pack_into('<H', header_data, HEADER_CRC_OFFSET,
+                     crc16(header_data[:HEADER_CRC_LENGTH]))
+    span = _changed_span(old_header, bytes(header_data))
+    if span:
+        start, end = span
+        patches.append((start, bytes(header_data[start:end])))
+
+    patches.sort()
+    return patches, layout
+
+def apply_patches(filename, patches):
+    """Writes `patches` straight into the file `filename`."""
+    f = open(filename, 'r+b')
+    try:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        for offset, data in patches:
+            if offset > size:
+                # Don't leave a hole of zeroes
+                f.seek(size)
+                f.write(b'\xff' * (offset - size))
+            f.seek(offset)
+            f.write(data)
+            size = max(size, offset + len(data))
+    finally:
+        f.close()
+
+def stream_patches(source, filename, patches):
+    """Writes a copy of the open file `source` to `filename`, with `patches`
+    applied.  Everything between patches is copied in big blocks.
+    """
+    out = open(filename, 'wb')
+    try:
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        pos = 0
+
+        def copy_to(end):
+            source.seek(pos)
+            remaining = min(end, size) - pos
+            while remaining > 0:
+                block = source.read(min(remaining, COPY_BLOCK_SIZE))
+                out.write(block)
+                remaining -= len(block)
+            if end > max(pos, size):
+                out.write(b'\xff' * (end - max(pos, size)))
+
+        for offset, data in patches:
+            copy_to(offset)
+            out.write(data)
+            pos = offset + len(data)
+        copy_to(size)
+    finally:
+        out.close()
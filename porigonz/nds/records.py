@@ -0,0 +1,295 @@
+# encoding: utf8
+u"""Decoding arrays of fixed-size binary records, such as the base stats of
+every Pokémon.
+
+A lot of game data is a NARC where every member is one record of the same
+layout: one member per species, one per move, and so on.  A `RecordLayout`
+describes one record, and decodes a whole NARC's worth of them in one go,
+into a `RecordTable` of columns.  That can then be written out as CSV, JSON
+Lines, or a simple binary columnar file.
+"""
+
+from array import array
+from binascii import hexlify
+from collections import OrderedDict, namedtuple
+import csv
+import json
+import re
+import struct
+import sys
+
+from porigonz.compat import native_str, range
+
+Field = namedtuple('Field', 'name code')
+
+# Plain integer codes map straight onto array typecodes.  (array has no 64-bit
+# types in Python 2, so q and Q columns are plain lists.)
+_array_codes = frozenset('bBhHiIlL')
+_code_re = re.compile(r'^(?:[bBhHiIlLqQ?]|\d+[sx])$')
+
+class RecordLayout(object):
+    """The layout of a single record.
+
+    `fields` is a list of (name, code) pairs, in order.  Codes are `struct`
+    codes for one value each: `B`, `h`, `I`, etc. for integers, `?` for a
+    bool, `16s` for 16 raw bytes, or `2x` for two bytes of padding, which
+    don't become a column.  Everything is little-endian.
+    """
+
+    def __init__(self, fields):
+        self.fields = []
+        for name, code in fields:
+            if not _code_re.match(code):
+                raise ValueError("Bad code %r for field %r" % (code, name))
+            self.fields.append(Field(name, code))
+
+        # Where each column starts within a record
+        self.columns = []
+        self.offsets = []
+        offset = 0
+        for field in self.fields:
+            if not field.code.endswith('x'):
+                self.columns.append(field)
+                self.offsets.append(offset)
+            offset += struct.calcsize('<' + field.code)
+
+        self.body = ''.join(field.code for field in self.fields)
+        self.size = offset
+
+    @classmethod
+    def from_string(cls, spec):
+        """Makes a layout from a string like `hp:B,attack:B,tms:16s,:2x`."""
+        fields = []
+        for part in spec.split(','):
+            name, _, code = part.strip().rpartition(':')
+            fields.append((name, code))
+        return cls(fields)
+
+    def decode(self, chunks):
+        """Decodes a list of chunks, one record each.  Short chunks are padded
+        with zeroes, and anything past the end of a record is ignored.
+        """
+        size = self.size
+        if all(len(chunk) == size for chunk in chunks):
+            # Usual case; no fixing up needed
+            data = b''.join(map(bytes, chunks))
+        else:
+            data = b''.join(bytes(chunk[:size]).ljust(size, b'\x00')
+                            for chunk in chunks)
+        return self._decode(data, len(chunks))
+
+    def decode_packed(self, data):
+        """Decodes records packed end to end in a single block of bytes.  Any
+        partial record at the end is ignored.
+        """
+        count = len(data) // self.size
+        return self._decode(bytes(data[:count * self.size]), count)
+
+    def _decode(self, data, count):
+        columns = OrderedDict()
+        for field, offset in zip(self.columns, self.offsets):
+            columns[field.name] = self._column(data, count, field, offset)
+
+        return RecordTable(self, count, columns)
+
+    def _column(self, data, count, field, offset):
+        """Pulls a single column out of `count` records packed in `data`."""
+        size = self.size
+        width = struct.calcsize('<' + field.code)
+        if field.code.endswith('s'):
+            return [data[i:i + width]
+                    for i in range(offset, count * size, size)]
+
+        # Every record's nth byte of the field is one extended slice away, so
+        # the whole column can be gathered into little-endian values without
+        # touching a single value from Python
+        raw = bytearray(width * count)
+        for i in range(width):
+            raw[i::width] = data[offset + i::size]
+        raw = bytes(raw)
+
+        if field.code in _array_codes and array(field.code).itemsize == width:
+            column = array(field.code, raw)
+            if sys.byteorder != 'little':
+                column.byteswap()
+            return column
+
+        values = struct.unpack('<%d%s' % (count, field.code), raw)
+        if field.code in _array_codes:
+            return array(field.code, values)
+        return list(values)
+
+
+class RecordTable(object):
+    """A decoded array of records, stored as columns.
+
+    `columns` is an ordered dict of field name to column.  Integer columns are
+    `array`s; bools and byte strings are lists.
+    """
+
+    def __init__(self, layout, count, columns):
+        self.layout = layout
+        self.count = count
+        self.columns = columns
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields each record as a tuple of values, in column order."""
+        return iter(zip(*self.columns.values()))
+
+    def _plain_rows(self):
+        """Yields records with byte strings as hex, for text formats."""
+        codes = [field.code for field in self.layout.columns]
+        for row in self:
+            yield [native_str(hexlify(value)) if code.endswith('s') else value
+                   for code, value in zip(codes, row)]
+
+    def write_csv(self, out):
+        """Writes the records as CSV, with a header row."""
+        writer = csv.writer(out)
+        writer.writerow(self.columns.keys())
+        writer.writerows(self._plain_rows())
+
+    def write_json_lines(self, out):
+        """Writes the records as JSON Lines, one object per record."""
+        names = self.columns.keys()
+        for row in self._plain_rows():
+            out.write(json.dumps(OrderedDict(zip(names, row))))
+            out.write('\n')
+
+    def write_columnar(self, out):
+        """Writes the records in a simple binary columnar format.
+
+        After a header describing the columns, each column's values follow one
+        after another, little-endian, so any column can be loaded straight
+        into an array (or `numpy.frombuffer`).  `read_columnar` reads it
+        back.
+        """
+        out.write(COLUMNAR_MAGIC)
+        out.write(struct.pack('<IH', self.count, len(self.columns)))
+        for field in self.layout.columns:
+            for string in field.name, field.code:
+                if not isinstance(string, bytes):
+                    string = string.encode('utf8')
+                out.write(struct.pack('<B', len(string)) + string)
+
+        for field in self.layout.columns:
+            column = self.columns[field.name]
+            if field.code.endswith('s'):
+                out.write(b''.join(column))
+            else:
+                # Not array.tostring(): array's l and L are eight bytes on
+                # some platforms, and struct's are always four
+                out.write(struct.pack('<%d%s' % (self.count, field.code),
+                                      *column))
+
+    writers = {
+        'csv': write_csv,
+        'jsonl': write_json_lines,
+        'columnar': write_columnar,
+    }
+
+    def write(self, out, format):
+        """Writes the records to `out` in one of the formats in `writers`."""
+        try:
+            writer = self.writers[format]
+        except KeyError:
+            raise ValueError("Unknown record format %r" % (format,))
+        writer(self, out)
+
+
+COLUMNAR_MAGIC = b'PZCOLS\x00\x01'
+
+def read_columnar(data):
+    """Reads bytes written by `RecordTable.write_columnar` back into a
+    `RecordTable`.
+    """
+    if not data.startswith(COLUMNAR_MAGIC):
+        raise ValueError("Not a columnar record file")
+
+    pos = len(COLUMNAR_MAGIC)
+    count, column_count = struct.unpack_from('<IH', data, pos)
+    pos += 6
+
+    fields = []
+    for _ in range(column_count):
+        strings = []
+        for _ in range(2):
+            length, = struct.unpack_from('<B', data, pos)
+            strings.append(native_str(data[pos + 1:pos + 1 + length]))
+            pos += 1 + length
+        fields.append(tuple(strings))
+    layout = RecordLayout(fields)
+
+    columns = OrderedDict()
+    for field in layout.columns:
+        if field.code.endswith('s'):
+            width = struct.calcsize(field.code)
+            size = width * count
+            column = [data[i:i + width] for i in range(pos, pos + size, width)]
+        else:
+            fmt = '<%d%s' % (count, field.code)
+            size = struct.calcsize(fmt)
+            column = struct.unpack_from(fmt, data, pos)
+            if field.code in _array_codes:
+                column = array(field.code, column)
+            else:
+                column = list(column)
+        columns[field.name] = column
+        pos += size
+
+    return RecordTable(layout, count, columns)
+
+
+### Known layouts
+
+layouts = {}
+
+# http://projectpokemon.org/wiki/Pokemon_NDS_Structure
+# poketool/personal/personal.narc; one member per species
+layouts['pokemon-base-stats'] = RecordLayout([
+    ('hp', 'B'),
+    ('attack', 'B'),
+    ('defense', 'B'),
+    ('speed', 'B'),
+    ('special_attack', 'B'),
+    ('special_defense', 'B'),
+    ('type1', 'B'),
+    ('type2', 'B'),
+    ('capture_rate', 'B'),
+    ('base_experience', 'B'),
+    ('effort', 'H'),  # two bits per stat, in the order above
+    ('item1', 'H'),
+    ('item2', 'H'),
+    ('gender_rate', 'B'),
+    ('hatch_counter', 'B'),
+    ('base_happiness', 'B'),
+    ('growth_rate', 'B'),
+    ('egg_group1', 'B'),
+    ('egg_group2', 'B'),
+    ('ability1', 'B'),
+    ('ability2', 'B'),
+    ('flee_rate', 'B'),
+    ('color', 'B'),
+    ('', '2x'),
+    ('machines', '16s'),  # one bit per TM/HM
+])
+
+# poketool/waza/waza_tbl.narc; one member per move
+layouts['pokemon-moves'] = RecordLayout([
+    ('effect', 'H'),
+    ('damage_class', 'B'),
+    ('power', 'B'),
+    ('type', 'B'),
+    ('accuracy', 'B'),
+    ('pp', 'B'),
+    ('effect_chance', 'B'),
+    ('target', 'H'),
+    ('priority', 'b'),
+    ('flags', 'B'),
+    ('contest_effect', 'B'),
+    ('contest_type', 'B'),
+    ('', '2x'),
+])
@@ -0,0 +1,102 @@
+# encoding: utf8
+u"""Full-text search over all the Pokémon text in a DS image.
+
+Decrypting every text bank in a game takes a while, so this is done once and
+the results are saved as an inverted index: every trigram of every string
+(lowercased) maps to the strings containing it.  A substring query then only
+has to look at strings containing all of its trigrams.
+
+Indices are keyed by `DSImage.fingerprint` and stored in the cache directory
+(see `porigonz.nds.cache`), so a given image is only ever indexed once.
+"""
+
+from array import array
+
+from porigonz.compat import range
+from porigonz.nds.cache import CachedIndex
+from porigonz.nds.textdump import iter_text
+
+# Bump this whenever the on-disk format changes, to invalidate old indices
+INDEX_VERSION = 1
+
+NGRAM_SIZE = 3
+
+def ngrams(string):
+    """Returns the set of lowercased n-grams in `string`."""
+    string = string.lower()
+    return set(string[i:i + NGRAM_SIZE]
+               for i in range(len(string) - NGRAM_SIZE + 1))
+
+
+class TextIndex(CachedIndex):
+    """An inverted index of every string in a DS image's text banks.
+
+    `locations` is a list of (file id, NARC member, string index) for every
+    indexed string, and `strings` is the corresponding list of text.  Postings
+    refer to strings by their position in these lists.
+    """
+
+    extension = '.textindex'
+    version = INDEX_VERSION
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.paths = {}
+        self.locations = []
+        self.strings = []
+        self.postings = {}
+
+    def add(self, file_id, member, index, string):
+        """Adds a string to the index."""
+        doc_id = len(self.strings)
+        self.locations.append((file_id, member, index))
+        self.strings.append(string)
+
+        for ngram in ngrams(string):
+            posting = self.postings.get(ngram)
+            if posting is None:
+                posting = self.postings[ngram] = array('I')
+            posting.append(doc_id)
+
+    def search(self, query, ignore_case=False):
+        """Yields (path, member, string index, string) for every indexed
+        string containing `query`, in index order.
+        """
+        grams = ngrams(query)
+        if grams:
+            # Intersect the postings, smallest first
+            postings = sorted((self.postings.get(gram, ()) for gram in grams),
+                              key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(posting)
+
+            candidates = sorted(candidates)
+        else:
+            # Too short to have any n-grams; just check everything
+            candidates = range(len(self.strings))
+
+        if ignore_case:
+            query = query.lower()
+
+        for doc_id in candidates:
+            string = self.strings[doc_id]
+            haystack = string.lower() if ignore_case else string
+            if query in haystack:
+                file_id, member, index = self.locations[doc_id]
+                yield self.paths[file_id], member, index, string
+
+    @classmethod
+    def build(cls, image, workers=None):
+        u"""Indexes every text bank in `image`, using a pool of `workers`
+        processes.  Each NARC member that looks like Pokémon text is indexed.
+        """
+        self = cls(image.fingerprint)
+
+        for dsfile, member, index, string in iter_text(image, workers):
+            self.paths[dsfile.id] = dsfile.path or "file%d" % dsfile.id
+            self.add(dsfile.id, member, index, string)
+
+        return self
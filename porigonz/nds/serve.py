@@ -0,0 +1,336 @@
+# encoding: utf8
+u"""Serving the contents of DS images over HTTP, on this machine only.
+
+Opening an image means parsing its whole filename table, so tools that want
+lots of little things out of an image can ask a server that keeps it open
+instead of running porigon-z over and over.  URLs look like:
+
+    /                               JSON list of the images being served
+    /0/                             JSON list of the files in the first image
+    /0/raw/msgdata/msg.narc         the file itself
+    /0/raw/msgdata/msg.narc?member=3
+                                    just one member of a NARC
+    /0/pokemon-sprite/poketool/pokegra/pokegra.narc?member=0&member=2
+                                    members 0 and 2 run through the
+                                    pokemon-sprite format
+
+Any format from `porigonz.nds.format` that produces strings can be used.
+Formats can produce several outputs from one file; `part=N` picks one, and
+the X-Porigonz-Parts header says how many there are.
+
+Each request is handled in its own thread, but decoding happens in a pool of
+worker processes, each with its own copy of the images.  Responses are kept
+in memory, up to a limit, and carry an ETag so clients can cache them too.
+"""
+
+from collections import OrderedDict
+import json
+import signal
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+
+from porigonz.compat import native_str, tobytes
+from porigonz.nds import DSImage, content_hash, stats
+
+# Formats that can be served, and their content types.  None means an image,
+# typed according to the encoder
+content_types = {
+    'raw': 'application/octet-stream',
+    'hex': 'text/plain',
+    'pokemon-text': 'text/plain; charset=utf-8',
+    'pokemon-sprite': None,
+    'texture': None,
+    'pokemon-overworld-sprites': None,
+    'pokemon-overworld-sprites-shiny': None,
+}
+
+image_content_types = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'raw': 'application/octet-stream',
+}
+
+# Only requests for these hosts are answered, so a web page can't get at the
+# server by pointing some other name at 127.0.0.1.  (Clients that send no Host
+# at all aren't browsers.)
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '')
+
+class NotFound(Exception):
+    pass
+
+
+### Worker processes
+
+_worker_images = {}
+_worker_encoder = None
+
+def _init_worker(encoder_options):
+    global _worker_encoder
+    from porigonz.nds.util.encoder import ImageEncoder
+    # ^C is for the server to deal with, or the pool can't be shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The pool is already one process per CPU; don't make threads too
+    _worker_encoder = ImageEncoder(threads=1, **encoder_options)
+
+def _chunks(image, file_id, members):
+    dsfile = image.dsfiles[file_id]
+    if not members:
+        return [dsfile.contents]
+
+    # Negative numbers would be Python's indices from the end: the same
+    # members again, under other names
+    if any(member < 0 for member in members):
+        raise NotFound("No such member")
+
+    narc = dsfile.parse_narc()
+    try:
+        return [narc[member] for member in members]
+    except IndexError:
+        raise NotFound("No such member")
+
+def _render(args):
+    """Formats one file (or some NARC members) in a worker.  Returns a list
+    of bytes.
+    """
+    filename, format_name, file_id, members = args
+    from porigonz.nds import format
+
+    image = _worker_images.get(filename)
+    if image is None:
+        image = _worker_images[filename] = DSImage(filename)
+
+    formatter = getattr(format, format_name.replace('-', '_'))
+    chunks = _chunks(image, file_id, members)
+    parts = [bytes(part) for part in formatter(chunks, encoder=_worker_encoder)]
+    image.dsfiles[file_id]._contents = None
+    return parts
+
+
+### Server
+
+class ResponseCache(object):
+    """Remembers the most recently used responses, up to `max_bytes` of them
+    in total.  Thread-safe.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            parts = self._entries.pop(key, None)
+            if parts is None:
+                stats.count('response cache misses')
+                return None
+            self._entries[key] = parts
+            stats.count('response cache hits')
+            return parts
+
+    def put(self, key, parts):
+        size = sum(len(data) for data, etag in parts)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = parts
+            self.size += size
+            while self.size > self.max_bytes:
+                _, old_parts = self._entries.popitem(last=False)
+                self.size -= sum(len(data) for data, etag in old_parts)
+
+class AssetServer(ThreadingMixIn, HTTPServer):
+    """Serves `images`, a list of `DSImage`s, on 127.0.0.1.
+
+    `encoder_options` are passed to the workers' `ImageEncoder`s;
+    `cache_size` is in bytes.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, images, port=8000, workers=None, encoder_options={},
+                 cache_size=64 * 1024 * 1024):
+        # Started first, so the workers don't inherit the socket
+        from multiprocessing import Pool
+        self.pool = Pool(workers, _init_worker, (encoder_options,))
+
+        HTTPServer.__init__(self, ('127.0.0.1', port), AssetRequestHandler)
+        self.images = images
+        self.image_format = encoder_options.get('format', 'png')
+        self.cache = ResponseCache(cache_size)
+
+        # Images are read by several threads at once, but each has only one
+        # file to seek around in.  The fingerprints are read now for the same
+        # reason
+        self._image_locks = [threading.Lock() for image in images]
+        self.fingerprints = [image.fingerprint for image in images]
+        self._paths = [dict((dsfile.path, dsfile) for dsfile in image.dsfiles
+                            if dsfile.path)
+                       for image in images]
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+
+    def image_listing(self):
+        return [
+            dict(index=n, filename=image.filename,
+                 title=native_str(image.header.title.rstrip(b'\x00')),
+                 game_code=native_str(image.header.id),
+                 fingerprint=self.fingerprints[n])
+            for n, image in enumerate(self.images)
+        ]
+
+    def file_listing(self, n):
+        return [
+            dict(id=dsfile.id, path=dsfile.path, offset=dsfile.offset,
+                 length=dsfile.length)
+            for dsfile in self.images[n].dsfiles
+        ]
+
+    def find_file(self, n, path):
+        try:
+            return self._paths[n][path]
+        except KeyError:
+            raise NotFound("No such file")
+
+    def render(self, n, format_name, path, members):
+        """Returns a list of (data, etag) for every part produced by running
+        the file at `path` (or `members` of it) through the format.
+        """
+        if format_name not in content_types:
+            raise NotFound("No such format")
+        dsfile = self.find_file(n, path)
+        image = self.images[n]
+
+        key = self.fingerprints[n], format_name, dsfile.id, members
+        parts = self.cache.get(key)
+        if parts is not None:
+            return parts
+
+        with stats.stage('render'):
+            if format_name == 'raw':
+                # No decoding to speak of, so not worth sending to a worker
+                with self._image_locks[n]:
+                    datas = [tobytes(data)
+                             for data in _chunks(image, dsfile.id, members)]
+                    dsfile._contents = None
+            else:
+                datas = self.pool.apply_async(
+                    _render,
+                    ((image.filename, format_name, dsfile.id, members),),
+                ).get()
+
+        parts = [(data, '"%s"' % content_hash(data)) for data in datas]
+        self.cache.put(key, parts)
+        return parts
+
+    def content_type(self, format_name):
+        return (content_types[format_name]
+                or image_content_types[self.image_format])
+
+class AssetRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'porigon-z'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        host = self.headers.get('Host', '').rsplit(':', 1)[0]
+        if host not in LOCAL_HOSTS:
+            self.send_error(403, "Only local requests are answered")
+            return
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/', 2)
+        stats.count('requests')
+
+        try:
+            if parts == ['']:
+                self.send_json(self.server.image_listing(), send_body)
+                return
+
+            try:
+                n = int(parts[0])
+                if not 0 <= n < len(self.server.images):
+                    raise IndexError
+                members = tuple(int(member)
+                                for member in query.get('member', []))
+                part = int(query.get('part', ['0'])[0])
+            except (ValueError, IndexError):
+                raise NotFound("No such image")
+
+            if len(parts) == 1:
+                self.send_json(self.server.file_listing(n), send_body)
+                return
+            elif len(parts) == 2:
+                raise NotFound("No file given")
+
+            format_name, path = parts[1], '/' + parts[2]
+            rendered = self.server.render(n, format_name, path, members)
+            if not 0 <= part < len(rendered):
+                raise NotFound("No such part")
+        except NotFound as e:
+            self.send_error(404, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e) or e.__class__.__name__)
+            return
+
+        data, etag = rendered[part]
+        if etag in self.headers.get('If-None-Match', ''):
+            stats.count('responses not modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.server.content_type(format_name))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Porigonz-Parts', str(len(rendered)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def send_json(self, obj, send_body):
+        data = json.dumps(obj, indent=2, sort_keys=True).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+def serve(images, port=8000, workers=None, encoder_options={},
+          cache_size=64 * 1024 * 1024):
+    """Serves `images` until interrupted."""
+    server = AssetServer(images, port=port, workers=workers,
+                         encoder_options=encoder_options,
+                         cache_size=cache_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
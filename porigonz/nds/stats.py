@@ -0,0 +1,319 @@
+# encoding: utf8
+"""Timing and counting what porigon-z spends its time on.
+
+Code that does something expensive wraps it in a named stage, and bumps
+counters for what it got through:
+
+    with stats.stage('read'):
+        data = f.read(length)
+    stats.count('bytes read', len(data))
+
+or, for a whole function, decorates it with `@stats.staged('decrypt')`.
+
+Nothing is recorded until `enable()` is called, and until then a stage is a
+shared object that does nothing and a counter is a single test, so leaving
+all this in costs next to nothing.  Once enabled, every stage records how
+many times it ran, its total time, and its "self" time: the total minus any
+stages nested inside it.  Stages nest separately per thread.
+
+Memory can be tracked too, with `enable(memory=True)`.  Where there's
+tracemalloc, this traces every allocation Python makes: each stage records how
+much more was allocated at the end than at the start, not counting nested
+stages, and the most that was allocated at once while it ran, and the peak is
+the most ever allocated at once.  Tracing slows everything down a good deal,
+and doesn't see memory that C libraries like PIL get for themselves.
+
+Python 2 has no tracemalloc, so there this goes by the process's resident
+size instead, which misses anything allocated in memory that was freed
+earlier: Python rarely gives memory back, so growth is really "new high-water
+mark".  This costs a read of /proc per stage, so it's only available on
+Linux; elsewhere only the overall peak is known.
+
+Stages running in other threads at the same time get mixed up in each
+other's memory, and only this process is counted; work done in a process pool
+isn't.
+"""
+
+from collections import defaultdict
+from functools import wraps
+import json
+import os
+import sys
+import threading
+from timeit import default_timer as clock
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+enabled = False
+track_memory = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_calls = defaultdict(int)
+_totals = defaultdict(float)
+_self_totals = defaultdict(float)
+_counters = defaultdict(int)
+_memory_growth = defaultdict(int)
+_memory_highs = defaultdict(int)
+_start = None
+
+# Whether memory is being traced with tracemalloc, whether it was started
+# here, and the most traced at once before the last time the peak was reset
+_tracing = False
+_started_tracing = False
+_traced_peak = 0
+
+def enable(memory=False):
+    """Starts recording, throwing away anything recorded before.  If `memory`
+    is true, also tracks memory use per stage, where possible.
+    """
+    global enabled, track_memory, _start, _tracing, _started_tracing
+    reset()
+    if memory and tracemalloc is not None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing = True
+    _start = clock()
+    enabled = True
+    track_memory = memory and current_memory() is not None
+
+def disable():
+    global enabled, track_memory, _tracing, _started_tracing
+    enabled = False
+    track_memory = False
+    if _started_tracing:
+        tracemalloc.stop()
+    _tracing = _started_tracing = False
+
+def reset():
+    global _traced_peak
+    with _lock:
+        _traced_peak = 0
+        _calls.clear()
+        _totals.clear()
+        _self_totals.clear()
+        _counters.clear()
+        _memory_growth.clear()
+        _memory_highs.clear()
+
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_memory():
+    """Returns how much Python has allocated, if that's being traced, or else
+    the resident size of this process, in bytes.  None if neither can be found
+    out cheaply.
+    """
+    if _tracing:
+        return tracemalloc.get_traced_memory()[0]
+
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * _page_size
+    finally:
+        f.close()
+
+def _traced_memory():
+    """Returns how much is traced now, and the most traced at once since the
+    last call, and starts again from now for the next.
+    """
+    global _traced_peak
+    with _lock:
+        memory, peak = tracemalloc.get_traced_memory()
+        # Only Python 3.9 and later can reset the peak; before that, it's the
+        # most since tracing started
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        _traced_peak = max(_traced_peak, peak)
+    return memory, peak
+
+def peak_memory():
+    """Returns the most Python has had allocated at once, if that's being
+    traced, or else the largest this process's resident size has been, in
+    bytes.  None if that's unknown.
+    """
+    if _tracing:
+        with _lock:
+            return max(_traced_peak, tracemalloc.get_traced_memory()[1])
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes; OS X in bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start', 'children', 'memory', 'child_memory',
+                 'high')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        if track_memory:
+            self.child_memory = 0
+            self.high = 0
+            if _tracing:
+                # The most traced since the last stage started or finished
+                # was while the enclosing stage was running
+                self.memory, peak = _traced_memory()
+                if stack:
+                    stack[-1].high = max(stack[-1].high, peak)
+            else:
+                self.memory = current_memory()
+        stack.append(self)
+        self.children = 0.0
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = clock() - self.start
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+
+        if track_memory:
+            if _tracing:
+                memory, peak = _traced_memory()
+                high = max(self.high, peak)
+            else:
+                memory = current_memory()
+                high = max(self.high, memory)
+            growth = memory - self.memory
+            if stack:
+                stack[-1].child_memory += growth
+                stack[-1].high = max(stack[-1].high, high)
+
+        with _lock:
+            _calls[self.name] += 1
+            _totals[self.name] += elapsed
+            _self_totals[self.name] += elapsed - self.children
+            if track_memory:
+                _memory_growth[self.name] += growth - self.child_memory
+                _memory_highs[self.name] = max(_memory_highs[self.name],
+                                               high)
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_stage = _NullStage()
+
+def stage(name):
+    """Returns a context manager that times its body as the stage `name`."""
+    if not enabled:
+        return _null_stage
+    return _Stage(name)
+
+def staged(name):
+    """Decorator that times every call to a function as the stage `name`."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """Adds `n` to the counter `name`."""
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def report():
+    """Returns everything recorded so far as a dict: 'elapsed' wall time,
+    'stages' mapping each name to its calls, total, and self time, and
+    'counters'.  'peak_memory' is what `peak_memory()` gives, if known.  If
+    memory is being tracked, each stage also has its 'memory_growth' and
+    'memory_high', in bytes.
+    """
+    peak = peak_memory()
+    with _lock:
+        stages = {}
+        for name in _calls:
+            stages[name] = dict(calls=_calls[name], total=_totals[name],
+                                self=_self_totals[name])
+            if track_memory:
+                stages[name].update(memory_growth=_memory_growth[name],
+                                    memory_high=_memory_highs[name])
+
+        return dict(
+            elapsed=clock() - _start if _start is not None else 0.0,
+            stages=stages,
+            counters=dict(_counters),
+            peak_memory=peak,
+        )
+
+def _megabytes(n):
+    return n / 1048576.0
+
+def write_summary(out):
+    """Writes a readable summary to the file `out`, slowest stages first (or
+    the ones that grew memory most, if memory is being tracked).
+    """
+    data = report()
+    if track_memory:
+        sort_key = 'memory_growth'
+        out.write("%-28s %8s %10s %10s %10s %10s\n" % (
+            'stage', 'calls', 'total', 'self', 'growth', 'high'))
+    else:
+        sort_key = 'self'
+        out.write("%-28s %8s %10s %10s\n" % (
+            'stage', 'calls', 'total', 'self'))
+
+    stages = sorted(data['stages'].items(),
+                    key=lambda item: item[1][sort_key], reverse=True)
+    for name, stage_data in stages:
+        out.write("%-28s %8d %9.3fs %9.3fs" % (
+            name, stage_data['calls'], stage_data['total'],
+            stage_data['self']))
+        if track_memory:
+            out.write(" %8.1fMB %8.1fMB" % (
+                _megabytes(stage_data['memory_growth']),
+                _megabytes(stage_data['memory_high'])))
+        out.write("\n")
+
+    if data['counters']:
+        out.write("\n%-28s %8s\n" % ('counter', 'value'))
+        for name, value in sorted(data['counters'].items()):
+            out.write("%-28s %8d\n" % (name, value))
+
+    out.write("\n%-28s %9.3fs\n" % ('elapsed', data['elapsed']))
+    if data['peak_memory'] is not None:
+        out.write("%-28s %8.1fMB\n" % (
+            'peak memory', _megabytes(data['peak_memory'])))
+
+def write_json(out):
+    """Writes everything recorded as JSON to the file `out`."""
+    json.dump(report(), out, indent=2, sort_keys=True)
+    out.write('\n')
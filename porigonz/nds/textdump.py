@@ -0,0 +1,99 @@
+# encoding: utf8
+u"""Bulk decryption of every bit of Pokémon text in a DS image.
+
+Text banks are decrypted in worker processes, a batch of NARC members at a
+time, but results always come back in (file, member, string) order.
+"""
+
+from collections import OrderedDict
+import json
+
+from porigonz.compat import range
+from porigonz.nds.parallel import image_pool, ordered_map, worker_image
+from porigonz.nds.util.text import is_pokemon_text, pokemon_character_table
+
+# How many NARC members each worker decrypts per task
+BATCH_SIZE = 16
+
+def iter_text(image, workers=None):
+    """Yields (dsfile, member, string index, string) for every string in every
+    text bank in `image`.
+    """
+    dsfiles = dict((dsfile.id, dsfile) for dsfile in image.dsfiles)
+
+    pool = image_pool(image, workers)
+    try:
+        # First find out which members of which files are text; this only
+        # decrypts headers
+        file_ids = [dsfile.id for dsfile in image.dsfiles if dsfile.length]
+        tasks = []
+        for file_id, members in zip(file_ids,
+                                    pool.imap(_find_text_members, file_ids)):
+            for i in range(0, len(members), BATCH_SIZE):
+                tasks.append((file_id, members[i:i + BATCH_SIZE]))
+
+        # Then decrypt them for real
+        for file_id, banks in ordered_map(pool, _translate_members, tasks):
+            dsfile = dsfiles[file_id]
+            for member, strings in banks:
+                for index, string in enumerate(strings):
+                    yield dsfile, member, index, string
+    finally:
+        pool.close()
+        pool.join()
+
+def dump_json_lines(image, out, workers=None):
+    """Writes every string in `image` to the file `out` as JSON Lines.
+
+    Each record has `file`, `member`, `index`, and `text` keys.
+    """
+    for dsfile, member, index, string in iter_text(image, workers):
+        record = OrderedDict([
+            ('file', dsfile.path or "file%d" % dsfile.id),
+            ('member', member),
+            ('index', index),
+            ('text', string),
+        ])
+        out.write(json.dumps(record, ensure_ascii=False).encode('utf8'))
+        out.write(b'\n')
+
+
+### Worker processes
+
+# The most recently split NARC, as (file id, chunks); consecutive tasks tend
+# to hit the same file
+_last_narc = None
+
+def _narc_chunks(file_id):
+    global _last_narc
+    if _last_narc is None or _last_narc[0] != file_id:
+        # Drop the old one first so only one is ever in memory
+        _last_narc = None
+        dsfile = worker_image().dsfiles[file_id]
+        _last_narc = file_id, dsfile.parse_narc()
+        dsfile._contents = None
+
+    return _last_narc[1]
+
+def _find_text_members(file_id):
+    """Returns the indices of the members of the given file that are text
+    banks, or an empty list if it isn't a NARC at all.
+    """
+    dsfile = worker_image().dsfiles[file_id]
+    is_narc = dsfile.is_narc
+    dsfile._contents = None
+    if not is_narc:
+        return []
+
+    return [member for member, chunk in enumerate(_narc_chunks(file_id))
+            if is_pokemon_text(chunk)]
+
+def _translate_members(task):
+    """Returns (file id, [(member, strings), ...]) for the given (file id,
+    members).
+    """
+    file_id, members = task
+    tbl = pokemon_character_table()
+    chunks = _narc_chunks(file_id)
+    return file_id, [(member, tbl.pokemon_translate(chunks[member]))
+                     for member in members]
@@ -1,21 +1,30 @@
 # encoding: utf8
 """Miscellaneous helpers for dealing with DS data."""
 
+from array import array
+import sys
+
+from porigonz.compat import (array_frombytes, byte_table, int_from_bytes,
+    int_to_bytes, tobytes)
+
 def cap_to_bits(n, bits=32):
     return n & ((1 << bits) - 1)
 
 def word_iterator(source, word_size):
     """Interprets source as a sequence of little-endian words, word_size bits
     each.
+
+    This works a byte at a time; `unpack_words` is much faster for widths that
+    line up with bytes.
     """
 
     mask = (1 << word_size) - 1
 
     current_word = 0
     current_len = 0
-    for ch in source:
+    for byte in bytearray(source):
         # Add in some bits
-        current_word = (ord(ch) << current_len) | current_word
+        current_word = (byte << current_len) | current_word
         current_len += 8
 
         # If there are enough bits for a word, split them off and yield
@@ -26,3 +35,148 @@ def word_iterator(source, word_size):
             current_len -= word_size
 
             yield new_word
+
+# CRC-16 as the DS computes it: reflected polynomial 0xa001 (aka MODBUS)
+def _crc16_table():
+    table = []
+    for n in range(256):
+        crc = n
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+_crc16_table = _crc16_table()
+
+# Feeding the CRC two bytes at a time needs a table for every possible 16-bit
+# word, but it halves the number of steps, and each step is a single lookup.
+# The wider table is only built the first time it's worth it
+_crc16_wide_table = None
+_CRC16_WIDE_THRESHOLD = 1024
+
+def _build_crc16_wide_table():
+    # CRCs are linear, so two steps of the byte table on a word `w` work out
+    # to (T[lo] >> 8) ^ T[T[lo] & 0xff] ^ T[hi]
+    table = _crc16_table
+    low = [(table[n] >> 8) ^ table[table[n] & 0xff] for n in range(256)]
+    return [low_value ^ high_value
+            for high_value in table
+            for low_value in low]
+
+def crc16(data, crc=0xffff):
+    """Returns the CRC-16 of `data`, as used in the DS header and banner.
+    Pass a previous result as `crc` to continue a running CRC.
+    """
+    global _crc16_wide_table
+
+    if len(data) >= _CRC16_WIDE_THRESHOLD:
+        if _crc16_wide_table is None:
+            _crc16_wide_table = _build_crc16_wide_table()
+        table = _crc16_wide_table
+        for word in unpack_words(data, 16):
+            crc = table[crc ^ word]
+        data = data[len(data) & ~1:]
+
+    table = _crc16_table
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+def xor_bytes(a, b):
+    """XORs two equal-length strings of bytes together, all at once.
+
+    Python has no vectorized XOR for bytes, but it does have arbitrarily
+    large integers, so the bytes are converted to (huge) numbers and back.
+    """
+    if not a:
+        return b''
+
+    n = int_from_bytes(a) ^ int_from_bytes(b)
+    return int_to_bytes(n, len(a))
+
+# For splitting bytes into 1-, 2-, or 4-bit fields.  _unpack_tables[bits][i]
+# extracts the ith field of each byte when passed to bytes.translate, and
+# _pack_tables[bits][i] does the reverse, moving a value into the ith field
+_unpack_tables = {}
+_pack_tables = {}
+for _bits in (1, 2, 4):
+    _mask = (1 << _bits) - 1
+    _unpack_tables[_bits] = [
+        byte_table((n >> shift) & _mask for n in range(256))
+        for shift in range(0, 8, _bits)
+    ]
+    _pack_tables[_bits] = [
+        byte_table((n & _mask) << shift for n in range(256))
+        for shift in range(0, 8, _bits)
+    ]
+del _bits, _mask
+
+def unpack_bits(data, bits):
+    """Returns a bytearray with one byte per `bits`-bit word in `data`, which
+    must be 1, 2, or 4.  Words are little-endian: the low bits come first.
+    """
+    if bits == 8:
+        return bytearray(data)
+
+    if not isinstance(data, (bytes, bytearray)):
+        data = tobytes(data)
+
+    tables = _unpack_tables[bits]
+    step = len(tables)
+    out = bytearray(len(data) * step)
+    for i, table in enumerate(tables):
+        out[i::step] = data.translate(table)
+    return out
+
+def unpack_words(data, bits):
+    """Returns all the little-endian `bits`-bit words in `data` at once.
+
+    1-, 2-, 4-, and 8-bit words come back as a bytearray, and 16-bit words as
+    an array of unsigned shorts, with any odd byte at the end dropped.  Other
+    widths fall back to `word_iterator` and come back as a list.
+    """
+    if bits in (1, 2, 4, 8):
+        return unpack_bits(data, bits)
+
+    if bits == 16:
+        words = array('H')
+        array_frombytes(words, data[:len(data) // 2 * 2])
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words
+
+    return list(word_iterator(data, bits))
+
+def pack_bits(values, bits):
+    """The reverse of `unpack_bits`: packs a sequence of `bits`-bit values
+    into bytes, low bits first.
+    """
+    values = bytes(bytearray(values))
+    if bits == 8:
+        return values
+
+    tables = _pack_tables[bits]
+    step = len(tables)
+    if len(values) % step:
+        values += b'\x00' * (step - len(values) % step)
+
+    # The fields don't overlap, so XOR works as OR
+    packed = values[0::step].translate(tables[0])
+    for i in range(1, step):
+        packed = xor_bytes(packed, values[i::step].translate(tables[i]))
+    return packed
+
+def unpack_nybbles(data):
+    """Returns a bytearray with one byte per 4-bit word in `data`, low nybble
+    first.
+    """
+    return unpack_bits(data, 4)
+
+def pack_nybbles(pixels):
+    """The reverse of `unpack_nybbles`: packs a sequence of 4-bit values, two
+    to a byte, and returns bytes.
+    """
+    return pack_bits(pixels, 4)
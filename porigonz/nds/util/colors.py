@@ -0,0 +1,76 @@
+# encoding: utf8
+"""Decoding DS colors.
+
+The DS stores colors as 15-bit little-endian words, five bits each of red,
+green, and blue, starting from the low bits.  There are only 32768 of them, so
+every one is converted up front into a table, and decoding a palette is then a
+single lookup.
+
+Palettes turn up over and over again across files, so the most recently used
+decoded palettes are also cached by their raw data.  That's why they're
+tuples: they're shared, so don't try to change them.
+"""
+
+from collections import OrderedDict
+from operator import itemgetter
+import threading
+
+from porigonz.compat import byte_table, range
+from porigonz.nds import stats
+from porigonz.nds.util import unpack_words
+
+# Decoded palettes, keyed by raw data, least recently used first.  Only this
+# many are kept, so a long extract or server doesn't keep every one it sees
+PALETTE_CACHE_SIZE = 256
+_palettes = OrderedDict()
+_palettes_lock = threading.Lock()
+
+# Bit 15 isn't part of the color, so it's cleared from every high byte
+_clear_bit_15 = byte_table(n & 0x7f for n in range(256))
+
+def _build_table():
+    return tuple(
+        ((w & 0x001f)        * 255 // 31,
+         ((w & 0x03e0) >> 5 ) * 255 // 31,
+         ((w & 0x7c00) >> 10) * 255 // 31)
+        for w in range(0x8000)
+    )
+
+_table = None
+
+def color_table():
+    """Returns a tuple of the (r, g, b) color for every 15-bit DS color."""
+    global _table
+    if _table is None:
+        _table = _build_table()
+    return _table
+
+def decode_palette(data):
+    """Returns a tuple of (r, g, b) colors for the raw palette data `data`.
+    Any odd byte at the end is ignored.
+    """
+    # A copy, so a view doesn't keep what it's a view of alive
+    key = bytes(data)
+    with _palettes_lock:
+        colors = _palettes.pop(key, None)
+        if colors is not None:
+            _palettes[key] = colors
+            stats.count('palette cache hits')
+            return colors
+    stats.count('palette cache misses')
+
+    masked = bytearray(data)
+    masked[1::2] = masked[1::2].translate(_clear_bit_15)
+    words = unpack_words(masked, 16)
+
+    table = color_table()
+    if len(words) > 1:
+        colors = itemgetter(*words)(table)
+    else:
+        colors = tuple(table[w] for w in words)
+
+    with _palettes_lock:
+        _palettes[key] = colors
+        while len(_palettes) > PALETTE_CACHE_SIZE:
+            _palettes.popitem(last=False)
+    return colors
@@ -0,0 +1,86 @@
+# encoding: utf8
+"""Turning decoded PIL images into files.
+
+Once sprites and textures are decoded, compressing them is most of the work
+left.  PIL lets go of the GIL while it compresses, so `ImageEncoder` can spread
+that work over a pool of threads without needing separate processes.
+"""
+
+from porigonz.compat import BytesIO
+from porigonz.nds import stats
+from porigonz.nds.parallel import ordered_map
+
+FORMATS = ['png', 'webp', 'raw']
+
+class ImageEncoder(object):
+    """Encodes PIL images as PNG, lossless WebP, or raw pixel data.
+
+    `compress_level` (0 to 9) and `optimize` are passed along to PIL's PNG and
+    WebP writers; `raw` just dumps the pixels, which for paletted images means
+    one palette index per byte.
+
+    `threads` is the size of the pool used by `encode_all`; None means one per
+    CPU.  The pool is started the first time it's needed; call `close()` (or
+    use the encoder in a `with` block) to stop it.
+    """
+
+    def __init__(self, format='png', compress_level=6, optimize=False,
+                 threads=None):
+        if format not in FORMATS:
+            raise ValueError("Unknown image format %r" % (format,))
+
+        self.format = format
+        self.compress_level = compress_level
+        self.optimize = optimize
+        self.threads = threads
+        self._pool = None
+
+    @stats.staged('encode image')
+    def encode(self, img):
+        """Returns the encoded data for a single image."""
+        stats.count('images encoded')
+        if self.format == 'raw':
+            return img.tobytes()
+
+        buffer = BytesIO()
+        if self.format == 'png':
+            img.save(buffer, 'PNG', compress_level=self.compress_level,
+                     optimize=self.optimize)
+        else:
+            # WebP has no paletted mode, and PIL would drop the transparency
+            # when converting it implicitly
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            img.save(buffer, 'WEBP', lossless=True,
+                     method=min(self.compress_level, 6),
+                     quality=100 if self.optimize else 80)
+        return buffer.getvalue()
+
+    def encode_all(self, images):
+        """Encodes every image in the iterable `images` on a thread pool,
+        yielding the results in the same order.
+        """
+        if self.threads == 1:
+            return (self.encode(img) for img in images)
+
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.threads)
+        return ordered_map(self._pool, self.encode, images)
+
+    def close(self):
+        """Stops the thread pool, if there is one, once it's finished what
+        it's doing.  The encoder can still be used; it'll just start another.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+default_encoder = ImageEncoder(threads=1)
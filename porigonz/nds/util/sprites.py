@@ -1,19 +1,27 @@
 # encoding: utf8
 """Handling NDS sprites."""
 
+from array import array
 from collections import namedtuple
-from cStringIO import StringIO
-from itertools import izip
+import struct
+import sys
 
 from construct import *
 from PIL import Image
 
-from porigonz.nds.util import cap_to_bits, word_iterator
+from porigonz.compat import bytes_compatible, range, tobytes
+from porigonz.nds import stats
+from porigonz.nds.nitro import NitroFile
+from porigonz.nds.util import xor_bytes
+from porigonz.nds.util.colors import decode_palette
+from porigonz.nds.util.encoder import default_encoder
+from porigonz.nds.util.tiles import tile_layout
 
-# Nintendo color resource; wraps palletes
+# Nintendo color resource; wraps palletes.  These are only used to build
+# files; `NitroFile` reads them
 nclr_struct = Struct('nclr',
-    Const(Bytes('magic', 4), 'RLCN'),
-    Const(Bytes('bom', 4), '\xff\xfe\x00\x01'),
+    Const(Bytes('magic', 4), b'RLCN'),
+    Const(Bytes('bom', 4), b'\xff\xfe\x00\x01'),
     ULInt32('length'),
     Const(ULInt16('header_length'), 0x10),
     ULInt16('num_sections'),
@@ -22,7 +30,7 @@ nclr_struct = Struct('nclr',
 
 # Palette data
 ttlp_struct = Struct('ttlp',
-    Const(Bytes('magic', 4), 'TTLP'),
+    Const(Bytes('magic', 4), b'TTLP'),
     ULInt32('length'),
     ULInt32('bit_depth'),
     Const(ULInt32('padding'), 0),
@@ -33,52 +41,47 @@ ttlp_struct = Struct('ttlp',
     MetaField('data', lambda ctx: 16 * 2),
 )
 
+@bytes_compatible
 class Palette(object):
     """Represents a DS palette.
 
-    After creating a palette, a list of color stored as r, g, b tuples is
-    available from the colors property.
+    After creating a palette, a tuple of colors stored as r, g, b tuples is
+    available from the colors property.  It may be shared with other
+    palettes, so don't change it.
     """
 
+    @stats.staged('decode palette')
     def __init__(self, chunk):
         """Parses a binary chunk as a B5 G5 R5 palette."""
-        self.colors = []
-
-        nclr = nclr_struct.parse(chunk)
-
         # XXX this SHOULD have two sections according to format docs.
         # ttlp.data won't leak into a following section, at least
-        ttlp = ttlp_struct.parse(nclr.data)
+        ttlp = ttlp_struct.parse(NitroFile(chunk).section(b'TTLP'))
 
-        for palette_word in word_iterator(ttlp.data, 16):
-            r = ((palette_word & 0x001f)      ) * 255 // 31
-            g = ((palette_word & 0x03e0) >> 5 ) * 255 // 31
-            b = ((palette_word & 0x7c00) >> 10) * 255 // 31
+        self.colors = decode_palette(ttlp.data)
+        stats.count('palettes decoded')
 
-            self.colors.append((r, g, b))
-
-    def png(self):
-        """Returns a PNG illustrating the colors in this palette."""
+    def image(self):
+        """Returns a PIL image illustrating the colors in this palette."""
 
         img = Image.new(mode='RGB', size=(len(self.colors), 1), color=None)
 
         for i, color in enumerate(self.colors):
             img.putpixel((i, 0), color)
 
-        img = img.resize((8 * len(self.colors), 8))
+        return img.resize((8 * len(self.colors), 8))
 
-        buffer = StringIO()
-        img.save(buffer, 'PNG')
-        return buffer.getvalue()
+    def png(self, encoder=default_encoder):
+        """Returns a PNG illustrating the colors in this palette."""
+        return encoder.encode(self.image())
 
-    def __str__(self):
+    def __bytes__(self):
         """Returns this palette as a PNG."""
         return self.png()
 
 
-# Nintendo character graphic resource
+# Nintendo character graphic resource; as above, only used to build files
 rgcn_struct = Struct('rgcn',
-    Const(Bytes('magic', 4), 'RGCN'),
+    Const(Bytes('magic', 4), b'RGCN'),
     Bytes('bom', 4),   # \xff\xfe\x01\x01 or \xff\xfe\x00\x01
     ULInt32('length'),
     Const(ULInt16('header_length'), 0x10),
@@ -89,7 +92,7 @@ rgcn_struct = Struct('rgcn',
 # "Character" data
 # Most of this seems totally wrong for Pokémon
 rahc_struct = Struct('rahc',
-    Const(Bytes('magic', 4), 'RAHC'),
+    Const(Bytes('magic', 4), b'RAHC'),
     ULInt8('header_length'), # 0x20),
     BitStruct('length',
         BitField('length', 24),
@@ -106,30 +109,145 @@ rahc_struct = Struct('rahc',
 
 Size = namedtuple('Size', ['width', 'height'])
 
+class LCGOrbit(object):
+    """The complete sequence of values produced by a 16-bit linear
+    congruential generator, `key = key * mult + add`.
+
+    With the constants the Pokémon games use, every possible key appears
+    exactly once before the sequence repeats, so the whole thing fits in a
+    65536-entry table.  The mask for any seed is then just a slice of it.
+    """
+
+    def __init__(self, mult, add):
+        self.mult = mult
+        self.add = add
+
+        orbit = array('H', [0]) * 0x10000
+        positions = array('H', [0]) * 0x10000
+
+        key = 0
+        for i in range(0x10000):
+            orbit[i] = key
+            positions[key] = i
+            key = (key * mult + add) & 0xffff
+
+        if key != 0 or len(set(orbit)) != 0x10000:
+            raise ValueError("LCG constants don't cover all 16-bit values")
+
+        # Masks are XORed against little-endian data
+        if sys.byteorder != 'little':
+            orbit.byteswap()
+
+        # Doubled up, so a mask that wraps around is still a single slice
+        self.orbit = tobytes(orbit) * 2
+        self.positions = positions
+
+    def mask(self, seed, count):
+        """Returns `count` 16-bit little-endian words of mask starting with
+        `seed`, as bytes.
+        """
+        start = self.positions[seed] * 2
+        return self.orbit[start:start + count * 2]
+
+    def reverse_mask(self, seed, count):
+        """Returns `count` words of mask ending with `seed`, where each word
+        generates the one before it.
+        """
+        mask = array('H', self.mask(seed, count))
+        mask.reverse()
+        return tobytes(mask)
+
+# Pokémon sprite encryption constants: (mult, add, where the seed is)
+# D/P: the encryption mask started at the beginning, so the decryption has to
+# start at the end: it uses the last word as its seed, and works backwards
+# through the data with the same generator as Platinum.  (0xeb65, 0x61a1 runs
+# that generator in reverse, which is how the mask was made.)
+POKEMON_SPRITE_DP = (0x4e6d, 0x6073, 'last')
+# Platinum: some sprites in Platinum have non-blank last pixels, so they
+# switched it around and have the first pixel be the decryption seed instead,
+# working forwards.
+# add = 0x89c3  # appears to be the first dummy block only?
+POKEMON_SPRITE_PLATINUM = (0x4e6d, 0x6073, 'first')
+
+_lcg_orbits = {}
+
+def lcg_orbit(mult, add):
+    """Returns the (cached) `LCGOrbit` for the given constants."""
+    key = mult, add
+    if key not in _lcg_orbits:
+        _lcg_orbits[key] = LCGOrbit(mult, add)
+    return _lcg_orbits[key]
+
+@stats.staged('decrypt sprite')
+def pokemon_decrypt(data, constants=POKEMON_SPRITE_PLATINUM):
+    """Decrypts a block of Pokémon sprite data in one go.  Any odd byte at the
+    end is dropped.
+    """
+    mult, add, seed_position = constants
+    count = len(data) // 2
+    if not count:
+        return b''
+
+    orbit = lcg_orbit(mult, add)
+    if seed_position == 'first':
+        seed, = struct.unpack('<H', data[0:2])
+        mask = orbit.mask(seed, count)
+    else:
+        seed, = struct.unpack('<H', data[count * 2 - 2:count * 2])
+        mask = orbit.reverse_mask(seed, count)
+
+    return xor_bytes(data[:count * 2], mask)
+
+def pokemon_encrypt(data, seed, constants=POKEMON_SPRITE_PLATINUM):
+    """The reverse of `pokemon_decrypt`, starting the mask from `seed`.
+
+    The seed ends up stored in place of the first (or last) word, so that
+    word of `data` is lost; it always decrypts to zero.
+    """
+    mult, add, seed_position = constants
+    count = len(data) // 2
+    if not count:
+        return b''
+
+    orbit = lcg_orbit(mult, add)
+    if seed_position == 'first':
+        data = b'\x00\x00' + data[2:count * 2]
+        mask = orbit.mask(seed, count)
+    else:
+        data = data[:count * 2 - 2] + b'\x00\x00'
+        mask = orbit.reverse_mask(seed, count)
+
+    return xor_bytes(data, mask)
+
+@bytes_compatible
 class Sprite(object):
-    """Represents a DS sprite."""
+    """Represents a DS sprite.
+
+    `pixels` is a bytearray of palette indices, one byte per pixel, in
+    row-major order; the pixel at x, y is `pixels[y * size.width + x]`.
+    """
 
     @classmethod
+    @stats.staged('decode sprite')
     def from_standard(cls, chunk):
         """Parses a nybble-based sprite from a chunk."""
 
         self = cls()
 
-        rgcn = rgcn_struct.parse(chunk)
-        rahc = rahc_struct.parse(rgcn.data)
+        rahc = rahc_struct.parse(NitroFile(chunk).section(b'RAHC'))
 
         # XXX make these less constant somehow
         self.size = Size(width=32, height=128)
 
-        self.pixels = [[0] * self.size.height for _ in range(self.size.width)]
-        for i, word in enumerate(word_iterator(rahc.data, 4)):
-            x, y = self.get_pos(i, tile_size=8)
-            self.pixels[x][y] = word
+        layout = tile_layout(self.size.width, self.size.height, tile_size=8)
+        self.pixels = layout.untile(rahc.data)
+        stats.count('sprites decoded')
 
         return self
 
     @classmethod
-    def from_pokemon(cls, chunk):
+    @stats.staged('decode sprite')
+    def from_pokemon(cls, chunk, constants=POKEMON_SPRITE_PLATINUM):
         """Parses a Pokémon sprite from a chunk.
 
         This encryption is only used for the Pokémon themselves and trainers.
@@ -141,112 +259,70 @@ class Sprite(object):
         integers.  The game then decrypts the images by doing the same thing in
         reverse, using the first or last few pixels in the image as the seed to
         the PRNG to reproduce the same mask.
+
+        `constants` picks the PRNG and seed; it should be either
+        `POKEMON_SPRITE_PLATINUM` (the default) or `POKEMON_SPRITE_DP`.
         """
 
         self = cls()
 
-        rgcn = rgcn_struct.parse(chunk)
-        rahc = rahc_struct.parse(rgcn.data)
+        rahc = rahc_struct.parse(NitroFile(chunk).section(b'RAHC'))
 
         # XXX make these less constant sometime.
-        # XXX and determine which constants to use.
         self.size = Size(width=160, height=80)
-        # D/P
-        # similarly uses a different add constant for the first block
-        add = 0x61a1
-        mult = 0xeb65
-        # Platinum
-        # These actually produce the same sequence as D/P, only backwards.  It
-        # seems the encryption mask in D/P started at the beginning, so the
-        # decryption had to start at the end—but some sprites in Platinum have
-        # non-blank last pixels.  So they had to switch it around and have the
-        # first pixel (with the same constants) be the decryption seed instead.
-        # I'm always using the first pixel as the seed, thus I have different
-        # constants.
-        # add = 0x89c3  # appears to be the first dummy block only?
-        add = 0x6073
-        mult = 0x4e6d
-
-        # Simple mask generator
-        def mask_generator():
-            key = (word_iterator(rahc.data[0:2], 16)).next()
-            while True:
-                yield key
-                key = cap_to_bits(key * mult + add, 16)
-
-        def pixel_generator():
-            # Unmask the sprite data
-            for word, mask in izip(word_iterator(rahc.data, 16),
-                                   mask_generator()):
-                unmasked = word ^ mask
-                # This is 16 bits, and there are four bits per pixel, so we
-                # have four pixels
-                for _ in range(4):
-                    yield cap_to_bits(unmasked, 4)
-                    unmasked >>= 4
-
-        self.pixels = [[0] * self.size.height for _ in range(self.size.width)]
-        for i, pixel in enumerate(pixel_generator()):
-            x, y = self.get_pos(i)
-            self.pixels[x][y] = pixel
-        print i, x, y
-
-        return self
-
-    def get_pos(self, idx, tile_size=None):
-        """Given a linearized index, returns the x, y coordinates within the
-        image.
-
-        If `tile_size` is provided, the image is assumed to be constructed from
-        square tiles of that size, and each tile is filled before the next is
-        begin.
-        """
-        if tile_size:
-            tile_no = idx // tile_size ** 2
-            # coordinates of the tile; 0,0 is first tile, 0,1 is second, etc
-            tile_x = tile_no % (self.size.width // tile_size)
-            tile_y = tile_no // (self.size.width // tile_size)
-
-            # idx within the tile
-            tile_idx = idx % tile_size ** 2
-
-            # Now we just need the x,y within the tile, plus the offsets for
-            # the tile itself
-            return (tile_x * tile_size + tile_idx %  tile_size,
-                    tile_y * tile_size + tile_idx // tile_size)
 
+        # Pokémon sprites aren't tiled, so the pixels are already in order
+        layout = tile_layout(self.size.width, self.size.height)
+        self.pixels = layout.untile(pokemon_decrypt(rahc.data, constants))
+        stats.count('sprites decoded')
 
-        # Without tiles, this is rather simpler
-        return idx % self.size.width, idx // self.size.width
+        return self
 
     def fake_color(self, idx):
         """Given a palette index, returns a unique fake color to represent it.
         """
-        sat = idx * 255 / 15
+        sat = idx * 255 // 15
         return sat, sat, sat
 
-    def png(self, palette=None):
-        """Returns this sprite as a PNG.  Colors are merely shades of gray,
-        unless a palette is provided."""
-        img = Image.new(mode='RGBA', size=self.size, color=None)
+    @stats.staged('build image')
+    def image(self, palette=None):
+        """Returns this sprite as a paletted PIL image.  Colors are merely
+        shades of gray, unless a palette is provided.
 
+        The first color is always transparent.  The image shares memory with
+        `pixels`, so getting another one with a different palette costs next
+        to nothing.
+        """
         if palette:
             colors = palette.colors
         else:
-            colors = [(sat, sat, sat) for sat in ((15 - _) * 255 / 15 for _ in range(16))]
+            colors = [(sat, sat, sat) for sat in ((15 - _) * 255 // 15 for _ in range(16))]
 
-        # Add alpha channel.  First color is always transparent
-        colors = [(0, 0, 0, 0)] + [color + (255,) for color in colors[1:]]
+        # Transparent pixels come out as black, as they did when sprites were
+        # drawn in RGBA
+        colors = [(0, 0, 0)] + list(colors[1:])
 
-        data = img.load()
-        for x in xrange(self.size.width):
-            for y in xrange(self.size.height):
-                data[x, y] = colors[ self.pixels[x][y] ]
+        img = Image.frombuffer('P', self.size, self.pixels, 'raw', 'P', 0, 1)
+        img.putpalette([channel for color in colors for channel in color])
+        img.info['transparency'] = 0
+        return img
+
+    def png(self, palette=None, encoder=default_encoder):
+        """Returns this sprite as a PNG.  Colors are merely shades of gray,
+        unless a palette is provided.
 
-        buffer = StringIO()
-        img.save(buffer, 'PNG')
-        return buffer.getvalue()
+        Other image formats can be had by passing an `ImageEncoder`.
+        """
+        return encoder.encode(self.image(palette))
+
+    def pngs(self, palettes, encoder=default_encoder):
+        """Returns a list of PNGs of this sprite, one for each of `palettes`.
+
+        If `encoder` has more than one thread, they're encoded in parallel.
+        """
+        images = [self.image(palette) for palette in palettes]
+        return list(encoder.encode_all(images))
 
-    def __str__(self):
+    def __bytes__(self):
         """Returns this sprite as a PNG."""
         return self.png()
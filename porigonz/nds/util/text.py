@@ -1,14 +1,18 @@
 # encoding: utf8
 """Utility functions and classes for working with DS text."""
 
+import pkgutil
+
 from construct import *
 
+from porigonz.compat import BytesIO, range, string_types, unichr
+from porigonz.nds import stats
 from porigonz.nds.util import cap_to_bits
 
 pokemon_encrypted_text_struct = Struct('pokemon_text',
     ULInt16('count'),
     ULInt16('key'),
-    MetaRepeater(
+    Array(
         lambda ctx: ctx['count'],
         Struct('header',
             ULInt32('offset'),
@@ -17,6 +21,44 @@ pokemon_encrypted_text_struct = Struct('pokemon_text',
     ),
 )
 
+def pokemon_character_table():
+    u"""Returns the `CharacterTable` for Gen IV Pokémon text, loading it on
+    first use.
+    """
+    global _pokemon_character_table
+    if _pokemon_character_table is None:
+        # LoadingNOW is awesome.
+        data = pkgutil.get_data('porigonz', 'data/pokemon.tbl')
+        _pokemon_character_table = CharacterTable.from_stream(BytesIO(data))
+
+    return _pokemon_character_table
+
+_pokemon_character_table = None
+
+def is_pokemon_text(src):
+    u"""Returns True iff `src` looks like a block of Pokémon text.
+
+    Only the header is decrypted; it must describe strings that fit within
+    the block and start after the header itself.
+    """
+    if len(src) < 4:
+        return False
+
+    try:
+        bank = PokemonTextBank(src, None)
+    except Exception:
+        return False
+
+    if not len(bank):
+        return False
+
+    data_start = 4 + 8 * len(bank)
+    for offset, length in bank.headers:
+        if offset < data_start or offset + length * 2 > len(src):
+            return False
+
+    return True
+
 class CharacterTable(object):
     friendly_display_mapping = {
         ord(u'\r'): u'\\r',
@@ -60,7 +102,7 @@ class CharacterTable(object):
         `from_` may be either an integer or a character.
         `to` must be a unicode character.
         """
-        if isinstance(from_, basestring):
+        if isinstance(from_, string_types):
             from_ = ord(from_)
 
         self.mapping_table[from_] = to
@@ -84,8 +126,33 @@ class CharacterTable(object):
         encryption from the Gen IV Pokémon games.
 
         These blocks actually contain a list of multiple strings.  The whole
-        list is returned.
+        list is returned.  If you only want a few of them, use
+        `pokemon_text_bank` instead.
         """
+        return list(self.pokemon_text_bank(src))
+
+    def pokemon_text_bank(self, src):
+        u"""Returns a `PokemonTextBank` wrapping a raw block of Pokémon text.
+
+        Only the header is decrypted up front; each string is decrypted and
+        decoded the first time it's asked for.
+        """
+        return PokemonTextBank(src, self)
+
+
+class PokemonTextBank(object):
+    u"""A block of encrypted Gen IV Pokémon text, decoded lazily.
+
+    Behaves like a read-only list of unicode strings.  The header (a list of
+    offsets and lengths) is decrypted immediately, but individual strings are
+    only decrypted when indexed, and are cached afterwards.  So grabbing one
+    Pokémon's name out of a bank costs only as much as that name.
+    """
+
+    def __init__(self, src, table):
+        self.src = src
+        self.table = table
+
         pokemon_junk = pokemon_encrypted_text_struct.parse(src)
 
         # <3 LoadingNOW for the original source
@@ -93,34 +160,62 @@ class CharacterTable(object):
         # Decrypt the header
         # It's encrypted with some XOR shenanigans and 16-bit math.
         key = cap_to_bits(pokemon_junk.key * 0x02fd, 16)
-        for i in range(pokemon_junk.count):
+        self.headers = []
+        for i, header in enumerate(pokemon_junk.header):
             curkey = cap_to_bits(key * (i + 1), 16)
             curkey = curkey | (curkey << 16)
 
-            pokemon_junk.header[i].offset ^= curkey
-            pokemon_junk.header[i].length ^= curkey
+            self.headers.append((header.offset ^ curkey,
+                                 header.length ^ curkey))
 
-        # Translate this garbage, decrypting with this rotating key
-        strings = []
-        for i, header in enumerate(pokemon_junk.header):
-            dest_chars = []
+        self._strings = [None] * len(self.headers)
 
-            offset = header.offset
-            length = header.length
+    def __len__(self):
+        return len(self.headers)
 
-            key = ((i + 1) * 0x91bd3) & 0xffff
-            for pos in xrange(length):
-                # Characters are two bytes; get them and fix endianness
-                n = (ord(src[offset + pos * 2 + 1]) << 8) \
-                   | ord(src[offset + pos * 2])
-                n ^= key
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
-                dest_chars.append(unichr(n))
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        string = self._strings[i]
+        if string is None:
+            string = self._decrypt(i % len(self))
+            self._strings[i] = string
+            stats.count('strings decrypted')
+
+        return string
+
+    def encrypted(self, i):
+        """Returns string `i` still encrypted.  Strings are encrypted by
+        index alone, so strings at the same index in two banks are the same
+        if and only if this is.
+        """
+        offset, length = self.headers[i]
+        return self.src[offset:offset + length * 2]
+
+    @stats.staged('decrypt text')
+    def _decrypt(self, i):
+        """Decrypts and decodes string `i`, which must be non-negative."""
+        offset, length = self.headers[i]
+        src = bytearray(self.src[offset:offset + length * 2])
+
+        # Translate this garbage, decrypting with this rotating key
+        dest_chars = []
+        key = ((i + 1) * 0x91bd3) & 0xffff
+        for pos in range(length):
+            # Characters are two bytes; get them and fix endianness
+            n = (src[pos * 2 + 1] << 8) | src[pos * 2]
+            n ^= key
 
-                # Rotate key
-                key = (key + 0x493d) & 0xffff
+            dest_chars.append(unichr(n))
 
-            dest_string = u''.join(dest_chars)
-            strings.append(self.escape_control_chars(self.pokemon_decode_string(dest_string)))
+            # Rotate key
+            key = (key + 0x493d) & 0xffff
 
-        return strings
+        dest_string = u''.join(dest_chars)
+        return self.table.escape_control_chars(
+            self.table.pokemon_decode_string(dest_string))
@@ -1,21 +1,36 @@
+from array import array
 from construct import *
 from PIL import Image
-from cStringIO import StringIO
 from collections import namedtuple
-from itertools import izip as zip
-
-from porigonz.nds.util import word_iterator
+from operator import itemgetter
+import struct
+import sys
+
+from porigonz.compat import (array_frombytes, byte_table, bytes_compatible,
+    native_str, range, tobytes, zip)
+from porigonz.nds import stats
+from porigonz.nds.nitro import NitroFile
+from porigonz.nds.util import unpack_words, xor_bytes
+from porigonz.nds.util.colors import decode_palette
+from porigonz.nds.util.encoder import default_encoder
+from porigonz.nds.util.tiles import tile_layout
 
 #http://tahaxan.arcnor.com/forums/index.php?action=printpage%3Btopic=34.0
 #http://tahaxan.arcnor.com/forums/index.php?topic=65.0
 
-bpp = [0, 8, 2, 4, 4, 8, 2, 8, 16]
+# Bits per texel for each format.  Format 5 also has another 16 bits per 4x4
+# block of palette index data, kept elsewhere
+bpp = [0, 8, 2, 4, 8, 2, 8, 16]
+
+# Colors in the palette for each format.  Format 5 blocks can use colors from
+# anywhere in the palette data, and format 7 has no palette at all
+palette_sizes = [0, 32, 4, 16, 256, None, 8, 0]
 
 # XXX call this Div8 instead?
 class TimesEight(Adapter):
     """these structs seem to contain a lot of integers that are off by a factor of eight. this class corrects that"""
     def _encode(self, obj, ctx):
-        return obj / 8
+        return obj // 8
     def _decode(self, obj, ctx):
         return obj * 8
 
@@ -39,7 +54,7 @@ block_header = Struct('header',
     Array(lambda ctx: ctx.count, ULInt32('unknown0')),
 )
 
-name_array = Array(lambda ctx: ctx.header.count, String('names', 16, padchar="\x00"))
+name_array = Array(lambda ctx: ctx.header.count, String('names', 16, padchar=b"\x00"))
 
 texture_def_struct = Struct('texture',
     block_header,
@@ -53,21 +68,32 @@ texture_def_struct = Struct('texture',
             Padding(2),
             Flag('color0'), #indcates that the first color is transparent
             Bits('format', 3),
-            Bits('height', 3),
-            Bits('width', 3),
+            Bits('height_shift', 3),
+            Bits('width_shift', 3),
             Padding(4),
             #LSB
         ))),
         Padding(4), #unknown
 
-        Value('height', lambda ctx: 8 << ctx.height),
-        Value('width', lambda ctx: 8 << ctx.width),
+        Value('height', lambda ctx: 8 << ctx.height_shift),
+        Value('width', lambda ctx: 8 << ctx.width_shift),
         Value('size', lambda ctx: ctx.width * ctx.height * bpp[ctx.format] // 8),
 
+        # 4x4-texel compressed textures keep their texels in a separate area
         OnDemandPointer(
-            lambda ctx: ctx._._.start + ctx._._.texture_data_ptr + ctx.offset,
+            lambda ctx: ctx._._.start + ctx.offset + (
+                ctx._._.sp_texture_ptr if ctx.format == 5
+                else ctx._._.texture_data_ptr),
             MetaField('data', lambda ctx: ctx.size)
         ),
+        # ...and a palette index for each block in another area, at half the
+        # offset; there are 16 bits of these per 16 texels
+        OnDemandPointer(
+            lambda ctx: ctx._._.start + ctx._._.sp_data_ptr + ctx.offset // 2,
+            MetaField('palette_index',
+                lambda ctx: ctx.width * ctx.height // 8
+                            if ctx.format == 5 else 0)
+        ),
     )),
     #Array(lambda ctx: ctx.header.count,),
 
@@ -94,7 +120,7 @@ palette_def_struct = Struct('palette',
 tex0_struct = Struct('tex0',
     Anchor("start"),
 
-    Const(Bytes('magic', 4), 'TEX0'),
+    Const(Bytes('magic', 4), b'TEX0'),
     ULInt32('length'),
     Padding(4), #Const(ULInt32('padding'), 0),
     TimesEight(ULInt16('texture_data_length')),
@@ -122,58 +148,83 @@ tex0_struct = Struct('tex0',
     #OnDemandPointer(lambda ctx: ctx.texture_data_ptr, )
 )
 
-btx0_struct = Struct('btx0',
-    Const(Bytes('magic', 4), 'BTX0'),
-    Const(Bytes('bom', 2), '\xff\xfe'),
-    Bytes('something', 2),
-    ULInt32('length'),
-    Const(ULInt16('header_length'), 0x10),
-    ULInt16('count'),
-
-    Array(lambda ctx: ctx.count, Struct('blocks',
-        ULInt32('offset'),
-        OnDemandPointer(lambda ctx: ctx.offset, tex0_struct),
-    )),
-)
-
 __metaclass__ = type
 
 Size = namedtuple('Size', 'width height')
 
 class NSBTX:
+    @stats.staged('parse textures')
     def __init__(self, chunk):
-       self.btx0 = btx0_struct.parse(chunk)
-       self.blocks = [TextureBlock(b.tex0.value) for b in self.btx0.blocks]
+        self.nitro = NitroFile(chunk)
+        self.blocks = [TextureBlock(tex0_struct.parse(self.nitro.section(i)))
+                       for i, section in enumerate(self.nitro.sections)
+                       if section.magic == b'TEX0']
 
+@bytes_compatible
 class TextureBlock:
+    """A block of textures and palettes from a TEX0.
+
+    Textures and palettes are only built when they're first asked for, and
+    are kept around after that, so each texture is only ever decoded once.
+    """
+
     def __init__(self, tex0):
         self.tex0 = tex0
         
         self.texture_count = tex0.texture.header.count
         self.palette_count = tex0.palette.header.count
 
-        self.textures = [Texture(t, t.data) for t in tex0.texture.info]
-        self.palettes = [Palette(tex0.palette.data[offset:])
-                         for offset in tex0.palette.offsets]
+        self._textures = [None] * self.texture_count
+        self._palettes = None
+        self._atlas = None
 
-        for t, name in zip(self.textures, tex0.texture.names):
-            t.name = name
+        names = self._names = [native_str(name)
+                                for name in tex0.texture.names]
+        self._texture_ids = dict((name, i) for i, name in enumerate(names))
+
+        self.name = None
+        if names and '.' in names[-1]:
+            self.name = names[-1].split('.', 1)[0]
+
+    @property
+    def textures(self):
+        return [self.get_texture(i) for i in range(self.texture_count)]
 
-        if '.' in name:
-            self.name = name.split('.', 1)[0]
+    @property
+    def palettes(self):
+        if self._palettes is None:
+            self._palettes = [Palette(self.tex0.palette.data[offset:])
+                              for offset in self.tex0.palette.offsets]
+        return self._palettes
 
     def get_texture(self, value):
         if hasattr(value, '__index__'):
             value = value.__index__()
         else:
             #filename
-            value = self.tex0.texture.names.index(value)
-        return Texture(self.tex0.texture.info[value],
-                       self.tex0.texture.info[value].data)
+            try:
+                value = self._texture_ids[value]
+            except KeyError:
+                raise ValueError("No texture named %r" % (value,))
+
+        texture = self._textures[value]
+        if texture is None:
+            info = self.tex0.texture.info[value]
+            texture = Texture(info, info.data, info.palette_index)
+            texture.name = self._names[value]
+            self._textures[value] = texture
+
+        return texture
 
     __getitem__ = get_texture
 
-    def image(self, palette=None):
+    def _atlas_layout(self):
+        """Works out how to arrange the textures in a single image.
+
+        Returns (textures, size, width, height): the textures in the order to
+        draw them, the size of each, and the number of textures across and
+        down.
+        """
         if self.texture_count <= 4:
             width = self.texture_count
             height = 1
@@ -187,162 +238,350 @@ class TextureBlock:
                 height += 4
                 width = self.texture_count // height
 
-        # XXX i'm assuming that all the textures are the same size
-        size = self.textures[0].size
-        #flag = False
-        #for t in self.textures:
-        #    if t.size != size:
-        #        print size
-        #        flag = True
-        #if flag:
-        #    return None
-        
-        textures = self.textures[:]
+        textures = self.textures
         if '.' in textures[0].name:
             try:
                 textures.sort(key=(lambda x: int(x.name.split('.')[1])))
             except ValueError:
                 pass
 
+        # XXX i'm assuming that all the textures are the same size
+        size = textures[0].size
+
+        # Anything that doesn't fit is dropped
+        return textures[:width * height], size, width, height
+
+    def _atlas_pixels(self):
+        """Returns the palette indices for the whole atlas, if it can be drawn
+        as one paletted image, along with the layout.  Otherwise, the pixels
+        are None.
+
+        The indices are built with a single gather from all the textures'
+        pixels, and are kept, so each palette only costs a palette swap.
+        """
+        if self._atlas is not None:
+            return self._atlas
+
+        textures, size, width, height = layout = self._atlas_layout()
+
+        # Only possible when every texture has plain palette indices, they're
+        # all the same size, and they agree on transparency
+        if any(t.format not in (2, 3, 4) or t.size != size
+               or bool(t.info.color0) != bool(textures[0].info.color0)
+               for t in textures):
+            self._atlas = None, layout
+            return self._atlas
+
+        # The grid never has more spaces than there are textures, so every
+        # atlas pixel comes from somewhere in the textures laid end to end
+        area = size.width * size.height
+        source = bytearray().join(t.pixels for t in textures)
+
+        order = array('I')
+        for y in range(size.height * height):
+            row, y_in = divmod(y, size.height)
+            for col in range(width):
+                start = (row * width + col) * area + y_in * size.width
+                order.extend(range(start, start + size.width))
+
+        self._atlas = bytearray(itemgetter(*order)(source)), layout
+        return self._atlas
+
+    def image(self, palette=None):
         if palette is None:
             palette = self.palettes[0]
 
-        bigimg = Image.new(mode="RGBA", size=(size.width*width, size.height*height))
+        atlas, (textures, size, width, height) = self._atlas_pixels()
+        atlas_size = (size.width * width, size.height * height)
+
+        if atlas is not None:
+            colors = palette.colors_for(textures[0].format)
+
+            img = Image.frombuffer('P', atlas_size, atlas, 'raw', 'P', 0, 1)
+            img.putpalette([channel for color in colors
+                                    for channel in color])
+            if textures[0].info.color0:
+                img.info['transparency'] = 0
+            return img
+
+        # Otherwise, fall back to pasting the textures in one at a time
+        bigimg = Image.new(mode="RGBA", size=atlas_size)
 
         for t, (x, y) in zip(textures, 
-                             ((x, y) for y in xrange(height)
-                                       for x in xrange(width))):
+                             ((x, y) for y in range(height)
+                                       for x in range(width))):
             point = (x * size.width, y * size.height)
-            img = t.image(palette)
+            img = t.image(palette).convert('RGBA')
             bigimg.paste(img, point)
 
         return bigimg
 
 
-    def png(self, palette=None):
-        img = self.image(palette)
+    def png(self, palette=None, encoder=default_encoder):
+        return encoder.encode(self.image(palette))
 
-        buffer = StringIO()
-        img.save(buffer, 'PNG')
-        return buffer.getvalue()
 
-
-    def __str__(self):
+    def __bytes__(self):
         return self.png()
         
+def gray_colors(count):
+    """Returns `count` shades of gray, from white to black, to stand in for a
+    palette."""
+    return [(sat, sat, sat)
+            for sat in ((count - 1 - _) * 255 // (count - 1) for _ in range(count))]
+
+def _translation(func):
+    """Returns a bytes.translate table applying `func` to each byte."""
+    return byte_table(func(n) for n in range(256))
+
+# Formats 1 and 6 pack a palette index and an alpha value into each byte
+_a3i5_indices = _translation(lambda n: n & 0x1f)
+_a3i5_alpha = _translation(lambda n: (((n >> 5) << 2) | (n >> 6)) * 255 // 31)
+_a5i3_indices = _translation(lambda n: n & 0x07)
+_a5i3_alpha = _translation(lambda n: (n >> 3) * 255 // 31)
+
+# For 4x4-texel compressed textures: each pixel's block number times four, in
+# row-major order, keyed by size
+_block_bases = {}
+
+@bytes_compatible
 class Texture:
-    def __init__(self, info, data):
+    """A single texture.
+
+    Formats 1 through 4 and 6 have palette indices, available from `pixels`,
+    and formats 1 and 6 additionally have `alpha`.  Format 5 (4x4-texel
+    compressed) and 7 (direct color) can only be turned into images.
+    """
+
+    def __init__(self, info, data, palette_index=None):
         self.info = info
         self.data = data
+        self.palette_index = palette_index
         self.format = info.format
         self.size = Size(info.width, info.height)
         self._pixels = None
+        self._alpha = None
 
-    @property
-    def pixels(self):
-        if self._pixels is not None:
-            return self._pixels
-        # [width][height]
-        self._pixels = [[0] * self.size.height for _ in range(self.size.width)]
+    @stats.staged('decode texture')
+    def _decode(self):
+        """Splits the texture data into palette indices and alpha, in one pass
+        per format.
+        """
         pixdata = self.data.value
         format = self.format
-        # XXX do the rest of the formats
-        if format == 3:
-            # 16-color palette
-            it = word_iterator(pixdata, 4)
-            for y in range(self.info.height):
-                for x in range(self.info.width):
-                    pix = it.next()
-                    self._pixels[x][y] = pix
-        elif format == 5:
-            # XXX do it
-            raise NotImplementedError
+        if format in (2, 3, 4):
+            # 4-, 16-, and 256-color palettes
+            layout = tile_layout(self.size.width, self.size.height,
+                                 bit_depth=bpp[format])
+            self._pixels = layout.untile(pixdata)
+        elif format == 1:
+            # A3I5: 32 colors and 3 bits of alpha
+            self._pixels = bytearray(pixdata.translate(_a3i5_indices))
+            self._alpha = pixdata.translate(_a3i5_alpha)
+        elif format == 6:
+            # A5I3: 8 colors and 5 bits of alpha
+            self._pixels = bytearray(pixdata.translate(_a5i3_indices))
+            self._alpha = pixdata.translate(_a5i3_alpha)
         else:
-            raise NotImplementedError
+            raise ValueError(
+                "Format %d textures don't have palette indices" % format)
+        stats.count('textures decoded')
 
+    @property
+    def pixels(self):
+        """Palette indices, one byte per pixel, in row-major order."""
+        if self._pixels is None:
+            self._decode()
         return self._pixels
 
+    @property
+    def alpha(self):
+        """Alpha values, 0 to 255, one byte per pixel, for formats 1 and 6.
+        None for other formats.
+        """
+        if self._pixels is None:
+            self._decode()
+        return self._alpha
+
 
+    @stats.staged('build image')
     def image(self, palette=None):
-        img = Image.new(mode='RGBA', size=self.size, color=None)
+        """Returns this texture as a PIL image.
+
+        Textures with only palette indices come out paletted, and the image
+        shares memory with `pixels`, so each extra palette only costs a
+        palette swap.  Textures with alpha, or without indices, come out as
+        RGBA.
+        """
+        format = self.format
+        if format == 7:
+            # Direct color: A1 B5 G5 R5, which PIL knows how to read
+            return Image.frombytes('RGBA', self.size, self.data.value,
+                                   'raw', 'RGBA;15')
 
         if palette:
-            if palette.format is None:
-                palette.format = self.format
-            colors = palette.colors
+            colors = palette.colors_for(format)
         else:
-            colors = [(sat, sat, sat) for sat in ((15 - _) * 255 / 15 for _ in range(16))]
+            colors = gray_colors(palette_sizes[format] or 256)
 
-        colors = [color + (255,) for color in colors]
-        if self.info.color0:
-            colors[0] = colors[0][:3] + (0,)
+        if format == 5:
+            return self._compressed_image(colors)
 
-        data = img.load()
-        for x in xrange(self.info.width):
-            for y in xrange(self.info.height):
-                data[x, y] = colors[self.pixels[x][y]]
+        img = Image.frombuffer('P', self.size, self.pixels, 'raw', 'P', 0, 1)
+        img.putpalette([channel for color in colors for channel in color])
 
-        return img
-
-    def png(self, palette=None):
-        img = self.image(palette)
+        if self.alpha is not None:
+            img = img.convert('RGB')
+            img.putalpha(Image.frombuffer('L', self.size, self.alpha,
+                                          'raw', 'L', 0, 1))
+        elif self.info.color0:
+            img.info['transparency'] = 0
 
-        buffer = StringIO()
-        img.save(buffer, 'PNG')
-        return buffer.getvalue()
+        return img
 
-    def __str__(self):
+    def _compressed_image(self, colors):
+        """Decodes a 4x4-texel compressed texture.
+
+        Each 4x4 block has 2 bits per texel, choosing one of four colors.
+        Those four are picked per block by its palette index data: an offset
+        into the palette, and a mode saying which colors are taken from the
+        palette, which are blended from the first two, and which are
+        transparent.  So the four colors of every block are worked out first,
+        and then every texel is looked up in that list at once.
+        """
+        width, height = self.size
+        layout = tile_layout(width, height, tile_size=4, bit_depth=2)
+        codes = layout.untile(self.data.value)
+
+        transparent = b'\x00\x00\x00\x00'
+        pack = lambda c: struct.pack('4B', c[0], c[1], c[2], 255)
+
+        def blend(c0, w0, c1, w1):
+            return pack(tuple((a * w0 + b * w1) // (w0 + w1)
+                              for a, b in zip(c0, c1)))
+
+        entries = unpack_words(self.palette_index.value, 16)
+
+        def color(i):
+            # Blocks can point anywhere in the palette data; anything past the
+            # end is black
+            if i < len(colors):
+                return colors[i]
+            return (0, 0, 0)
+
+        def block_quad(entry):
+            base = (entry & 0x3fff) * 2
+            mode = entry >> 14
+            c0 = color(base)
+            c1 = color(base + 1)
+            if mode == 0:
+                c2, c3 = pack(color(base + 2)), transparent
+            elif mode == 1:
+                c2, c3 = blend(c0, 1, c1, 1), transparent
+            elif mode == 2:
+                c2, c3 = pack(color(base + 2)), pack(color(base + 3))
+            else:
+                c2, c3 = blend(c0, 5, c1, 3), blend(c0, 3, c1, 5)
+            return pack(c0), pack(c1), c2, c3
+
+        # Neighboring blocks tend to share palette index entries, so only work
+        # out each entry once
+        quads = {}
+        block_colors = []
+        for entry in entries:
+            quad = quads.get(entry)
+            if quad is None:
+                quad = quads[entry] = block_quad(entry)
+            block_colors.extend(quad)
+
+        # Missing blocks are transparent
+        block_count = layout.pixel_count // 16
+        block_colors.extend([transparent] * (4 * block_count - len(block_colors)))
+
+        # Each texel's index in block_colors is its block number times four,
+        # plus its code.  The low two bits of the former are always zero, so
+        # XOR does the addition
+        bases = _block_bases.get(self.size)
+        if bases is None:
+            bases = array('I', (n * 4 for n in layout.tile_numbers))
+            _block_bases[self.size] = bases
+        itemsize = bases.itemsize
+        spread_codes = bytearray(len(codes) * itemsize)
+        low_byte = 0 if sys.byteorder == 'little' else itemsize - 1
+        spread_codes[low_byte::itemsize] = codes
+
+        indices = array('I')
+        array_frombytes(indices,
+                        xor_bytes(tobytes(bases), bytes(spread_codes)))
+
+        data = b''.join(itemgetter(*indices)(block_colors))
+        return Image.frombuffer('RGBA', self.size, data, 'raw', 'RGBA', 0, 1)
+
+    def png(self, palette=None, encoder=default_encoder):
+        return encoder.encode(self.image(palette))
+
+    def __bytes__(self):
         return self.png()
         
 # http://nocash.emubase.de/gbatek.htm#ds3dtextureformats
+@bytes_compatible
 class Palette:
+    """A texture palette.
+
+    Palettes don't say how many colors they have; that depends on the format
+    of the texture using them.  So `colors` is only filled in once `format`
+    is set, and is replaced whenever it changes.  It may be shared with other
+    palettes, so don't change it.
+
+    Textures of different formats can share a palette, so they ask for
+    `colors_for` their own format instead, which leaves `format` alone.
+    """
+
     def __init__(self, data, format=None):
-        self.format = format
         self.data = data
+        self._format = None
 
-        self.colors = []
+        self.colors = ()
+        self.format = format
 
 
     def set_format(self, format):
         if format is None:
             self._format = None
-        elif format == self._format:
-            pass
-        elif format == 5:
-            # XXX do it
-            raise NotImplementedError
-        elif format == 7:
-            #direct color texture -- no palette
-            raise ValueError
-        else:
+        elif format != self._format:
+            self.colors = self.colors_for(format)
             self._format = format
-            size = 1 << bpp[format]
-            for _, w in zip(range(size), word_iterator(self.data, 16)):
-                r = (w & 0x1f) * 255 // 31
-                g = ((w >> 5) & 0x1f) * 255 // 31
-                b = ((w >> 10) & 0x1f) * 255 // 31
-                self.colors.append((r, g, b))
 
     def get_format(self):
         return self._format
 
     format = property(get_format, set_format)
+
+    def colors_for(self, format):
+        """Returns the colors this palette has for a texture of the given
+        format.
+        """
+        if format == 7:
+            #direct color texture -- no palette
+            raise ValueError
+        size = palette_sizes[format] or len(self.data) // 2
+        return decode_palette(self.data[:size * 2])
             
-    def png(self):
-        """Returns a PNG illustrating the colors in this palette."""
+    def image(self):
+        """Returns a PIL image illustrating the colors in this palette."""
 
         img = Image.new(mode='RGB', size=(len(self.colors), 1), color=None)
 
         for i, color in enumerate(self.colors):
             img.putpixel((i, 0), color)
 
-        img = img.resize((8 * len(self.colors), 8))
+        return img.resize((8 * len(self.colors), 8))
 
-        buffer = StringIO()
-        img.save(buffer, 'PNG')
-        return buffer.getvalue()
+    def png(self, encoder=default_encoder):
+        """Returns a PNG illustrating the colors in this palette."""
+        return encoder.encode(self.image())
 
-    def __str__(self):
+    def __bytes__(self):
         """Returns this palette as a PNG."""
         return self.png()
 
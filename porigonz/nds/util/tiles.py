@@ -0,0 +1,111 @@
+# encoding: utf8
+"""Converting between tiled DS graphics data and plain rows of pixels.
+
+DS 2D graphics are usually stored as square tiles (8×8, say), each filled
+before the next begins, with tiles running left to right and then top to
+bottom.  Rather than work out where every pixel goes every time, a
+`TileLayout` works out the whole mapping once for a given size; untiling an
+image is then a single gather.  Layouts are cached, so get them with
+`tile_layout`.
+"""
+
+from array import array
+from operator import itemgetter
+
+from porigonz.compat import range
+from porigonz.nds.util import pack_bits, unpack_words
+
+class TileLayout(object):
+    """The arrangement of pixels in an image of a particular size, tile size,
+    and bit depth.
+
+    `order` is an array mapping each pixel, in row-major order, to its index
+    in the tiled data.  If `tile_size` is None, the image isn't tiled at all
+    and `order` is None too.
+    """
+
+    def __init__(self, width, height, tile_size=None, bit_depth=4):
+        if bit_depth not in (1, 2, 4, 8):
+            raise ValueError("Can't handle %d-bit pixels" % bit_depth)
+
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.bit_depth = bit_depth
+        self.pixel_count = width * height
+
+        if tile_size is None:
+            self.order = None
+            return
+
+        tiles_across = width // tile_size
+        tile_area = tile_size ** 2
+        order = array('I')
+        for y in range(height):
+            # coordinates of the tile; 0,0 is first tile, 1,0 is second, etc
+            tile_y, y_in_tile = divmod(y, tile_size)
+            for x in range(width):
+                tile_x, x_in_tile = divmod(x, tile_size)
+                tile_no = tile_y * tiles_across + tile_x
+                order.append(tile_no * tile_area
+                             + y_in_tile * tile_size + x_in_tile)
+        self.order = order
+
+        # The actual gathering is done by itemgetter, in C
+        self._untiler = itemgetter(*order)
+
+        inverse = array('I', order)
+        for i, idx in enumerate(order):
+            inverse[idx] = i
+        self._tiler = itemgetter(*inverse)
+
+    @property
+    def tile_numbers(self):
+        """An array giving the number of the tile each pixel, in row-major
+        order, belongs to.
+        """
+        if self.order is None:
+            raise TypeError("Image isn't tiled")
+
+        tile_area = self.tile_size ** 2
+        return array('I', (idx // tile_area for idx in self.order))
+
+    def _fit(self, pixels):
+        """Pads or truncates a bytearray of pixels to the size of the image."""
+        missing = self.pixel_count - len(pixels)
+        if missing > 0:
+            pixels.extend(bytearray(missing))
+        elif missing < 0:
+            del pixels[self.pixel_count:]
+        return pixels
+
+    def untile(self, data):
+        """Converts raw tiled data to a bytearray of pixels, one byte each, in
+        row-major order.  Missing data is treated as zeroes.
+        """
+        pixels = self._fit(unpack_words(data, self.bit_depth))
+
+        if self.order is None:
+            return pixels
+        return bytearray(self._untiler(pixels))
+
+    def tile(self, pixels):
+        """The reverse of `untile`: converts row-major pixels back to raw tiled
+        data, as bytes.
+        """
+        pixels = self._fit(bytearray(pixels))
+        if self.order is not None:
+            pixels = bytearray(self._tiler(pixels))
+
+        return pack_bits(pixels, self.bit_depth)
+
+
+_layouts = {}
+
+def tile_layout(width, height, tile_size=None, bit_depth=4):
+    """Returns the (cached) `TileLayout` for the given dimensions."""
+    key = width, height, tile_size, bit_depth
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = _layouts[key] = TileLayout(*key)
+    return layout
@@ -0,0 +1,143 @@
+# encoding: utf8
+"""Checking the CRCs stored in a DS image.
+
+A DS image carries several CRC-16s: one for the header, one for the Nintendo
+logo (which is always the same), one for the banner, and one for the secure
+area at the start of the ARM9 binary.  Anything that patches an image has to
+keep them right, so this checks all of them, for any number of images at once.
+"""
+
+from collections import namedtuple
+from multiprocessing import Pool
+import os
+import time
+
+from porigonz.nds import DSImage
+from porigonz.nds.util import crc16
+
+# What each CRC covers, and where the banner's own CRC starts
+HEADER_CRC_LENGTH = 0x15e
+LOGO_OFFSET = 0xc0
+LOGO_LENGTH = 0x9c
+LOGO_CRC = 0xcf56
+BANNER_CRC_START = 0x20
+BANNER_CRC_END = 0x840
+SECURE_AREA_START = 0x4000
+SECURE_AREA_END = 0x8000
+
+class Check(namedtuple('Check', 'name expected actual')):
+    """The result of checking one CRC.  `actual` is None if there was
+    nothing to check.
+    """
+
+    @property
+    def status(self):
+        if self.actual is None:
+            return 'skipped'
+        elif self.expected == self.actual:
+            return 'ok'
+        else:
+            return 'bad'
+
+    @property
+    def ok(self):
+        return self.status != 'bad'
+
+
+def verify_image(image):
+    """Checks every CRC in `image`, returning a list of `Check`s."""
+    header = image.header
+    f = image._file
+
+    f.seek(0)
+    header_data = f.read(HEADER_CRC_LENGTH)
+
+    checks = [
+        Check('header', header.header_crc16, crc16(header_data)),
+        Check('logo', LOGO_CRC, header.logo_crc16),
+        Check('logo-data', header.logo_crc16,
+              crc16(header_data[LOGO_OFFSET:LOGO_OFFSET + LOGO_LENGTH])),
+    ]
+
+    if header.banner_offset:
+        f.seek(header.banner_offset + BANNER_CRC_START)
+        banner_data = f.read(BANNER_CRC_END - BANNER_CRC_START)
+        checks.append(Check('banner', image.banner.crc16, crc16(banner_data)))
+    else:
+        checks.append(Check('banner', None, None))
+
+    # Only images with the ARM9 binary inside the secure area have one, and
+    # the CRC is of the encrypted data; a dump with a decrypted secure area
+    # will fail this
+    if SECURE_AREA_START <= header.arm9_source < SECURE_AREA_END:
+        f.seek(SECURE_AREA_START)
+        secure_data = f.read(SECURE_AREA_END - SECURE_AREA_START)
+        checks.append(Check('secure-area', header.crc16, crc16(secure_data)))
+    else:
+        checks.append(Check('secure-area', None, None))
+
+    return checks
+
+def _checked_bytes(image):
+    """Returns roughly how many bytes `verify_image` reads from `image`."""
+    total = HEADER_CRC_LENGTH
+    if image.header.banner_offset:
+        total += BANNER_CRC_END - BANNER_CRC_START
+    if SECURE_AREA_START <= image.header.arm9_source < SECURE_AREA_END:
+        total += SECURE_AREA_END - SECURE_AREA_START
+    return total
+
+def verify_file(filename):
+    """Checks the image in `filename`.  Returns (filename, checks, bytes
+    read), or (filename, None, error message) if it can't even be opened.
+    """
+    try:
+        image = DSImage(filename)
+    except Exception as e:
+        return filename, None, str(e) or e.__class__.__name__
+
+    try:
+        return filename, verify_image(image), _checked_bytes(image)
+    finally:
+        image._file.close()
+
+def verify_files(filenames, workers=None):
+    """Yields the result of `verify_file` for each of `filenames`, in order,
+    checking them across a pool of `workers` processes.
+    """
+    if len(filenames) <= 1:
+        for filename in filenames:
+            yield verify_file(filename)
+        return
+
+    pool = Pool(workers)
+    try:
+        for result in pool.imap(verify_file, filenames, chunksize=4):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Throughput(object):
+    """Keeps count of how much has been verified, and how fast."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.images = 0
+        self.checked_bytes = 0
+        self.image_bytes = 0
+
+    def add(self, filename, checked_bytes):
+        self.images += 1
+        self.checked_bytes += checked_bytes
+        self.image_bytes += os.path.getsize(filename)
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        return ("%d images (%.1f MB) in %.2fs: %.1f images/s, "
+                "%.1f MB of checksummed data/s" % (
+            self.images, self.image_bytes / 1048576.0, elapsed,
+            self.images / elapsed,
+            self.checked_bytes / 1048576.0 / elapsed,
+        ))
@@ -0,0 +1,491 @@
+# encoding: utf8
+u"""Building synthetic DS images.
+
+Real game images can't be shipped around, so benchmarks and checks run on fake
+ones instead: random contents, but laid out the way the real thing is, and
+valid as far as porigon-z is concerned.  Wherever there's a struct for
+something, it's built with the same struct used to parse it.
+
+`pokemon_image` builds a whole image that looks a bit like a Pokémon game:
+
+    from porigonz.synthetic import write_pokemon_image
+    write_pokemon_image('fake.nds', seed=0)
+"""
+
+from binascii import unhexlify
+import random
+import struct
+
+from construct import Container
+
+from porigonz.compat import range, text_type
+from porigonz.nds import (banner_struct, fat_struct, filename_list_struct,
+    narc_fatb_struct, narc_fntb_struct, nds_image_struct)
+from porigonz.nds.nitro import nitro_header_struct, section_header
+from porigonz.nds.records import layouts
+from porigonz.nds.util import cap_to_bits, crc16
+from porigonz.nds.util.sprites import (nclr_struct, rahc_struct, rgcn_struct,
+    ttlp_struct, pokemon_encrypt)
+from porigonz.nds.util.text import pokemon_encrypted_text_struct
+from porigonz.nds.util.texture import bpp, block_header
+
+def random_bytes(rng, length):
+    """Returns `length` random bytes from the `random.Random` `rng`."""
+    if not length:
+        return b''
+    return unhexlify('%0*x' % (length * 2, rng.getrandbits(length * 8)))
+
+def align(data, alignment, padding=b'\x00'):
+    """Pads `data` out to a multiple of `alignment` bytes."""
+    return data + padding * (-len(data) % alignment)
+
+
+### Nitro files
+
+def make_nitro(magic, sections, bom=0xfeff, version=0x0100):
+    """Builds a Nitro file from a list of (magic, data) sections, packed end
+    to end.
+    """
+    body = b''.join(section_header.pack(section_magic, len(data) + 8) + data
+                   for section_magic, data in sections)
+    header = nitro_header_struct.build(Container(
+        magic=magic,
+        bom=bom,
+        version=version,
+        file_size=16 + len(body),
+        header_length=16,
+        num_sections=len(sections),
+    ))
+    return header + body
+
+def make_narc(members):
+    """Builds a NARC from a list of byte strings, without filenames."""
+    records = []
+    fimg = []
+    pos = 0
+    for member in members:
+        records.append(Container(start=pos, end=pos + len(member)))
+        member = align(member, 4, b'\xff')
+        fimg.append(member)
+        pos += len(member)
+
+    fatb = narc_fatb_struct.build(Container(
+        num_records=len(members),
+        records=records,
+    ))
+    fntb = narc_fntb_struct.build(Container(
+        unknown1=4,
+        unknown2=0x10000,
+        filenames=[],
+    ))
+    return make_nitro(b'NARC', [
+        (b'BTAF', fatb),
+        (b'BTNF', fntb),
+        (b'GMIF', b''.join(fimg)),
+    ])
+
+
+### Sprites and palettes
+
+def make_rgcn(data):
+    """Wraps some raw pixel data in an RGCN/RAHC sprite chunk."""
+    rahc = rahc_struct.build(Container(
+        magic=b'RAHC',
+        header_length=0x20,
+        length=Container(length=len(data)),
+        num_pixels=len(data) * 2 // 64,
+        pixel_size=0x20,
+        bit_depth=3,
+        padding=0,
+        data_size=len(data),
+        unknown1=0x18,
+        data=data,
+    ))
+    return rgcn_struct.build(Container(
+        magic=b'RGCN',
+        bom=b'\xff\xfe\x00\x01',
+        length=0x10 + len(rahc),
+        header_length=0x10,
+        num_sections=1,
+        data=rahc,
+    ))
+
+def make_rlcn(data):
+    """Wraps 16 colors of raw BGR555 palette data in an RLCN/TTLP chunk."""
+    ttlp = ttlp_struct.build(Container(
+        magic=b'TTLP',
+        length=0x18 + len(data),
+        bit_depth=3,
+        padding=0,
+        data_length=len(data),
+        num_colors=len(data) // 2,
+        data=data,
+    ))
+    return nclr_struct.build(Container(
+        magic=b'RLCN',
+        bom=b'\xff\xfe\x00\x01',
+        length=0x10 + len(ttlp),
+        header_length=0x10,
+        num_sections=1,
+        data=ttlp,
+    ))
+
+def make_pokemon_sprite(rng):
+    """Builds an encrypted Pokémon sprite of random pixels."""
+    # rahc_struct only ever reads this much
+    data = random_bytes(rng, 2048)
+    return make_rgcn(pokemon_encrypt(data, rng.getrandbits(16)))
+
+
+### Text
+
+# Digits and letters, plus spaces
+_text_characters = list(range(0x0121, 0x0151)) + [0x01de] * 8
+_text_terminator = 0xffff
+
+def make_text_bank(strings, key):
+    u"""Builds an encrypted bank of Pokémon text from a list of strings, each
+    a list of character codes.  The reverse of `PokemonTextBank`.
+    """
+    header_key = cap_to_bits(key * 0x02fd, 16)
+    headers = []
+    body = []
+    offset = 4 + 8 * len(strings)
+    for i, chars in enumerate(strings):
+        string_key = cap_to_bits(header_key * (i + 1), 16)
+        string_key = string_key | (string_key << 16)
+        headers.append(Container(
+            offset=offset ^ string_key,
+            length=len(chars) ^ string_key,
+        ))
+
+        char_key = ((i + 1) * 0x91bd3) & 0xffff
+        encrypted = []
+        for char in chars:
+            encrypted.append(char ^ char_key)
+            char_key = (char_key + 0x493d) & 0xffff
+        body.append(struct.pack('<%dH' % len(encrypted), *encrypted))
+        offset += len(chars) * 2
+
+    header = pokemon_encrypted_text_struct.build(Container(
+        count=len(strings),
+        key=key,
+        header=headers,
+    ))
+    return header + b''.join(body)
+
+def random_text_bank(rng, count, max_length=40):
+    """Builds a text bank of `count` random strings."""
+    strings = []
+    for _ in range(count):
+        length = rng.randint(1, max_length)
+        chars = [rng.choice(_text_characters) for _ in range(length)]
+        strings.append(chars + [_text_terminator])
+    return make_text_bank(strings, rng.getrandbits(16))
+
+
+### Textures
+
+def make_btx0(textures, palettes):
+    """Builds a BTX0 from a list of textures, each (name, format, width,
+    height, color0, data), and palettes, each (name, data).  Widths and
+    heights are the logarithms the TEX0 stores: the size is 8 << n.  Format 5
+    texture data is a pair of (texels, palette index data).
+    """
+    texture_data = b''
+    sp_texture_data = b''
+    sp_index_data = b''
+    infos = []
+    for name, format, width, height, color0, data in textures:
+        if format == 5:
+            offset = len(sp_texture_data)
+            sp_texture_data = align(sp_texture_data + data[0], 8)
+            sp_index_data = align(sp_index_data + data[1], 4)
+        else:
+            offset = len(texture_data)
+            texture_data = align(texture_data + data, 8)
+        params = (color0 << 13) | (format << 10) | (height << 7) | (width << 4)
+        infos.append(struct.pack('<HHI', offset // 8, params, 0))
+
+    palette_data = b''
+    palette_offsets = []
+    for name, data in palettes:
+        palette_offsets.append(len(palette_data) // 8)
+        palette_data = align(palette_data + data, 8)
+
+    def names(things):
+        return b''.join(thing[0].encode('ascii').ljust(16, b'\x00')
+                        for thing in things)
+
+    def definition(count, entry_size, entries, names):
+        header = block_header.build(Container(
+            count=count,
+            block_length=0,
+            header_length=12 + 4 * count,
+            unknown0=[0] * count,
+        ))
+        return (header + struct.pack('<HH', entry_size, 4 + entry_size * count)
+                + b''.join(entries) + names)
+
+    texture_def = definition(len(textures), 8, infos, names(textures))
+    palette_def = definition(
+        len(palettes), 4,
+        [struct.pack('<I', offset) for offset in palette_offsets],
+        names(palettes))
+
+    # Everything after the TEX0 header, with pointers relative to its start
+    texture_def_ptr = 0x3c
+    palette_def_ptr = texture_def_ptr + len(texture_def)
+    texture_data_ptr = palette_def_ptr + len(palette_def)
+    texture_data_ptr += -texture_data_ptr % 8
+    sp_texture_ptr = texture_data_ptr + len(texture_data)
+    sp_data_ptr = sp_texture_ptr + len(sp_texture_data)
+    palette_data_ptr = sp_data_ptr + len(sp_index_data)
+    palette_data_ptr += -palette_data_ptr % 8
+    sp_index_data = sp_index_data.ljust(palette_data_ptr - sp_data_ptr, b'\x00')
+    length = palette_data_ptr + len(palette_data)
+
+    # The layout of `tex0_struct`, which has too many pointers to build
+    header = (
+        b'TEX0' + struct.pack('<I4x', length)
+        + struct.pack('<HH4xI4x', len(texture_data) // 8, 0x3c,
+                      texture_data_ptr)
+        + struct.pack('<HH4xII4x', len(sp_texture_data) // 8, 0x3c,
+                      sp_texture_ptr, sp_data_ptr)
+        + struct.pack('<H2xII', len(palette_data) // 8,
+                      palette_def_ptr, palette_data_ptr)
+    )
+    tex0 = align(header + texture_def + palette_def, 8)
+    tex0 += texture_data + sp_texture_data + sp_index_data + palette_data
+
+    # 3D files list their sections' offsets after the header, rather than
+    # packing them end to end
+    header = nitro_header_struct.build(Container(
+        magic=b'BTX0',
+        bom=0xfeff,
+        version=0x0001,
+        file_size=0x14 + len(tex0),
+        header_length=0x10,
+        num_sections=1,
+    ))
+    return header + struct.pack('<I', 0x14) + tex0
+
+def random_btx0(rng, count=8, formats=(2, 3, 4), size=(3, 3)):
+    """Builds a BTX0 of `count` random textures, cycling through `formats`,
+    with a few palettes to go with them.
+    """
+    width, height = size
+    textures = []
+    for i in range(count):
+        format = formats[i % len(formats)]
+        length = (8 << width) * (8 << height) * bpp[format] // 8
+        if format == 5:
+            data = random_bytes(rng, length), random_bytes(rng, length // 2)
+        else:
+            data = random_bytes(rng, length)
+        textures.append(('tex.%d' % i, format, width, height, i % 2, data))
+
+    palettes = [('pal%d' % i, random_bytes(rng, 512)) for i in range(3)]
+    return make_btx0(textures, palettes)
+
+### Images
+
+HEADER_LENGTH = 0x4000
+
+# Not Nintendo's logo, which can't be shipped around either, but blank apart
+# from the last two bytes, which give it the same CRC: 0xcf56
+LOGO = b'\x00' * 154 + b'\x04\x68'
+
+def _filename_table(paths):
+    """Builds a filename table for a list of paths, returning it along with
+    the file id each path ends up with.
+    """
+    # Directories are numbered in the order they're first seen, and each
+    # directory's files get consecutive ids
+    directories = {'': []}
+    order = ['']
+    for path in paths:
+        parts = path.split('/')
+        for depth in range(1, len(parts)):
+            directory = '/'.join(parts[:depth])
+            if directory not in directories:
+                directories[directory] = []
+                order.append(directory)
+                directories['/'.join(parts[:depth - 1])].append(
+                    (parts[depth - 1], True))
+        directories['/'.join(parts[:-1])].append((parts[-1], False))
+
+    directory_ids = dict((directory, 0xf000 + n)
+                         for n, directory in enumerate(order))
+
+    file_ids = {}
+    top_file_ids = []
+    lists = []
+    for directory in order:
+        top_file_ids.append(len(file_ids))
+        entries = []
+        for name, is_directory in directories[directory]:
+            path = (directory + '/' + name).lstrip('/')
+            if is_directory:
+                directory_id = directory_ids[path]
+            else:
+                directory_id = None
+                file_ids[path] = len(file_ids)
+            entries.append(Container(
+                metadata=Container(is_directory=is_directory,
+                                   length=len(name)),
+                filename=name.encode('ascii'),
+                directory_id=directory_id,
+            ))
+        entries.append(Container(
+            metadata=Container(is_directory=False, length=0),
+            filename=b'',
+            directory_id=None,
+        ))
+        lists.append(filename_list_struct.build(entries))
+
+    # `filename_table_struct` finds the lists with pointers, so the rows
+    # pointing at them are built by hand
+    rows = []
+    offset = 8 * len(order)
+    for n, directory in enumerate(order):
+        if n == 0:
+            parent = len(order)
+        else:
+            parent = directory_ids[directory.rpartition('/')[0]]
+        rows.append(struct.pack('<IHH', offset, top_file_ids[n], parent))
+        offset += len(lists[n])
+
+    return b''.join(rows) + b''.join(lists), file_ids
+
+def make_banner(title):
+    """Builds a banner with the given title in every language."""
+    # UnicodeDSString only parses; it can't build
+    title = title.encode('utf-16-le')[:256].ljust(256, b'\x00')
+    banner = (struct.pack('<HH28x', 1, 0) + b'\x00' * (512 + 32)
+              + title * 6)
+    banner = banner[:2] + struct.pack('<H', crc16(banner[0x20:])) + banner[4:]
+    assert len(banner) == banner_struct.sizeof()
+    return banner
+
+def make_image(files, title='PORIGONZ', game_code='PZZZ', rng=None):
+    """Builds a DS image containing `files`, a list of (path, data).  Paths
+    are relative, like 'a/b/c.narc'.
+    """
+    if rng is None:
+        rng = random.Random(0)
+
+    fnt, file_ids = _filename_table([path for path, data in files])
+    contents = [None] * len(files)
+    for path, data in files:
+        contents[file_ids[path]] = data
+
+    # Header, then the (random) ARM9 binary, banner, tables, and every file,
+    # all 512-byte aligned
+    arm9 = random_bytes(rng, 0x4000)
+    banner = make_banner(text_type(title))
+    blocks = [arm9, banner, fnt, b'\x00' * (8 * len(contents))] + contents
+
+    offsets = []
+    pos = HEADER_LENGTH
+    for block in blocks:
+        offsets.append(pos)
+        pos = pos + len(block)
+        pos += -pos % 0x200
+    rom_length = pos
+    arm9_offset, banner_offset, fnt_offset, fat_offset = offsets[:4]
+
+    fat = fat_struct.build([
+        Container(start=offset, end=offset + len(data))
+        for offset, data in zip(offsets[4:], contents)])
+    blocks[3] = fat
+
+    card_size = 0
+    while (0x20000 << card_size) < rom_length:
+        card_size += 1
+
+    fields = dict.fromkeys(
+        [subcon.name for subcon in nds_image_struct.subcons], 0)
+    fields.update(
+        title=title.encode('ascii').ljust(12, b'\x00'),
+        id=game_code.encode('ascii'),
+        card_size=card_size,
+        card_info=b'\x00' * 10,
+        arm9_source=arm9_offset,
+        arm9_binary_length=len(arm9),
+        file_table_offset=fnt_offset,
+        file_table_length=len(fnt),
+        fat_offset=fat_offset,
+        fat_length=len(fat),
+        banner_offset=banner_offset,
+        crc16=crc16(arm9),
+        rom_length=rom_length,
+        header_length=HEADER_LENGTH,
+        unknown5=b'\x00' * 56,
+        gba_logo=LOGO,
+        logo_crc16=crc16(LOGO),
+        reserved1=b'\x00' * 160,
+    )
+    header = nds_image_struct.build(Container(**fields))
+    header = header[:0x15e] + struct.pack('<H', crc16(header[:0x15e])) \
+        + header[0x160:]
+
+    image = bytearray(rom_length)
+    image[0:len(header)] = header
+    for offset, block in zip(offsets, blocks):
+        image[offset:offset + len(block)] = block
+    return bytes(image)
+
+def pokemon_image(seed=0, scale=1):
+    u"""Builds an image that looks a bit like a Pokémon game: a deep tree of
+    a few thousand small files, NARCs of text and sprites and records, and
+    some textures.  `scale` multiplies the amount of everything.
+    """
+    rng = random.Random(seed)
+    files = []
+
+    # Lots of little files, several directories deep
+    for n in range(2000 * scale):
+        path = 'fielddata/area%d/zone%d/map%d/file%04d.bin' % (
+            n % 6, n // 6 % 5, n // 30 % 4, n)
+        files.append((path, random_bytes(rng, rng.randint(16, 256))))
+
+    # Text, in many banks
+    files.append(('msgdata/msg.narc', make_narc([
+        random_text_bank(rng, rng.randint(10, 100))
+        for _ in range(200 * scale)])))
+
+    # Front and back sprites, normal and shiny palettes, for each species
+    members = []
+    for _ in range(50 * scale):
+        members.extend([
+            make_pokemon_sprite(rng),
+            make_pokemon_sprite(rng),
+            make_rlcn(random_bytes(rng, 32)),
+            make_rlcn(random_bytes(rng, 32)),
+        ])
+    files.append(('poketool/pokegra/pokegra.narc', make_narc(members)))
+
+    # Records
+    for path, layout, count in (
+        ('poketool/personal/personal.narc', 'pokemon-base-stats', 500),
+        ('poketool/waza/waza_tbl.narc', 'pokemon-moves', 470)):
+        size = layouts[layout].size
+        files.append((path, make_narc([
+            random_bytes(rng, size) for _ in range(count * scale)])))
+
+    # Textures, loose and in a NARC
+    for n in range(10 * scale):
+        files.append(('graphic/tex%02d.nsbtx' % n, random_btx0(rng)))
+    files.append(('graphic/textures.narc', make_narc([
+        random_btx0(rng) for _ in range(10 * scale)])))
+
+    return make_image(files, rng=rng)
+
+def write_pokemon_image(filename, seed=0, scale=1):
+    """Writes `pokemon_image` to a file."""
+    f = open(filename, 'wb')
+    try:
+        f.write(pokemon_image(seed, scale))
+    finally:
+        f.close()
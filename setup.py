@@ -9,7 +9,12 @@ setup(
 
     packages = find_packages(),
     package_data = { '': ['data'] },
-    install_requires = ['construct>=2.0'],
+    # construct 2.5 keeps 2.0's API, and is the first to support Python 3
+    install_requires = ['construct>=2.0,<2.6'],
+    classifiers = [
+        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+    ],
     entry_points = {
         'console_scripts': [
             'porigon-z = porigonz:main',